@@ -0,0 +1,306 @@
+"""Load-test a MusicServer with simulated headless clients.
+
+Starts server.py as a subprocess on a synthetic library, then drives it from
+a few worker processes, each running many asyncio clients that speak the
+framed LIST/PLAY protocol. Two phases are measured per server mode:
+
+    churn  clients connect, read HELLO and disconnect in a loop (conn/s)
+    load   persistent clients mix LIST pages and PLAY downloads
+           (LIST p50/p99, time to first DATA byte, aggregate MB/s)
+
+Results are printed and can be saved as JSON and compared with an earlier
+run:
+
+    python bench/bench_load.py --modes thread async --clients 64 --output load.json
+    python bench/bench_load.py --modes async --baseline load.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from common import protocol
+
+# name, unit, True when larger is better
+METRICS = [
+    ('connections_per_sec', 'conn/s', True),
+    ('list_p50_ms', 'ms', False),
+    ('list_p99_ms', 'ms', False),
+    ('ttfb_p50_ms', 'ms', False),
+    ('ttfb_p99_ms', 'ms', False),
+    ('throughput_mb_s', 'MB/s', True),
+]
+
+
+def make_library(directory, tracks, track_kb):
+    """Write `tracks` WAV files of about track_kb KiB each"""
+    frames = os.urandom(track_kb * 1024)
+    names = []
+    for i in range(tracks):
+        name = f"track_{i:05d}.wav"
+        with wave.open(os.path.join(directory, name), 'wb') as w:
+            w.setnchannels(2)
+            w.setsampwidth(2)
+            w.setframerate(44100)
+            w.writeframes(frames)
+        names.append(name)
+    return names
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(mode, port, music_dir, max_connections, extra_args=()):
+    cmd = [
+        sys.executable, os.path.join(ROOT, 'server', 'server.py'),
+        '--host', '127.0.0.1',
+        '--port', str(port),
+        '--music-dir', music_dir,
+        '--mode', mode,
+        '--backlog', '1024',
+        '--max-connections', str(max_connections),
+    ]
+    cmd.extend(extra_args)
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Server exited with status {proc.returncode}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("Server did not start listening")
+
+
+def stop_server(proc):
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+async def _read_frame(reader):
+    header = await reader.readexactly(protocol.HEADER_SIZE)
+    msg_type, flags, request_id, length = protocol.unpack_header(header)
+    payload = await reader.readexactly(length) if length else b''
+    return msg_type, flags, request_id, payload
+
+
+async def _connect(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    msg_type, flags, request_id, payload = await _read_frame(reader)
+    if msg_type != protocol.HELLO:
+        writer.close()
+        raise ConnectionError(f"Expected HELLO, got frame type {msg_type}")
+    return reader, writer
+
+
+async def _request(reader, writer, request_id, command):
+    writer.write(protocol.pack_header(protocol.REQUEST, request_id, len(command)) + command.encode())
+    msg_type, flags, rid, payload = await _read_frame(reader)
+    if msg_type != protocol.RESPONSE or rid != request_id:
+        raise ConnectionError(f"Bad reply to {command}")
+    reply = protocol.decode_json(payload)
+    if reply.get('status') != 'OK':
+        raise ConnectionError(reply.get('message', 'Server error'))
+    return reply
+
+
+async def churn_client(port, deadline, stats):
+    """Connect, wait for HELLO, disconnect; repeat until deadline"""
+    while time.time() < deadline:
+        try:
+            reader, writer = await _connect(port)
+            writer.close()
+            await writer.wait_closed()
+            stats['connections'] += 1
+        except (OSError, asyncio.IncompleteReadError):
+            stats['errors'] += 1
+
+
+async def load_client(port, names, deadline, list_ratio, seed, stats):
+    """Mix LIST pages and full PLAY downloads on one connection"""
+    rng = random.Random(seed)
+    try:
+        reader, writer = await _connect(port)
+    except (OSError, asyncio.IncompleteReadError):
+        stats['errors'] += 1
+        return
+
+    request_id = 0
+    try:
+        while time.time() < deadline:
+            request_id += 1
+            start = time.perf_counter()
+            if rng.random() < list_ratio:
+                offset = rng.randrange(max(1, len(names) - 50))
+                await _request(reader, writer, request_id, f"LIST:offset={offset}&limit=50")
+                stats['list'].append(time.perf_counter() - start)
+                continue
+
+            await _request(reader, writer, request_id, f"PLAY:{rng.choice(names)}")
+            first = True
+            while True:
+                msg_type, flags, rid, payload = await _read_frame(reader)
+                if msg_type != protocol.DATA or rid != request_id:
+                    raise ConnectionError(f"Unexpected frame type {msg_type}")
+                if first:
+                    stats['ttfb'].append(time.perf_counter() - start)
+                    first = False
+                stats['bytes'] += len(payload)
+                if flags & protocol.FLAG_END:
+                    break
+            stats['plays'] += 1
+    except (OSError, asyncio.IncompleteReadError):
+        stats['errors'] += 1
+    finally:
+        writer.close()
+
+
+def _run_worker(job):
+    """Entry point of one load-generating process"""
+    port, clients, names, start, churn_until, load_until, list_ratio, seed = job
+    stats = {'connections': 0, 'errors': 0, 'list': [], 'ttfb': [], 'bytes': 0, 'plays': 0}
+
+    async def run():
+        # Pool startup is staggered; begin together so the phases line up
+        await asyncio.sleep(max(0.0, start - time.time()))
+        await asyncio.gather(*(churn_client(port, churn_until, stats) for _ in range(clients)))
+        await asyncio.gather(*(load_client(port, names, load_until, list_ratio, seed + i, stats)
+                               for i in range(clients)))
+
+    asyncio.run(run())
+    return stats
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run_mode(mode, args, music_dir, names):
+    port = free_port()
+    server = start_server(mode, port, music_dir, args.clients * 2 + 16, args.server_arg)
+    try:
+        workers = max(1, min(args.workers, args.clients))
+        start = time.time() + 1.0
+        churn_until = start + args.churn_seconds
+        load_until = churn_until + args.seconds
+        jobs = [(port, args.clients // workers + (i < args.clients % workers), names,
+                 start, churn_until, load_until, args.list_ratio, args.seed + i * 100003)
+                for i in range(workers)]
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(_run_worker, jobs)
+    finally:
+        stop_server(server)
+
+    list_latency = [t for r in results for t in r['list']]
+    ttfb = [t for r in results for t in r['ttfb']]
+    to_ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {
+        'connections_per_sec': round(sum(r['connections'] for r in results) / args.churn_seconds, 1),
+        'list_requests': len(list_latency),
+        'list_p50_ms': to_ms(percentile(list_latency, 50)),
+        'list_p99_ms': to_ms(percentile(list_latency, 99)),
+        'plays': sum(r['plays'] for r in results),
+        'ttfb_p50_ms': to_ms(percentile(ttfb, 50)),
+        'ttfb_p99_ms': to_ms(percentile(ttfb, 99)),
+        'throughput_mb_s': round(sum(r['bytes'] for r in results) / args.seconds / 1e6, 1),
+        'errors': sum(r['errors'] for r in results),
+    }
+
+
+def print_results(results):
+    print(f"{'mode':<8} {'conn/s':>9} {'LIST p50':>9} {'LIST p99':>9} "
+          f"{'TTFB p50':>9} {'TTFB p99':>9} {'MB/s':>9} {'errors':>7}")
+    fmt = lambda v: 'n/a' if v is None else f"{v:.1f}"
+    for mode, r in results.items():
+        print(f"{mode:<8} {fmt(r['connections_per_sec']):>9} {fmt(r['list_p50_ms']):>9} "
+              f"{fmt(r['list_p99_ms']):>9} {fmt(r['ttfb_p50_ms']):>9} {fmt(r['ttfb_p99_ms']):>9} "
+              f"{fmt(r['throughput_mb_s']):>9} {r['errors']:>7}")
+
+
+def compare(results, baseline):
+    """Print the change of each metric against a saved run"""
+    for mode, r in results.items():
+        base = baseline.get('results', {}).get(mode)
+        if base is None:
+            print(f"{mode}: not in baseline")
+            continue
+        print(f"{mode} vs baseline:")
+        for key, unit, higher_is_better in METRICS:
+            old, new = base.get(key), r.get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            better = change >= 0 if higher_is_better else change <= 0
+            print(f"  {key:<20} {old:>10.1f} -> {new:>10.1f} {unit:<6} "
+                  f"{change:+6.1f}% {'better' if better else 'worse'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', nargs='+', default=['thread', 'async'])
+    parser.add_argument('--clients', type=int, default=64, help="Concurrent simulated clients")
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1),
+                        help="Load-generating processes")
+    parser.add_argument('--seconds', type=float, default=10.0, help="Length of the load phase")
+    parser.add_argument('--churn-seconds', type=float, default=3.0, help="Length of the connect phase")
+    parser.add_argument('--tracks', type=int, default=200)
+    parser.add_argument('--track-kb', type=int, default=512)
+    parser.add_argument('--list-ratio', type=float, default=0.5, help="Share of requests that are LIST")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help="Extra argument for server.py, e.g. --server-arg=--no-sendfile")
+    parser.add_argument('--output', help="Save results to this JSON file")
+    parser.add_argument('--baseline', help="Compare against a JSON file from an earlier run")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as music_dir:
+        names = make_library(music_dir, args.tracks, args.track_kb)
+        for mode in args.modes:
+            print(f"Running {mode} mode: {args.clients} clients, {args.seconds:g}s...")
+            results[mode] = run_mode(mode, args, music_dir, names)
+
+    print_results(results)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'cpus': os.cpu_count(),
+                'config': vars(args),
+                'results': results
+            }, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,33 @@
-import socket
+import logging
 import os
-from tkinter import Tk, Label, Listbox, Button, messagebox, filedialog, ttk, Canvas, PhotoImage
+import sys
+from tkinter import Tk, Label, Listbox, Button, messagebox, filedialog, ttk, Canvas, PhotoImage, StringVar
+from urllib.parse import urlencode
 from PIL import Image, ImageTk
 import pygame
 import threading
 import json
 import time
-import struct
 import io
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3
+import shutil
+import zlib
+import base64
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from streaming import StreamBuffer, StreamReader
+from integrity import BlockVerifier
+from track_cache import TrackCache
+from mux import TransferCancelled
+from pool import ConnectionPool
+from playqueue import PlayQueue, Prefetcher
+from worker import UiDispatcher, BackgroundTasks
+
+log = logging.getLogger("musicclient")
+
+def _format_time(seconds):
+    """m:ss for a seek bar label (0:00 when unknown)"""
+    seconds = int(seconds or 0)
+    return f"{seconds // 60}:{seconds % 60:02d}"
 
 class MusicClient:
     def __init__(self, root):
@@ -19,22 +37,63 @@ class MusicClient:
         
         self.host = 'localhost'
         self.port = 12345
-        self.client_socket = None
+        self.pool = None
+        self.connecting = False
+        self.transfer_connections = 2  # Besides the control connection
+        self.keepalive_interval = 15.0  # Below the server's 30s idle timeout
+        self.resume_attempts = 3
+        self.current_transfer = None
         self.connected = False
         self.current_file = None
         self.pause_position = 0  # Track pause position
+        self.play_start = 0.0  # Seconds into the track the last play() started at
         self.download_dir = "downloaded_music"
         self.playing = False
         self.paused = False
-        self.lock = threading.Lock()
         self.current_image = None
+        self.current_track = None
+        self.album_art_size = 300
+        self.streaming = True  # Start playback before the download completes
+        self.prebuffer_seconds = 3.0
+        self.prebuffer_bytes = None  # Overrides prebuffer_seconds when set
+        self.stream_buffer_size = 1 << 20
+        self.time_to_first_sound = None
+        # Rendition to play ('high', 'medium' or 'low'); None plays originals
+        self.quality = None
+        self.play_queue = PlayQueue()
+        self.prefetcher = None
+        self.prefetch_transfer = None
+        self.prefetch_depth = 2  # Queued tracks downloaded ahead of time
+        self.prefetch_max_bytes = 256 << 20
+        self.page_size = 200
+        self.list_total = 0
+        self.loading_page = False
+        self.list_generation = 0  # Bumped per search; late pages of older ones are dropped
         self.default_album_art = self._create_default_album_art()
+        # Seek bar: the track's duration and peak levels (0-255) from WAVE
+        self.waveform_height = 48
+        self.track_duration = None
+        self.track_peaks = b''
+        self.wave_bars = []
+        self.wave_played = 0
         
         if not os.path.exists(self.download_dir):
             os.makedirs(self.download_dir)
         
+        # Played tracks are kept here so replays cost no network traffic
+        self.cache_max_bytes = 1 << 30
+        self.track_cache = None
+        if self.cache_max_bytes:
+            self.track_cache = TrackCache(os.path.join(self.download_dir, "cache"), self.cache_max_bytes)
+        
         pygame.mixer.init()
         self.setup_ui()
+        
+        # Blocking work runs on worker threads; widgets are only ever
+        # touched on the Tk thread, through self.ui
+        self.ui = UiDispatcher(self.root)
+        self.tasks = BackgroundTasks(self.ui)
+        self.root.after(250, self._tick)
     
     def _create_default_album_art(self):
         """Create a default album art image"""
@@ -77,8 +136,31 @@ class MusicClient:
         list_frame = ttk.LabelFrame(content_frame, text="Available Music", padding=10)
         list_frame.pack(side="right", fill="both", expand=True, padx=5, pady=5)
         
-        self.music_listbox = Listbox(list_frame, height=15, bg="white", fg="black")
-        self.music_listbox.pack(fill="both", expand=True)
+        search_frame = ttk.Frame(list_frame)
+        search_frame.pack(fill="x", pady=(0, 5))
+        
+        self.search_var = StringVar()
+        search_entry = ttk.Entry(search_frame, textvariable=self.search_var)
+        search_entry.pack(side="left", fill="x", expand=True)
+        search_entry.bind("<Return>", lambda event: self.refresh_list())
+        
+        self.sort_var = StringVar(value="name")
+        ttk.Combobox(search_frame, textvariable=self.sort_var, width=8, state="readonly",
+                     values=("name", "title", "artist", "album", "duration")).pack(side="left", padx=5)
+        ttk.Button(search_frame, text="Search", command=self.refresh_list).pack(side="left")
+        
+        listbox_frame = ttk.Frame(list_frame)
+        listbox_frame.pack(fill="both", expand=True)
+        
+        list_scrollbar = ttk.Scrollbar(listbox_frame, orient="vertical")
+        list_scrollbar.pack(side="right", fill="y")
+        self.music_listbox = Listbox(listbox_frame, height=15, bg="white", fg="black")
+        self.music_listbox.pack(side="left", fill="both", expand=True)
+        
+        # Pages are fetched lazily as the list is scrolled towards its end
+        self.list_scrollbar = list_scrollbar
+        self.music_listbox.config(yscrollcommand=self._on_list_scroll)
+        list_scrollbar.config(command=self.music_listbox.yview)
         
         ttk.Button(list_frame, text="Refresh List", command=self.refresh_list).pack(pady=5)
         
@@ -90,6 +172,24 @@ class MusicClient:
         ttk.Button(controls_frame, text="Pause", command=self.pause_music).pack(side="left", padx=5)
         ttk.Button(controls_frame, text="Stop", command=self.stop_playback).pack(side="left", padx=5)
         ttk.Button(controls_frame, text="Download", command=self.download_selected).pack(side="left", padx=5)
+        ttk.Button(controls_frame, text="Add to Queue", command=self.queue_selected).pack(side="left", padx=5)
+        ttk.Button(controls_frame, text="Next", command=self.play_next).pack(side="left", padx=5)
+        
+        self.quality_var = StringVar(value=self.quality or "original")
+        quality_box = ttk.Combobox(controls_frame, textvariable=self.quality_var, width=8, state="readonly",
+                                   values=("original", "high", "medium", "low"))
+        quality_box.pack(side="right", padx=5)
+        quality_box.bind("<<ComboboxSelected>>", lambda event: self._set_quality(self.quality_var.get()))
+        ttk.Label(controls_frame, text="Quality:").pack(side="right")
+        
+        # Play Queue Frame
+        queue_frame = ttk.LabelFrame(main_frame, text="Up Next", padding=10)
+        queue_frame.pack(fill="x", pady=5)
+        
+        self.queue_listbox = Listbox(queue_frame, height=4, bg="white", fg="black")
+        self.queue_listbox.pack(side="left", fill="x", expand=True)
+        ttk.Button(queue_frame, text="Remove", command=self.remove_queued).pack(side="top", padx=5, pady=2)
+        ttk.Button(queue_frame, text="Clear", command=self.clear_queue).pack(side="top", padx=5, pady=2)
         
         # Song Info Frame
         self.song_info_frame = ttk.LabelFrame(main_frame, text="Song Information", padding=10)
@@ -104,161 +204,502 @@ class MusicClient:
         self.song_album = ttk.Label(self.song_info_frame, text="Album: Unknown", font=("Arial", 10))
         self.song_album.pack(anchor="w")
         
+        # Seek bar, drawn as the track's waveform; click to jump
+        seek_frame = ttk.Frame(self.song_info_frame)
+        seek_frame.pack(fill="x", pady=(5, 0))
+        self.time_label = ttk.Label(seek_frame, text="0:00 / 0:00", font=("Arial", 9))
+        self.time_label.pack(side="right", padx=5)
+        self.wave_canvas = Canvas(seek_frame, height=self.waveform_height, bg="#1e1e1e", highlightthickness=0)
+        self.wave_canvas.pack(side="left", fill="x", expand=True)
+        self.wave_canvas.bind("<Button-1>", self._seek_click)
+        self.wave_canvas.bind("<Configure>", lambda event: self._draw_waveform())
+        
         # Status Bar
         self.status_bar = ttk.Label(main_frame, text="Ready", relief="sunken")
         self.status_bar.pack(fill="x", pady=5)
     
-    def _extract_album_art(self, filepath):
-        """Extract album art from MP3 file"""
+    def _load_track_info(self, filename, points):
+        """Fetch tags (META), album art (ART) and the waveform (WAVE) for
+        filename.
+        
+        Runs on a worker thread as soon as a track is picked, so the info
+        shows before any audio arrives; the server has the thumbnail
+        ready at display size and the waveform at `points` peaks, so
+        nothing is parsed, resized or decoded here.
+        """
+        meta = {}
+        image = None
+        wave = {}
         try:
-            audio = MP3(filepath, ID3=ID3)
-            if 'APIC:' in audio.tags:
-                album_art = audio.tags['APIC:'].data
-                img = Image.open(io.BytesIO(album_art))
-                img = img.resize((300, 300), Image.LANCZOS)
-                return ImageTk.PhotoImage(img)
+            wave = json.loads(self._call(f"WAVE:{filename}:{points}"))
         except Exception:
-            pass
-        return None
+            pass  # A plain seek bar from META's duration
+        try:
+            meta = json.loads(self._call(f"META:{filename}"))
+            if meta.get('status') == 'OK' and meta.get('art_sizes'):
+                conn, request_id, response = self.pool.request_transfer(f"ART:{filename}:{self.album_art_size}")
+                if json.loads(response).get('status') != 'OK':
+                    conn.release(request_id)
+                else:
+                    image = Image.open(io.BytesIO(b''.join(conn.data(request_id))))
+                    image.load()
+                    if max(image.size) > self.album_art_size:
+                        # An original-size rendition from a server without Pillow
+                        image.thumbnail((self.album_art_size, self.album_art_size))
+        except Exception:
+            pass  # Fall back to the file name and default art
+        self.ui.post(self._show_track_info, filename, meta, image, wave)
     
-    def _update_album_art(self, filepath):
-        """Update the album art display"""
-        img = self._extract_album_art(filepath)
-        if img:
-            self.current_image = img  # Keep reference
-            self.album_canvas.delete("all")
-            self.album_canvas.create_image(150, 150, image=img)
+    def _show_track_info(self, filename, meta, image, wave=None):
+        """Update album art and song info (Tk thread)"""
+        if filename != self.current_track:
+            return  # Another track was picked meanwhile
+        self.song_title.config(text=f"Title: {meta.get('title') or filename}")
+        self.song_artist.config(text=f"Artist: {meta.get('artist') or 'Unknown'}")
+        self.song_album.config(text=f"Album: {meta.get('album') or 'Unknown'}")
+        
+        self.album_canvas.delete("all")
+        if image is not None:
+            self.current_image = ImageTk.PhotoImage(image)  # Keep reference
+            self.album_canvas.create_image(150, 150, image=self.current_image)
         else:
-            self.album_canvas.delete("all")
             self.album_canvas.create_image(150, 150, image=self.default_album_art)
+        
+        wave = wave if wave and wave.get('status') == 'OK' else {}
+        self.track_duration = wave.get('duration') or meta.get('duration')
+        self.track_peaks = base64.b64decode(wave.get('peaks') or '')
+        self._draw_waveform()
     
-    def _update_song_info(self, filepath):
-        """Update song information display"""
+    def _draw_waveform(self):
+        """Redraw the seek bar: one bar per peak, mirrored about the middle"""
+        canvas = self.wave_canvas
+        canvas.delete("all")
+        width, height = max(canvas.winfo_width(), 1), self.waveform_height
+        middle = height / 2
+        peaks = self.track_peaks
+        if peaks:
+            step = width / len(peaks)
+            self.wave_bars = [
+                canvas.create_line(i * step, middle - level, i * step, middle + level + 1, fill="#5a7a9a")
+                for i, level in enumerate(max(1, peak * (height - 4) // 510) for peak in peaks)
+            ]
+        else:
+            self.wave_bars = []
+            canvas.create_line(0, middle, width, middle, fill="#5a7a9a", width=2)
+        self.wave_played = 0
+        canvas.create_line(0, 0, 0, height, fill="#ffffff", tags="cursor")
+        self._update_position()
+    
+    def _position(self):
+        """Seconds into the current track"""
+        if self.paused:
+            return self.pause_position / 1000
+        if self.playing:
+            return self.play_start + max(pygame.mixer.music.get_pos(), 0) / 1000
+        return 0.0
+    
+    def _update_position(self):
+        duration = self.track_duration
+        position = min(self._position(), duration) if duration else self._position()
+        self.time_label.config(text=f"{_format_time(position)} / {_format_time(duration)}")
+        if not duration:
+            return
+        x = position / duration * max(self.wave_canvas.winfo_width(), 1)
+        self.wave_canvas.coords("cursor", x, 0, x, self.waveform_height)
+        # Recolour only the bars the cursor passed (or went back over)
+        played = int(position / duration * len(self.wave_bars))
+        first, last = sorted((self.wave_played, played))
+        colour = "#9ad0ff" if played > self.wave_played else "#5a7a9a"
+        for bar in self.wave_bars[first:last]:
+            self.wave_canvas.itemconfig(bar, fill=colour)
+        self.wave_played = played
+    
+    def _tick(self):
+        if self.playing:
+            self._update_position()
+        self.root.after(250, self._tick)
+    
+    def _seek_click(self, event):
+        if not (self.playing or self.paused) or not self.track_duration:
+            return
+        position = event.x / max(self.wave_canvas.winfo_width(), 1) * self.track_duration
         try:
-            audio = MP3(filepath, ID3=ID3)
-            title = audio.tags.get('TIT2', ['Unknown'])[0]
-            artist = audio.tags.get('TPE1', ['Unknown'])[0]
-            album = audio.tags.get('TALB', ['Unknown'])[0]
-            
-            self.song_title.config(text=f"Title: {title}")
-            self.song_artist.config(text=f"Artist: {artist}")
-            self.song_album.config(text=f"Album: {album}")
-        except Exception:
-            filename = os.path.basename(filepath)
-            self.song_title.config(text=f"Title: {filename}")
-            self.song_artist.config(text="Artist: Unknown")
-            self.song_album.config(text="Album: Unknown")
+            pygame.mixer.music.play(start=position)
+        except pygame.error as e:
+            self.status_bar.config(text=f"Cannot seek: {e}")
+            return
+        self.play_start = position
+        self.paused = False
+        self._update_position()
+    
+    def _set_status(self, text):
+        self.status_bar.config(text=text)
     
     def connect(self):
-        if self.connected:
+        if self.connected or self.connecting:
             return
         
+        # Verify connection; the HELLO is read before requests start
+        pool = ConnectionPool(
+            self.host, self.port,
+            transfers=self.transfer_connections,
+            keepalive=self.keepalive_interval,
+            on_state=self._on_connection_state
+        )
+        self.connecting = True
+        self.status_bar.config(text=f"Connecting to {self.host}:{self.port}...")
+        self.tasks.run(
+            pool.open,
+            on_done=lambda welcome: self._on_connected(pool),
+            on_error=lambda e: self._on_connect_failed(pool, e)
+        )
+    
+    def _on_connected(self, pool):
+        self.connecting = False
+        self.pool = pool
+        if self.track_cache and self.prefetch_depth:
+            # Prefetched tracks land in the track cache, so playing
+            # them is a cache hit
+            self.prefetcher = Prefetcher(
+                self.play_queue, self._stat, self._prefetch, self._cancel_prefetch,
+                depth=self.prefetch_depth,
+                max_bytes=self.prefetch_max_bytes
+            )
+        
+        self.connected = True
+        self.status_label.config(text=f"Status: Connected to {self.host}:{self.port}", foreground="green")
+        self.status_bar.config(text="Connected to server")
+        self.refresh_list()
+    
+    def _on_connect_failed(self, pool, e):
+        self.connecting = False
+        pool.close()
+        messagebox.showerror("Error", f"Failed to connect: {str(e)}")
+        self.status_bar.config(text=f"Connection failed: {str(e)}")
+    
+    def _on_connection_state(self, state, detail):
+        """Reconnect progress reported by the ConnectionPool (any thread)"""
+        self.ui.post(self._show_connection_state, state, detail)
+    
+    def _show_connection_state(self, state, detail):
+        if not self.connected:
+            return
+        if state == 'reconnecting':
+            self.status_label.config(text=f"Status: Reconnecting (attempt {detail})...", foreground="orange")
+        elif state == 'connected':
+            self.status_label.config(text=f"Status: Connected to {self.host}:{self.port}", foreground="green")
+        elif state == 'lost':
+            self.status_label.config(text="Status: Connection lost", foreground="red")
+            self.status_bar.config(text=f"Connection lost: {str(detail)}")
+
+    def _call(self, message):
+        """JSON text of the RESPONSE to a control request"""
+        try:
+            return self.pool.call(message)
+        except Exception as e:
+            raise ConnectionError(f"Failed to receive message: {str(e)}")
+
+    def _call_json(self, message):
+        """Decoded reply to a control request; ValueError unless status is OK"""
+        response = self._call(message)
+        if not response:
+            raise ValueError("No response from server")
+        data = json.loads(response)
+        if data.get('status') != 'OK':
+            raise ValueError(data.get('message', 'Server error'))
+        return data
+
+    def _stat(self, filename):
+        """Ask the server for a track's size/mtime/etag"""
+        return self._call_json(f"STAT:{filename}")
+
+    def _set_quality(self, quality):
+        """Ask for this rendition from the next track on"""
+        self.quality = None if quality == "original" else quality
+        if self.prefetcher:
+            # Prefetch the upcoming tracks at the new quality
+            self.prefetcher.wake()
+
+    def _rendition_etag(self, etag, quality):
+        """The etag the server gives the rendition of a track with etag"""
+        return f"{etag}.{quality}" if quality else etag
+
+    def _format_hint(self, path, filename):
+        """Decoder hint for a file: renditions may be MP3 despite a .wav name"""
+        with open(path, 'rb') as f:
+            magic = f.read(4)
+        if magic == b'RIFF':
+            return 'wav'
+        if magic[:3] == b'ID3' or magic[:1] == b'\xff':
+            return 'mp3'
+        return os.path.splitext(filename)[1][1:]
+
+    def _partial_path(self, filepath):
+        return filepath + ".part"
+
+    def _request_file(self, filename, filepath, command="PLAY", quality=None, etag=None):
+        """Send PLAY for filename, resuming a partial download of filepath.
+        
+        command="DOWNLOAD" asks for the same bytes as bulk traffic, which
+        the server schedules behind playback streams. quality asks for a
+        rendition; the server sends the original until it has made one.
+        A partial download is only resumed if the reply's etag matches
+        etag, the version it was a part of, when that is given.
+        
+        Returns the server's reply: the offset, length, total size and
+        etag of the byte range that will follow as DATA frames and the
+        quality actually sent, plus the command, connection and request_id
+        they will arrive on.
+        """
+        part_file = self._partial_path(filepath)
+        offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+        
+        request = f"{command}@{quality}" if quality else command
+        conn, request_id, response = self.pool.request_transfer(
+            f"{request}:{filename}:{offset}" if offset else f"{request}:{filename}")
+        data = json.loads(response) if response else {}
+        if data.get('status') != 'OK':
+            conn.release(request_id)
+        elif offset and etag and data.get('etag') != etag:
+            # Not the bytes the partial copy was made of
+            conn.cancel(request_id)
+            conn.release(request_id)
+            data = {}
+        
+        if offset and data.get('status') not in ('OK', 'BUSY'):
+            # The partial copy no longer fits the server's file; start over
+            os.remove(part_file)
+            return self._request_file(filename, filepath, command, quality)
+        if data.get('status') != 'OK':
+            raise ValueError(data.get('message', 'No response from server'))
+        data.update(command=command, conn=conn, request_id=request_id)
+        return data
+
+    def _request_range(self, ready, position, length):
+        """Request length bytes from position of the file ready describes.
+        
+        Returns the (conn, request_id) its DATA frames will arrive on;
+        raises if the server's copy is no longer the one ready is for.
+        """
+        # The quality that was sent, not the one asked for: a rendition
+        # made since the original was sent would not match it
+        command = ready['command']
+        quality = ready.get('quality')
+        if quality and quality != "original":
+            command = f"{command}@{quality}"
+        conn, request_id, response = self.pool.request_transfer(
+            f"{command}:{ready['name']}:{position}:{length}")
+        data = json.loads(response) if response else {}
+        if data.get('status') != 'OK' or data.get('etag') != ready.get('etag'):
+            conn.cancel(request_id)
+            conn.release(request_id)
+            raise ConnectionError(data.get('message', "Track changed on the server"))
+        return conn, request_id
+    
+    def _resume_transfer(self, ready, position):
+        """Re-request the rest of an interrupted transfer from position.
+        
+        The pool reconnects (with backoff) if it has to; ready is updated
+        in place with the new connection and request id.
+        """
+        end = ready['offset'] + ready['length']
+        conn, request_id = self._request_range(ready, position, end - position)
+        ready.update(conn=conn, request_id=request_id)
+    
+    def _block_prefix(self, part_file, offset, block_size):
+        """The bytes of offset's block already in part_file"""
+        start = offset - offset % block_size
+        if start == offset:
+            return b''
+        try:
+            with open(part_file, 'rb') as f:
+                f.seek(start)
+                return f.read(offset - start)
+        except OSError:
+            return b''
+    
+    def _repair_blocks(self, part_file, ready, bad):
+        """Fetch the blocks that failed their checksum again and write them
+        over the bad copies in part_file.
+        
+        A block still corrupt after resume_attempts retries fails the
+        transfer; part_file is then cut back to just before it, so the
+        next attempt resumes from the last verified byte.
+        """
+        with open(part_file, 'r+b') as f:
+            for start, length, expected in bad:
+                try:
+                    for attempt in range(self.resume_attempts + 1):
+                        conn, request_id = self._request_range(ready, start, length)
+                        data = b''.join(conn.data(request_id))
+                        if len(data) == length and zlib.crc32(data) == expected:
+                            break
+                    else:
+                        raise ConnectionError(f"Block at byte {start} is still corrupt "
+                                              f"after {attempt + 1} attempts")
+                except Exception:
+                    f.truncate(start)
+                    raise
+                f.seek(start)
+                f.write(data)
+
+    def _receive_file(self, filepath, ready, stream=None, progress=True):
+        """Thread-safe file receiving.
+        
+        `ready` is the PLAY reply from _request_file. Data is appended to
+        filepath.part from its offset and only renamed to filepath once
+        complete, so an interrupted transfer can be resumed. With a
+        StreamBuffer, every chunk is also fed to it as it arrives.
+        
+        If the connection drops, the rest is re-requested from where it
+        broke off, up to resume_attempts times. When the reply carries
+        block checksums, each block is checked as it completes (and, on a
+        resume, the blocks already in filepath.part before anything is
+        appended) and the ones that fail are fetched again before the
+        file is renamed into place. progress=False keeps background downloads out of the status
+        bar; otherwise progress is reported through self.ui at most 10
+        times a second.
+        """
+        part_file = self._partial_path(filepath)
+        offset, length, total = ready['offset'], ready['length'], ready['total']
         try:
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.settimeout(10)
-            self.client_socket.connect((self.host, self.port))
+            if stream:
+                stream.set_size(total)
             
-            # Verify connection
-            welcome = self._receive_message()
-            if not welcome:
-                raise ConnectionError("Connection failed")
+            # Receive file data; unbuffered when streaming so the player
+            # can read back anything that has left the ring buffer
+            received = 0
+            resumes = 0
+            verifier = None
+            if ready.get('checksums'):
+                block_size = ready['block_size']
+                verifier = BlockVerifier(block_size, ready['checksums'], offset, total,
+                                         self._block_prefix(part_file, offset, block_size))
+                if ready.get('prefix_checksums'):
+                    # Resuming: check what is already on disk before
+                    # adding to it; bad blocks are re-fetched with the rest
+                    with open(part_file, 'rb') as f:
+                        verifier.check_prefix(f, ready['prefix_checksums'])
+            with open(part_file, 'ab' if offset else 'wb', buffering=0 if stream else -1) as f:
+                while True:
+                    try:
+                        for data in ready['conn'].data(ready['request_id']):
+                            f.write(data)
+                            if verifier:
+                                verifier.feed(data)
+                            if stream:
+                                stream.feed(data)
+                            received += len(data)
+                            if progress:
+                                percent = int(((offset + received) / total) * 100) if total else 100
+                                self.ui.progress(filepath, self._set_status,
+                                                 f"Downloading {os.path.basename(filepath)}: {percent}%")
+                        break
+                    except TransferCancelled:
+                        raise
+                    except ConnectionError:
+                        # Only a dropped connection is worth resuming
+                        if (ready['conn'].error is None or ready.get('cancelled')
+                                or resumes >= self.resume_attempts or received >= length):
+                            raise
+                        resumes += 1
+                        self.ui.post(self._set_status, f"Connection lost, resuming {os.path.basename(filepath)}...")
+                        self._resume_transfer(ready, offset + received)
             
-            self.connected = True
-            self.status_label.config(text=f"Status: Connected to {self.host}:{self.port}", foreground="green")
-            self.status_bar.config(text="Connected to server")
-            self.refresh_list()
+            if received != length:
+                raise ConnectionError(f"Received {received} of {length} bytes")
+            if verifier and verifier.bad:
+                if progress:
+                    self.ui.post(self._set_status, f"Re-fetching {len(verifier.bad)} corrupt "
+                                                   f"block(s) of {os.path.basename(filepath)}...")
+                self._repair_blocks(part_file, ready, verifier.bad)
+            if stream:
+                stream.finish(filepath)
+            else:
+                os.replace(part_file, filepath)
+            return True
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to connect: {str(e)}")
-            self.status_bar.config(text=f"Connection failed: {str(e)}")
-            try:
-                self.client_socket.close()
-            except:
-                pass
-            self.client_socket = None
-    
-    def _send_message(self, message):
-        """Thread-safe message sending"""
-        with self.lock:
-            try:
-                message = message.encode() if isinstance(message, str) else message
-                self.client_socket.sendall(struct.pack('!I', len(message)) + message)
-            except Exception as e:
-                raise ConnectionError(f"Failed to send message: {str(e)}")
-
-    def _receive_message(self):
-        """Thread-safe message receiving"""
-        with self.lock:
-            try:
-                # Get message length
-                raw_len = self.client_socket.recv(4)
-                if not raw_len:
-                    return None
-                msg_len = struct.unpack('!I', raw_len)[0]
-                
-                # Get message data
-                return self.client_socket.recv(msg_len).decode()
-            except Exception as e:
-                raise ConnectionError(f"Failed to receive message: {str(e)}")
-
-    def _receive_file(self, filepath):
-        """Thread-safe file receiving"""
-        with self.lock:
-            try:
-                # Get file size
-                size_bytes = self.client_socket.recv(8)
-                if not size_bytes or len(size_bytes) != 8:
-                    raise ValueError("Invalid file size received")
-                
-                filesize = int.from_bytes(size_bytes, 'big')
-                
-                # Receive file data
-                received = 0
-                with open(filepath, 'wb') as f:
-                    while received < filesize:
-                        data = self.client_socket.recv(min(filesize - received, 4096))
-                        if not data:
-                            raise ConnectionError("Connection interrupted")
-                        f.write(data)
-                        received += len(data)
-                        progress = int((received / filesize) * 100)
-                        self.status_bar.config(text=f"Downloading {os.path.basename(filepath)}: {progress}%")
-                
-                return True
-            except Exception as e:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                raise ConnectionError(f"File transfer failed: {str(e)}")
+            # Keep whatever arrived in part_file for the next attempt
+            error = ConnectionError(f"File transfer failed: {str(e)}")
+            if stream:
+                stream.fail(error)
+            raise error
+        finally:
+            self.ui.done(filepath)
 
     def refresh_list(self):
         if not self.connected:
             messagebox.showwarning("Not Connected", "Please connect to the server first.")
             return
     
-        try:
-            self._send_message("LIST")
-            response = self._receive_message()
-            
-            if not response:
-                raise ValueError("No response from server")
-            
-            data = json.loads(response)
-            if data.get('status') != 'OK':
-                raise ValueError(data.get('message', 'Server error'))
-            
-            self.music_listbox.delete(0, 'end')
-            for file in data.get('files', []):
-                self.music_listbox.insert('end', file)
-                
-            self.status_bar.config(text=f"Found {len(data['files'])} songs")
-        except Exception as e:
+        self.list_generation += 1
+        self.music_listbox.delete(0, 'end')
+        self.list_total = 0
+        self._fetch_page(0)
+    
+    def _fetch_page(self, offset):
+        """Request one LIST page for the current search; it is appended
+        by _show_page when the reply arrives"""
+        params = {
+            'offset': offset,
+            'limit': self.page_size,
+            'sort': self.sort_var.get() or 'name'
+        }
+        query = self.search_var.get().strip()
+        if query:
+            params['q'] = query
+        
+        self.loading_page = True
+        generation = self.list_generation
+        self.tasks.run(
+            self._call_json, f"LIST:{urlencode(params)}",
+            on_done=lambda data: self._show_page(generation, data),
+            on_error=lambda e: self._page_failed(generation, offset, e)
+        )
+    
+    def _show_page(self, generation, data):
+        if generation != self.list_generation:
+            return
+        self.loading_page = False
+        files = data.get('files', [])
+        self.music_listbox.insert('end', *files)
+        self.list_total = data.get('total', 0)
+        about = ""
+        if not data.get('exact', True):
+            if len(files) < self.page_size:
+                # The total was an upper bound and this was the last page
+                self.list_total = self.music_listbox.size()
+            else:
+                about = "about "
+        
+        self.status_bar.config(text=f"Showing {self.music_listbox.size()} of {about}{self.list_total} songs")
+    
+    def _page_failed(self, generation, offset, e):
+        if generation != self.list_generation:
+            return
+        self.loading_page = False
+        self.status_bar.config(text=f"Error: {str(e)}")
+        if offset == 0:
+            # The pool reconnects on the next request; stay connected
             messagebox.showerror("Error", f"Failed to get music list: {str(e)}")
-            self.status_bar.config(text=f"Error: {str(e)}")
-            self.disconnect()
+    
+    def _on_list_scroll(self, first, last):
+        self.list_scrollbar.set(first, last)
+        loaded = self.music_listbox.size()
+        if float(last) > 0.9 and loaded < self.list_total and not self.loading_page:
+            self.root.after_idle(self._load_more)
+    
+    def _load_more(self):
+        loaded = self.music_listbox.size()
+        if not self.connected or self.loading_page or loaded >= self.list_total:
+            return
+        self._fetch_page(loaded)
     
     def play_selected(self):
         if self.paused:
             # Resume from paused position
             pygame.mixer.music.play(start=self.pause_position/1000)  # Convert to seconds
+            self.play_start = self.pause_position / 1000
             self.paused = False
             self.status_bar.config(text="Resumed playback")
             return
@@ -272,73 +713,273 @@ class MusicClient:
             messagebox.showwarning("No Selection", "Please select a music file to play.")
             return
         
-        filename = self.music_listbox.get(selection[0])
-        temp_file = os.path.join(self.download_dir, f"temp_{filename}")
+        self._play(self.music_listbox.get(selection[0]))
+
+    def _play(self, filename):
+        """Stop the current track and start filename"""
+        # Stop any current playback
+        self.stop_playback()
         
+        self.current_track = filename
+        self.status_bar.config(text=f"Loading {filename}...")
+        self.track_duration = None
+        self.track_peaks = b''
+        self._draw_waveform()
+        self.tasks.run(self._load_track_info, filename, max(self.wave_canvas.winfo_width(), 100))
+        self.tasks.run(self._start_track, filename, time.perf_counter(),
+                       on_error=lambda e: self._play_failed(filename, e))
+    
+    def _play_failed(self, filename, e):
+        if filename != self.current_track:
+            return
+        messagebox.showerror("Error", f"Failed to play music: {str(e)}")
+        self.status_bar.config(text=f"Error: {str(e)}")
+    
+    def _start_track(self, filename, requested_at):
+        """Look the track up in the cache or request it (worker thread)"""
+        temp_file = os.path.join(self.download_dir, f"temp_{filename}")
+        quality = self.quality
         try:
-            # Stop any current playback
-            self.stop_playback()
+            etag = None
+            if self.track_cache:
+                original = self._stat(filename)['etag']
+                etag = self._rendition_etag(original, quality)
+                temp_file = self.track_cache.path_for(filename, etag)
+                if self.prefetcher:
+                    # Don't race the prefetcher for the same .part file; the
+                    # request below resumes from whatever it already has
+                    self.prefetcher.release(filename)
+                cached = self.track_cache.lookup(filename, etag)
+                if not cached and etag != original:
+                    # A cached original sounds better and costs nothing
+                    cached = self.track_cache.lookup(filename, original)
+                if cached:
+                    self.ui.post(self._set_status, f"Playing {filename} from cache")
+                    threading.Thread(
+                        target=self._download_and_play,
+                        args=(filename, cached, None, requested_at, etag),
+                        daemon=True
+                    ).start()
+                    if self.prefetcher:
+                        self.prefetcher.wake()
+                    return
             
             # Request file from server
-            self._send_message(f"PLAY:{filename}")
-            response = self._receive_message()
-            
-            if response != "READY":
-                raise ValueError(response)
+            ready = self._request_file(filename, temp_file, quality=quality, etag=etag)
+            if etag and ready['etag'] != etag:
+                # The rendition is not made yet (or the track just changed):
+                # play what was sent without caching it under etag
+                temp_file = os.path.join(self.download_dir, f"temp_{filename}")
+                etag = None
+            if filename != self.current_track:
+                # Another track was picked while this request was in flight
+                ready['conn'].cancel(ready['request_id'])
+                ready['conn'].release(ready['request_id'])
+                return
             
             # Start download in background
-            self.status_bar.config(text=f"Downloading {filename}...")
+            self.ui.post(self._set_status, f"Downloading {filename}...")
             threading.Thread(
                 target=self._download_and_play,
-                args=(filename, temp_file),
+                args=(filename, temp_file, ready, requested_at, etag),
                 daemon=True
             ).start()
+            if self.prefetcher:
+                self.prefetcher.wake()
             
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to play music: {str(e)}")
-            self.status_bar.config(text=f"Error: {str(e)}")
-            if os.path.exists(temp_file):
+        except Exception:
+            if not self._is_cached_file(temp_file) and os.path.exists(temp_file):
                 os.remove(temp_file)
+            raise
 
-    def _download_and_play(self, filename, temp_file):
+    def _download_and_play(self, filename, temp_file, ready=None, requested_at=None, etag=None):
+        """Download (unless ready is None: already cached) and play a track.
+        
+        With an etag the finished download is committed to the track cache
+        and kept; otherwise it is deleted once playback ends. Runs on its
+        own thread for the whole playback, so it reports through self.ui.
+        """
+        stream = None
+        receiver = None
+        if ready is not None:
+            self.current_transfer = ready
         try:
-            # Download the file
-            self._receive_file(temp_file)
-            
-            # Update album art and song info
-            self._update_album_art(temp_file)
-            self._update_song_info(temp_file)
+            if ready is None:
+                # Cache hit: nothing to transfer
+                source = temp_file
+            elif self.streaming:
+                # Receive on another thread and start playing as soon as the
+                # prebuffer is in; the decoder reads through the ring buffer
+                stream = StreamBuffer(
+                    self._partial_path(temp_file),
+                    ready['offset'],
+                    capacity=self.stream_buffer_size,
+                    on_event=self._on_stream_event
+                )
+                receiver = threading.Thread(
+                    target=self._receive_stream,
+                    args=(temp_file, ready, stream),
+                    daemon=True
+                )
+                receiver.start()
+                if not stream.wait_for_prebuffer(self.prebuffer_seconds, self.prebuffer_bytes):
+                    raise stream.error
+                source = StreamReader(stream)
+            else:
+                # Download the file
+                self._receive_file(temp_file, ready)
+                source = temp_file
             
             # Play the file
             self.current_file = temp_file
-            pygame.mixer.music.load(temp_file)
+            if stream:
+                pygame.mixer.music.load(source, ready.get('format') or os.path.splitext(filename)[1][1:])
+            else:
+                pygame.mixer.music.load(source, self._format_hint(source, filename))
+            self.play_start = 0.0
             pygame.mixer.music.play()
+            if stream:
+                stream.mark_playing()
             self.playing = True
             self.paused = False
             self.pause_position = 0
-            self.status_bar.config(text=f"Playing: {filename}")
+            if requested_at is not None:
+                self.time_to_first_sound = time.perf_counter() - requested_at
+                log.info("Time to first sound for %s: %.3fs", filename, self.time_to_first_sound)
+                self.ui.post(self._set_status, f"Playing: {filename} (started in {self.time_to_first_sound:.2f}s)")
+            else:
+                self.ui.post(self._set_status, f"Playing: {filename}")
             
-            # Wait for playback to finish
-            while pygame.mixer.music.get_busy() and self.playing:
+            # Wait for playback to finish (a paused track is not finished)
+            while self.playing and (self.paused or pygame.mixer.music.get_busy()):
                     time.sleep(0.1)
+            # Ended by itself rather than stopped or replaced
+            finished = self.playing and self.current_file == temp_file
+            
+            if receiver:
+                # The rest of the transfer still has to be read off the socket
+                receiver.join()
+                log.info("Stream %s: %d underruns, %.2fs stalled",
+                         filename, stream.underruns, stream.stall_time)
+            
+            if etag and ready is not None and not (stream and stream.error):
+                self.track_cache.commit(filename, etag)
             
             # Cleanup
-            if os.path.exists(temp_file):
+            if not etag and os.path.exists(temp_file):
                 try:
                     os.remove(temp_file)
                 except:
                     pass
-            self.status_bar.config(text="Ready")
+            if stream and stream.underruns:
+                self.ui.post(self._set_status, f"Ready (last track stalled {stream.underruns} "
+                                               f"times, {stream.stall_time:.1f}s in total)")
+            else:
+                self.ui.post(self._set_status, "Ready")
+            if finished and len(self.play_queue):
+                self.ui.post(self.play_next)
             
         except Exception as e:
-            self.status_bar.config(text=f"Error: {str(e)}")
-            if os.path.exists(temp_file):
+            if ready is not None and self.current_transfer is not ready:
+                # Stopped or replaced by another track before it could play
+                return
+            self.ui.post(self._set_status, f"Error: {str(e)}")
+            if etag:
+                # Don't keep serving a copy that failed to play
+                self.track_cache.discard(temp_file)
+            elif os.path.exists(temp_file):
                 try:
                     os.remove(temp_file)
                 except:
                     pass
-            messagebox.showerror("Error", f"Playback failed: {str(e)}")
+            self.ui.post(messagebox.showerror, "Error", f"Playback failed: {str(e)}")
                 
+    def _receive_stream(self, temp_file, ready, stream):
+        try:
+            self._receive_file(temp_file, ready, stream)
+        except Exception:
+            pass  # Already recorded on the stream by _receive_file
+
+    def _on_stream_event(self, event, info):
+        """Underrun/rebuffer notifications from the StreamBuffer"""
+        if event == 'underrun':
+            log.warning("Buffer underrun #%d at byte %d", info['count'], info['position'])
+            self.ui.post(self._set_status, f"Buffering... (underrun #{info['count']})")
+        elif event == 'rebuffered':
+            log.info("Rebuffered after %.2fs", info['stalled'])
+            self.ui.post(self._set_status, f"Playing (rebuffered after {info['stalled']:.1f}s)")
+
+    def queue_selected(self):
+        selection = self.music_listbox.curselection()
+        if not selection:
+            messagebox.showwarning("No Selection", "Please select a music file to queue.")
+            return
+        
+        for index in selection:
+            self.play_queue.add(self.music_listbox.get(index))
+        self._refresh_queue()
+        if not (self.playing or self.paused) and self.connected:
+            self.play_next()
+
+    def remove_queued(self):
+        for index in reversed(self.queue_listbox.curselection()):
+            self.play_queue.remove(index)
+        self._refresh_queue()
+
+    def clear_queue(self):
+        self.play_queue.clear()
+        self._refresh_queue()
+
+    def play_next(self):
+        """Skip to the next queued track"""
+        if not self.connected:
+            messagebox.showwarning("Not Connected", "Please connect to the server first.")
+            return
+        filename = self.play_queue.pop_next()
+        self._refresh_queue()
+        if filename is None:
+            self.status_bar.config(text="Queue is empty")
+            return
+        self._play(filename)
+
+    def _refresh_queue(self):
+        self.queue_listbox.delete(0, 'end')
+        for filename in self.play_queue:
+            self.queue_listbox.insert('end', filename)
+        if self.prefetcher:
+            self.prefetcher.wake()
+
+    def _prefetch(self, filename, etag):
+        """Download a queued track into the track cache (Prefetcher.fetch)"""
+        quality = self.quality
+        if self.track_cache.lookup(filename, etag):
+            return
+        etag = self._rendition_etag(etag, quality)
+        if self.track_cache.lookup(filename, etag):
+            return
+        path = self.track_cache.path_for(filename, etag)
+        # DOWNLOAD is bulk traffic: the server paces it behind playback
+        ready = self._request_file(filename, path, "DOWNLOAD", quality, etag)
+        if ready['etag'] != etag:
+            # The server is still making the rendition; asking got it started
+            ready['conn'].cancel(ready['request_id'])
+            ready['conn'].release(ready['request_id'])
+            return
+        self.prefetch_transfer = ready
+        try:
+            if self.prefetcher.cancelled:
+                self._cancel_prefetch()
+            self._receive_file(path, ready, progress=False)
+        finally:
+            self.prefetch_transfer = None
+        self.track_cache.commit(filename, etag)
+
+    def _cancel_prefetch(self):
+        ready = self.prefetch_transfer
+        if ready:
+            ready['cancelled'] = True
+            ready['conn'].cancel(ready['request_id'])
+
     def pause_music(self):
         if self.playing:
             if self.paused:
@@ -347,12 +988,18 @@ class MusicClient:
                 self.status_bar.config(text="Resumed playback")
             else:
                 # Pause and remember position
-                self.pause_position = pygame.mixer.music.get_pos()  # Get position in milliseconds
+                self.pause_position = int(self._position() * 1000)  # Position in milliseconds
                 pygame.mixer.music.pause()
                 self.paused = True
                 self.status_bar.config(text="Playback paused")
 
     def stop_playback(self):
+        if self.current_transfer:
+            # Free the connection for the next track; the .part file keeps
+            # what arrived so far for a later resume
+            self.current_transfer['cancelled'] = True
+            self.current_transfer['conn'].cancel(self.current_transfer['request_id'])
+            self.current_transfer = None
         if self.playing or self.paused:
             pygame.mixer.music.stop()
             # Release the music file
@@ -365,18 +1012,22 @@ class MusicClient:
             except:
                 pass
             
-            # Clean up temp file
-            if self.current_file and os.path.exists(self.current_file):
+            # Clean up temp file (cached tracks are kept for replay)
+            if self.current_file and not self._is_cached_file(self.current_file) and os.path.exists(self.current_file):
                 try:
                     os.remove(self.current_file)
                 except Exception as e:
-                    print(f"Cleanup warning: {str(e)}")
+                    log.warning("Cleanup warning: %s", e)
             
             self.playing = False
             self.paused = False
             self.pause_position = 0
+            self._update_position()
             self.status_bar.config(text="Playback stopped")
 
+    def _is_cached_file(self, path):
+        return self.track_cache is not None and self.track_cache.owns(path)
+
     def download_selected(self):
         if not self.connected:
             messagebox.showwarning("Not Connected", "Please connect to the server first.")
@@ -398,41 +1049,77 @@ class MusicClient:
         if not save_path:
             return
         
-        try:
-            # Request file from server
-            self._send_message(f"PLAY:{filename}")
-            response = self._receive_message()
+        self.status_bar.config(text=f"Downloading {filename}...")
+        self.tasks.run(
+            self._download, filename, save_path,
+            on_done=self._download_done,
+            on_error=lambda e: self._download_failed(save_path, e)
+        )
+
+    def _download(self, filename, save_path):
+        """Save a track to save_path, from the cache if possible (worker thread)"""
+        etag = self._stat(filename)['etag']
+        cached = None
+        if self.track_cache:
+            cached = self.track_cache.lookup(filename, etag)
+        
+        if cached:
+            shutil.copyfile(cached, save_path)
+        else:
+            # A partial download is only resumed if it is of the version
+            # it was started from; save_path.part.etag records which
+            part_file = self._partial_path(save_path)
+            etag_file = part_file + ".etag"
+            if os.path.exists(part_file):
+                try:
+                    with open(etag_file) as f:
+                        etag = f.read()
+                except OSError:
+                    os.remove(part_file)
             
-            if response != "READY":
-                raise ValueError(response)
+            # Request file from server
+            ready = self._request_file(filename, save_path, "DOWNLOAD", etag=etag)
+            with open(etag_file, 'w') as f:
+                f.write(ready['etag'])
             
             # Download the file
-            self._receive_file(save_path)
-            
-            messagebox.showinfo("Success", f"File saved to:\n{save_path}")
-            self.status_bar.config(text="Download complete")
-            
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to download: {str(e)}")
-            self.status_bar.config(text=f"Error: {str(e)}")
-            if os.path.exists(save_path):
-                os.remove(save_path)
+            self._receive_file(save_path, ready)
+            os.remove(etag_file)
+        return save_path
+
+    def _download_done(self, save_path):
+        messagebox.showinfo("Success", f"File saved to:\n{save_path}")
+        self.status_bar.config(text="Download complete")
+
+    def _download_failed(self, save_path, e):
+        messagebox.showerror("Error", f"Failed to download: {str(e)}")
+        self.status_bar.config(text=f"Error: {str(e)}")
+        if os.path.exists(save_path):
+            os.remove(save_path)
 
     def disconnect(self):
         if not self.connected:
             return
         
         self.stop_playback()
+        self.connected = False
+        if self.prefetcher:
+            self.prefetcher.stop()
+            self.prefetcher = None
         try:
-            self.client_socket.close()
+            self.pool.close()
         except:
             pass
-        self.client_socket = None
-        self.connected = False
+        self.pool = None
+        self.current_transfer = None
         self.status_label.config(text="Status: Disconnected", foreground="red")
         self.status_bar.config(text="Disconnected from server")
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
     root = Tk()
     client = MusicClient(root)
     root.mainloop()
\ No newline at end of file
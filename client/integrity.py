@@ -0,0 +1,60 @@
+import zlib
+
+
+class BlockVerifier:
+    """Checks a transfer against the server's per-block CRC32s as it arrives.
+
+    The PLAY reply lists `checksums` for the blocks of block_size bytes
+    that its range touches, starting with the block holding `offset`.
+    feed() takes the data in order and checks each block as soon as its
+    last byte is in; `bad` collects (start, length, crc) of every block
+    that did not match, to be fetched again. prefix, the bytes of the
+    first block before offset (already on disk when a download resumes
+    mid-block), lets that block be checked too; without it it is skipped,
+    as is a last block the range ends inside of. check_prefix() checks
+    the whole blocks before that one, for a resumed download.
+    """
+
+    def __init__(self, block_size, checksums, offset, total, prefix=b''):
+        self.block_size = block_size
+        self.checksums = checksums
+        self.first = offset // block_size
+        self.index = self.first
+        self.pos = offset
+        self.total = total
+        self.crc = zlib.crc32(prefix) if len(prefix) == offset - self.first * block_size else None
+        self.bad = []
+
+    def check_prefix(self, f, checksums):
+        """Check the blocks before the first one of the range, read from
+        file f, against checksums (one per block from the start of the
+        file); the ones that don't match go into bad"""
+        for index, expected in enumerate(checksums[:self.first]):
+            start = index * self.block_size
+            f.seek(start)
+            data = f.read(self.block_size)
+            if len(data) != self.block_size or zlib.crc32(data) != expected:
+                self.bad.append((start, self.block_size, expected))
+
+    def feed(self, data):
+        view = memoryview(data)
+        while view:
+            end = min((self.index + 1) * self.block_size, self.total)
+            n = min(len(view), end - self.pos)
+            if self.crc is not None:
+                self.crc = zlib.crc32(view[:n], self.crc)
+            self.pos += n
+            view = view[n:]
+            if self.pos == end:
+                self._check(end)
+                self.index += 1
+                self.crc = 0
+
+    def _check(self, end):
+        i = self.index - self.first
+        if self.crc is None or i >= len(self.checksums):
+            return
+        expected = self.checksums[i]
+        if self.crc != expected:
+            start = self.index * self.block_size
+            self.bad.append((start, end - start, expected))
@@ -0,0 +1,201 @@
+import queue
+import socket
+import threading
+import time
+
+from common import protocol
+
+
+class TransferCancelled(ConnectionError):
+    """The server ended a transfer early because it was cancelled"""
+
+
+class ServerBusy(ConnectionError):
+    """The server turned the connection away for load; retry_after is the
+    number of seconds it asks us to wait before trying again"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class MuxConnection:
+    """Multiplexed requests over one framed server connection.
+
+    A reader thread routes every incoming frame by request id to that
+    request's queue, so a LIST or STAT sent while a track is downloading is
+    answered as soon as its RESPONSE arrives instead of after the transfer.
+    Callers only ever wait on their own request id.
+    """
+
+    def __init__(self, sock, timeout=10.0):
+        self.sock = sock
+        self.timeout = timeout
+        self.reader = protocol.FrameReader(sock)
+        self.write_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.request_id = 0
+        self.channels = {}
+        self.error = None
+
+        self.welcome = self._read_welcome()
+        # The reader thread blocks until close(); waits time out per request
+        sock.settimeout(None)
+        self.thread = threading.Thread(target=self._read_loop, daemon=True)
+        self.thread.start()
+
+    def _read_welcome(self):
+        frame = self.reader.read_frame()
+        if frame is None:
+            raise ConnectionError("Connection closed by server")
+        msg_type, flags, request_id, payload = frame
+        if msg_type == protocol.ERROR:
+            error = protocol.decode_json(payload)
+            if error.get('status') == 'BUSY':
+                raise ServerBusy(error.get('message', 'Server busy'), error.get('retry_after'))
+            raise ConnectionError(error.get('message', 'Server error'))
+        if msg_type != protocol.HELLO:
+            raise protocol.ProtocolError(f"Unexpected frame type {msg_type}")
+        return str(payload, 'utf-8')
+
+    def _open_channel(self):
+        with self.lock:
+            if self.error:
+                raise self.error
+            self.request_id = (self.request_id + 1) & 0xFFFFFFFF or 1
+            request_id = self.request_id
+            self.channels[request_id] = queue.Queue()
+        return request_id
+
+    def _send(self, msg_type, request_id, payload=b''):
+        try:
+            with self.write_lock:
+                protocol.send_frame(self.sock, msg_type, request_id, payload)
+        except Exception as e:
+            self.release(request_id)
+            raise ConnectionError(f"Failed to send message: {str(e)}")
+
+    def request(self, message):
+        """Send a REQUEST and return its id for response() and data()"""
+        message = message.encode() if isinstance(message, str) else message
+        request_id = self._open_channel()
+        self._send(protocol.REQUEST, request_id, message)
+        return request_id
+
+    def ping(self):
+        """Round-trip a PING; returns the delay in seconds"""
+        request_id = self._open_channel()
+        started = time.perf_counter()
+        self._send(protocol.PING, request_id)
+        try:
+            msg_type, flags, payload = self._next(request_id)
+            if msg_type != protocol.PONG:
+                raise protocol.ProtocolError(f"Unexpected frame type {msg_type}")
+        finally:
+            self.release(request_id)
+        return time.perf_counter() - started
+
+    def busy(self):
+        """Number of requests still waiting for frames"""
+        with self.lock:
+            return len(self.channels)
+
+    def response(self, request_id, keep=False):
+        """JSON text of the RESPONSE to request_id.
+
+        The request is released afterwards unless keep is set, as it must be
+        when DATA frames follow.
+        """
+        try:
+            msg_type, flags, payload = self._next(request_id)
+            if msg_type == protocol.ERROR:
+                raise ConnectionError(protocol.decode_json(payload).get('message', 'Server error'))
+            if msg_type != protocol.RESPONSE:
+                raise protocol.ProtocolError(f"Unexpected frame type {msg_type}")
+            return str(payload, 'utf-8')
+        except:
+            keep = False
+            raise
+        finally:
+            if not keep:
+                self.release(request_id)
+
+    def data(self, request_id):
+        """Yield the DATA payloads of request_id up to the FLAG_END frame"""
+        try:
+            while True:
+                msg_type, flags, payload = self._next(request_id)
+                if msg_type != protocol.DATA:
+                    raise protocol.ProtocolError(f"Unexpected frame type {msg_type}")
+                if flags & protocol.FLAG_CANCELLED:
+                    raise TransferCancelled("Transfer cancelled")
+                yield payload
+                if flags & protocol.FLAG_END:
+                    return
+        finally:
+            self.release(request_id)
+
+    def cancel(self, request_id):
+        """Ask the server to cut a transfer short"""
+        try:
+            with self.write_lock:
+                protocol.send_frame(self.sock, protocol.CANCEL, request_id)
+        except OSError:
+            pass
+
+    def release(self, request_id):
+        with self.lock:
+            self.channels.pop(request_id, None)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self._fail(ConnectionError("Connection closed"))
+
+    def _next(self, request_id):
+        with self.lock:
+            channel = self.channels.get(request_id)
+            error = self.error
+        if channel is None:
+            raise error or ConnectionError(f"Unknown request {request_id}")
+        try:
+            msg_type, flags, payload = channel.get(timeout=self.timeout)
+        except queue.Empty:
+            raise ConnectionError("Timed out waiting for server")
+        if msg_type is None:
+            raise payload
+        return msg_type, flags, payload
+
+    def _read_loop(self):
+        try:
+            while True:
+                # Owned payloads: they outlive the next read in the queues
+                frame = self.reader.read_frame(owned=True)
+                if frame is None:
+                    raise ConnectionError("Connection closed by server")
+                msg_type, flags, request_id, payload = frame
+                if msg_type == protocol.ERROR and request_id == 0:
+                    raise ConnectionError(protocol.decode_json(payload).get('message', 'Server error'))
+                with self.lock:
+                    channel = self.channels.get(request_id)
+                # Frames for released requests (e.g. the tail of a cancelled
+                # transfer) are dropped
+                if channel is not None:
+                    channel.put((msg_type, flags, payload))
+        except Exception as e:
+            self._fail(e if isinstance(e, ConnectionError) else ConnectionError(str(e)))
+
+    def _fail(self, error):
+        """Wake every waiting request with error"""
+        with self.lock:
+            if self.error is None:
+                self.error = error
+            channels = list(self.channels.values())
+        for channel in channels:
+            channel.put((None, 0, self.error))
@@ -0,0 +1,122 @@
+import logging
+import threading
+
+log = logging.getLogger("musicclient.playqueue")
+
+
+class PlayQueue:
+    """Tracks to play after the current one, in order (thread-safe)"""
+
+    def __init__(self):
+        self.tracks = []
+        self.lock = threading.Lock()
+
+    def add(self, name):
+        with self.lock:
+            self.tracks.append(name)
+
+    def remove(self, index):
+        with self.lock:
+            if 0 <= index < len(self.tracks):
+                del self.tracks[index]
+
+    def clear(self):
+        with self.lock:
+            self.tracks = []
+
+    def pop_next(self):
+        """Take the track that plays next, or None"""
+        with self.lock:
+            return self.tracks.pop(0) if self.tracks else None
+
+    def upcoming(self, n):
+        with self.lock:
+            return self.tracks[:n]
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __iter__(self):
+        return iter(self.upcoming(len(self.tracks)))
+
+
+class Prefetcher:
+    """Downloads the next queued tracks in the background.
+
+    While a track plays, the first `depth` tracks of the queue are fetched
+    in order with fetch(name, etag), as long as their total size stays
+    within max_bytes, so the next track starts from local disk the moment
+    the current one ends. stat(name) returns the server's size and etag;
+    cancel() aborts the fetch in progress, and fetch should give up early
+    when it finds `cancelled` set. Call wake() whenever the queue or the
+    current track changes.
+    """
+
+    def __init__(self, queue, stat, fetch, cancel, depth=2, max_bytes=256 << 20):
+        self.queue = queue
+        self.stat = stat
+        self.fetch = fetch
+        self.cancel = cancel
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.active = None
+        self.cancelled = False
+        self.cond = threading.Condition()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def wake(self):
+        """Replan; a fetch for a track no longer upcoming is cancelled"""
+        with self.cond:
+            if self.active is not None and self.active not in self.queue.upcoming(self.depth):
+                self._cancel_active()
+        self._wake.set()
+
+    def release(self, name, timeout=5.0):
+        """Stop fetching name (it is about to be played directly) and wait
+        until its partial file is no longer being written"""
+        with self.cond:
+            if self.active == name:
+                self._cancel_active()
+                self.cond.wait_for(lambda: self.active != name, timeout)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        with self.cond:
+            if self.active is not None:
+                self._cancel_active()
+
+    def _cancel_active(self):
+        self.cancelled = True
+        self.cancel()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            budget = self.max_bytes
+            for name in self.queue.upcoming(self.depth):
+                # A queue change restarts the plan from its head
+                if self._stop.is_set() or self._wake.is_set():
+                    break
+                with self.cond:
+                    self.active = name
+                    self.cancelled = False
+                try:
+                    info = self.stat(name)
+                    if info['size'] > budget:
+                        break
+                    budget -= info['size']
+                    self.fetch(name, info['etag'])
+                except Exception as e:
+                    if not self.cancelled and not self._stop.is_set():
+                        log.warning("Prefetch of %s failed: %s", name, e)
+                finally:
+                    with self.cond:
+                        self.active = None
+                        self.cond.notify_all()
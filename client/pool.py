@@ -0,0 +1,183 @@
+import json
+import random
+import socket
+import threading
+
+from mux import MuxConnection, ServerBusy
+
+
+class _Slot:
+    """One pooled connection, reopened under its own lock when it dies"""
+
+    def __init__(self):
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def live(self):
+        return self.conn is not None and self.conn.error is None
+
+
+class ConnectionPool:
+    """A control connection plus a few transfer connections to one server.
+
+    LIST and STAT go over the control connection so browsing never waits
+    behind DATA frames; each PLAY/DOWNLOAD goes to the least busy transfer
+    connection. A connection that dies is reopened on next use, retrying
+    with exponential backoff, and a keepalive thread pings idle
+    connections so the server's idle timeout never closes them. A server
+    that answers BUSY is given at least the retry_after it asks for,
+    whether it turned away the connection or a transfer.
+
+    on_state(state, detail) is called with 'reconnecting' (detail is the
+    attempt number), 'connected' or 'lost' (detail is the error).
+    """
+
+    def __init__(self, host, port, transfers=2, timeout=10.0, keepalive=15.0,
+                 retries=6, backoff=0.5, max_backoff=30.0, on_state=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.on_state = on_state
+        self.control_slot = _Slot()
+        self.transfer_slots = [_Slot() for _ in range(max(1, transfers))]
+        self.select_lock = threading.Lock()
+        self.welcome = None
+        self.closed = False
+        self._stop = threading.Event()
+        self._keepalive_thread = None
+
+    def open(self):
+        """Connect the control connection; a single attempt, so a wrong
+        address fails fast instead of backing off"""
+        self._get(self.control_slot, 1)
+        if self.keepalive and self._keepalive_thread is None:
+            self._keepalive_thread = threading.Thread(target=self._keepalive_loop, daemon=True)
+            self._keepalive_thread.start()
+        return self.welcome
+
+    def close(self):
+        self.closed = True
+        self._stop.set()
+        for slot in [self.control_slot] + self.transfer_slots:
+            if slot.conn is not None:
+                slot.conn.close()
+
+    def control(self):
+        return self._get(self.control_slot, self.retries)
+
+    def transfer(self):
+        """Least busy transfer connection; idle live ones before new ones"""
+        with self.select_lock:
+            slot = min(self.transfer_slots,
+                       key=lambda s: (s.conn.busy(), False) if s.live() else (0, True))
+        return self._get(slot, self.retries)
+
+    def call(self, message):
+        """RESPONSE text of a control request (LIST, STAT, ...).
+
+        These are idempotent, so a request lost with its connection is
+        sent once more on a fresh one.
+        """
+        for attempt in range(2):
+            conn = self.control()
+            try:
+                return conn.response(conn.request(message))
+            except ConnectionError:
+                if conn.error is None or attempt:
+                    raise
+
+    def request_transfer(self, message):
+        """Send a PLAY/DOWNLOAD; (conn, request_id, RESPONSE text).
+
+        The request stays open on conn for its DATA frames. A BUSY reply
+        is retried up to `retries` times; the last one is returned.
+        """
+        for busy in range(self.retries + 1):
+            conn, request_id, response = self._request_transfer(message)
+            try:
+                reply = json.loads(response)
+            except ValueError:
+                reply = {}
+            if reply.get('status') != 'BUSY' or busy == self.retries:
+                return conn, request_id, response
+            conn.release(request_id)
+            if self._stop.wait(self._retry_delay(reply.get('retry_after'), self.backoff)):
+                raise ConnectionError("Connection closed")
+
+    def _request_transfer(self, message):
+        for attempt in range(2):
+            conn = self.transfer()
+            try:
+                request_id = conn.request(message)
+                return conn, request_id, conn.response(request_id, keep=True)
+            except ConnectionError:
+                if conn.error is None or attempt:
+                    raise
+
+    def _retry_delay(self, retry_after, delay):
+        # Full jitter, so clients dropped together don't return together;
+        # never sooner than a BUSY server asked
+        return (retry_after or 0) + random.uniform(0, delay)
+
+    def _get(self, slot, attempts):
+        with slot.lock:
+            if not slot.live():
+                if slot.conn is not None:
+                    slot.conn.close()
+                    slot.conn = None
+                slot.conn = self._connect(attempts)
+            return slot.conn
+
+    def _connect(self, attempts):
+        delay = self.backoff
+        error = None
+        for attempt in range(attempts):
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            if attempt:
+                self._notify('reconnecting', attempt)
+                retry_after = error.retry_after if isinstance(error, ServerBusy) else None
+                if self._stop.wait(self._retry_delay(retry_after, delay)):
+                    raise ConnectionError("Connection closed")
+                delay = min(delay * 2, self.max_backoff)
+            sock = None
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                conn = MuxConnection(sock, self.timeout)
+            except OSError as e:  # includes a refused HELLO
+                error = e
+                if sock is not None:
+                    sock.close()
+                continue
+            self.welcome = conn.welcome
+            if attempt:
+                self._notify('connected', None)
+            return conn
+        self._notify('lost', error)
+        raise ConnectionError(f"Failed to connect to {self.host}:{self.port}: {str(error)}")
+
+    def _keepalive_loop(self):
+        while not self._stop.wait(self.keepalive):
+            for slot in [self.control_slot] + self.transfer_slots:
+                conn = slot.conn
+                # Connections with requests in flight are not idle
+                if conn is None or conn.error is not None or conn.busy():
+                    continue
+                try:
+                    conn.ping()
+                except ConnectionError as e:
+                    conn.close()
+                    if slot is self.control_slot:
+                        self._notify('lost', e)
+
+    def _notify(self, state, detail):
+        if self.on_state:
+            try:
+                self.on_state(state, detail)
+            except Exception:
+                pass
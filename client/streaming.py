@@ -0,0 +1,245 @@
+import os
+import struct
+import threading
+import time
+
+# kbps by bitrate index for MPEG-1 and MPEG-2/2.5 Layer III
+MP3_BITRATES = {
+    3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0],
+}
+DEFAULT_BYTE_RATE = 128000 // 8
+
+
+def id3_tag_size(head):
+    """Length of a leading ID3v2 tag (header and footer included), else 0"""
+    if len(head) < 10 or head[:3] != b'ID3':
+        return 0
+    size = 0
+    for b in head[6:10]:
+        size = (size << 7) | (b & 0x7F)
+    return 10 + size + (10 if head[5] & 0x10 else 0)
+
+
+def audio_layout(head):
+    """Return (audio_start, bytes_per_second) for the start of an MP3/WAV.
+
+    Returns None while head is too short to tell, so callers can wait for
+    more data. The ID3v2 tag (album art and all) counts as part of the
+    prebuffer because the decoder has to get through it before any audio.
+    """
+    if len(head) < 12:
+        return None
+
+    if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+        if len(head) < 44:
+            return None
+        byte_rate = struct.unpack('<I', head[28:32])[0]
+        return 44, byte_rate or DEFAULT_BYTE_RATE
+
+    audio_start = id3_tag_size(head)
+    if len(head) < audio_start + 4:
+        return None
+
+    b1, b2 = head[audio_start + 1], head[audio_start + 2]
+    if head[audio_start] != 0xFF or b1 & 0xE0 != 0xE0:
+        return audio_start, DEFAULT_BYTE_RATE
+    version = 3 if b1 & 0x18 == 0x18 else 2
+    kbps = MP3_BITRATES[version][b2 >> 4]
+    return audio_start, (kbps * 1000 // 8) or DEFAULT_BYTE_RATE
+
+
+class StreamBuffer:
+    """Ring buffer between the socket thread and the audio decoder.
+
+    The receiving thread feed()s every chunk after writing it to the spool
+    file. The most recent `capacity` bytes are served from memory; anything
+    older (a seek backwards, or the already-downloaded prefix of a resumed
+    transfer) is read back from the spool file, so memory stays bounded
+    while the whole track remains seekable.
+    """
+
+    def __init__(self, spool_path, start_offset=0, capacity=1 << 20, on_event=None):
+        self.spool_path = spool_path
+        self.capacity = capacity
+        self.ring = bytearray(capacity)
+        self.ring_start = start_offset  # oldest absolute position held in ring
+        self.written = start_offset     # bytes available so far
+        self.total_size = None
+        self.layout = None
+        self.done = False
+        self.error = None
+        self.playing = False
+        self.on_event = on_event
+        self.rebuffer_bytes = 64 * 1024
+        self.underruns = 0
+        self.stall_time = 0.0
+        self.cond = threading.Condition()
+
+    # -- socket thread side -------------------------------------------------
+
+    def set_size(self, total_size):
+        with self.cond:
+            self.total_size = total_size
+            self.cond.notify_all()
+
+    def feed(self, data):
+        """Append a received chunk (already written to the spool file)"""
+        with self.cond:
+            if len(data) > self.capacity:
+                self.written += len(data) - self.capacity
+                data = data[-self.capacity:]
+            pos = self.written % self.capacity
+            first = min(len(data), self.capacity - pos)
+            self.ring[pos:pos + first] = data[:first]
+            self.ring[:len(data) - first] = data[first:]
+            self.written += len(data)
+            self.ring_start = max(self.ring_start, self.written - self.capacity)
+            self.cond.notify_all()
+
+    def finish(self, final_path=None):
+        """Mark the transfer complete, moving the spool to final_path.
+
+        The rename happens under the lock so a concurrent spool read never
+        sees a stale path. Returns the path the data now lives at (the spool
+        stays put if the platform refuses to rename an open file).
+        """
+        with self.cond:
+            if final_path:
+                try:
+                    os.replace(self.spool_path, final_path)
+                    self.spool_path = final_path
+                except OSError:
+                    pass
+            self.done = True
+            self.cond.notify_all()
+            return self.spool_path
+
+    def fail(self, error):
+        with self.cond:
+            self.error = error
+            self.done = True
+            self.cond.notify_all()
+
+    # -- player side --------------------------------------------------------
+
+    def wait_for_prebuffer(self, seconds=None, nbytes=None):
+        """Block until enough data has arrived to start playback.
+
+        nbytes wins if given; otherwise the target is derived from the
+        track's header (ID3 tag + `seconds` of audio at its bitrate).
+        Returns False if the transfer failed first.
+        """
+        with self.cond:
+            while True:
+                if self.error:
+                    return False
+                if self.done:
+                    return True
+                target = nbytes
+                if target is None:
+                    layout = self._audio_layout()
+                    if layout is not None:
+                        audio_start, byte_rate = layout
+                        target = audio_start + int((seconds or 0) * byte_rate)
+                if target is not None and self.written >= target:
+                    return True
+                self.cond.wait()
+
+    def _audio_layout(self):
+        if self.layout is None and self.written >= 12:
+            head = self._copy(0, min(self.written, 10))
+            peek = max(4096, id3_tag_size(head) + 4)
+            self.layout = audio_layout(self._copy(0, min(self.written, peek)))
+        return self.layout
+
+    def mark_playing(self):
+        """Start counting underruns from here on"""
+        with self.cond:
+            self.playing = True
+
+    def read_at(self, pos, size):
+        with self.cond:
+            end = pos + size
+            if self.total_size is not None:
+                end = min(end, self.total_size)
+            if pos >= end:
+                return b''
+            if pos >= self.written and not self.done:
+                self._wait_underrun(pos)
+            end = min(end, self.written)
+            if pos >= end:
+                return b''
+            return self._copy(pos, end - pos)
+
+    def _wait_underrun(self, pos):
+        """The decoder caught up with the network: rebuffer before resuming"""
+        started = time.perf_counter()
+        if self.playing:
+            self.underruns += 1
+            self._emit('underrun', {'position': pos, 'count': self.underruns})
+        target = pos + self.rebuffer_bytes
+        while self.written < target and not self.done:
+            self.cond.wait()
+        stalled = time.perf_counter() - started
+        if self.playing:
+            self.stall_time += stalled
+            self._emit('rebuffered', {'position': pos, 'stalled': stalled})
+
+    def _copy(self, pos, size):
+        """Read [pos, pos + size) from ring or spool; caller holds the lock"""
+        if size <= 0:
+            return b''
+        if pos < self.ring_start:
+            with open(self.spool_path, 'rb') as f:
+                f.seek(pos)
+                return f.read(size)
+        start = pos % self.capacity
+        first = min(size, self.capacity - start)
+        return bytes(self.ring[start:start + first]) + bytes(self.ring[:size - first])
+
+    def _emit(self, event, info):
+        if self.on_event:
+            try:
+                self.on_event(event, info)
+            except Exception:
+                pass
+
+
+class StreamReader:
+    """Seekable, blocking file object over a StreamBuffer for pygame.mixer"""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.position = 0
+        self.closed = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = (self.buffer.total_size or self.buffer.written) - self.position
+        data = self.buffer.read_at(self.position, size)
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            with self.buffer.cond:
+                while self.buffer.total_size is None and not self.buffer.done:
+                    self.buffer.cond.wait()
+                offset += self.buffer.total_size or self.buffer.written
+        self.position = max(0, offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,117 @@
+import json
+import logging
+import os
+import threading
+import time
+from common.cachekey import cache_key
+
+log = logging.getLogger("musicclient.track_cache")
+
+
+def _version(etag):
+    """The etag of the original a rendition's etag was derived from"""
+    return etag.split('.', 1)[0]
+
+
+class TrackCache:
+    """On-disk LRU cache of downloaded tracks.
+
+    Files are named after a hash of (track name, server etag), so a track
+    that changes on the server simply gets a new cache file and the old one
+    ages out. Renditions of a version ("<etag>.<quality>") are kept beside
+    it. index.json records size and last use for each file; when the
+    total exceeds max_bytes the least recently used files are deleted.
+    """
+
+    INDEX_FILE = "index.json"
+
+    def __init__(self, directory, max_bytes):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        self.entries = {}
+        try:
+            with open(os.path.join(self.directory, self.INDEX_FILE)) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+        # Forget entries whose files were deleted behind our back
+        self.entries = {key: entry for key, entry in self.entries.items()
+                        if os.path.exists(os.path.join(self.directory, key))}
+
+    def path_for(self, name, etag):
+        return os.path.join(self.directory, cache_key(name, etag) + os.path.splitext(name)[1])
+
+    def owns(self, path):
+        return os.path.dirname(os.path.abspath(path)) == self.directory
+
+    def lookup(self, name, etag):
+        """Path of the cached copy of this version of name, or None"""
+        path = self.path_for(name, etag)
+        key = os.path.basename(path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or not os.path.exists(path):
+                return None
+            entry['last_used'] = time.time()
+            self._save()
+        return path
+
+    def commit(self, name, etag):
+        """Register a completed download at path_for(name, etag)"""
+        path = self.path_for(name, etag)
+        if not os.path.exists(path):
+            return
+        key = os.path.basename(path)
+        with self.lock:
+            # Older versions of the same track are dead weight now; other
+            # renditions of this version are not
+            version = _version(etag)
+            for old_key, entry in list(self.entries.items()):
+                if entry['name'] == name and _version(entry['etag']) != version:
+                    self._delete(old_key)
+            self.entries[key] = {
+                'name': name,
+                'etag': etag,
+                'size': os.path.getsize(path),
+                'last_used': time.time()
+            }
+            self._evict(keep=key)
+            self._save()
+
+    def discard(self, path):
+        """Drop a cached file, e.g. one that failed to decode"""
+        with self.lock:
+            self._delete(os.path.basename(path))
+            self._save()
+
+    def _evict(self, keep):
+        total = sum(entry['size'] for entry in self.entries.values())
+        for key, entry in sorted(self.entries.items(), key=lambda item: item[1]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= entry['size']
+            self._delete(key)
+
+    def _delete(self, key):
+        self.entries.pop(key, None)
+        try:
+            os.remove(os.path.join(self.directory, key))
+        except OSError:
+            pass
+
+    def _save(self):
+        index_path = os.path.join(self.directory, self.INDEX_FILE)
+        tmp_path = index_path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            log.warning("Failed to save track cache index: %s", e)
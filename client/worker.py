@@ -0,0 +1,93 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("musicclient.worker")
+
+
+class UiDispatcher:
+    """Runs callbacks from background threads on the Tk thread.
+
+    Worker threads never touch widgets: post(fn, *args) only appends to a
+    queue that the Tk thread drains every `interval` ms via root.after.
+    progress(key, fn, *args) keeps just the latest update per key and
+    applies them at most max_rate times a second, so a transfer reporting
+    every chunk costs a handful of label updates instead of thousands;
+    done(key) drops an update still waiting once the final one is posted.
+    """
+
+    def __init__(self, root, interval=30, max_rate=10.0):
+        self.root = root
+        self.interval = interval
+        self.min_gap = 1.0 / max_rate
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latest = {}
+        self.last_progress = 0.0
+        self.root.after(self.interval, self._drain)
+
+    def post(self, fn, *args):
+        self.queue.put((fn, args))
+
+    def progress(self, key, fn, *args):
+        with self.lock:
+            self.latest[key] = (fn, args)
+
+    def done(self, key):
+        with self.lock:
+            self.latest.pop(key, None)
+
+    def _drain(self):
+        try:
+            now = time.monotonic()
+            if self.latest and now - self.last_progress >= self.min_gap:
+                with self.lock:
+                    latest, self.latest = self.latest, {}
+                self.last_progress = now
+                for fn, args in latest.values():
+                    self._run(fn, args)
+            while True:
+                try:
+                    fn, args = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                self._run(fn, args)
+        finally:
+            self.root.after(self.interval, self._drain)
+
+    def _run(self, fn, args):
+        try:
+            fn(*args)
+        except Exception:
+            log.exception("UI callback %r failed", fn)
+
+
+class BackgroundTasks:
+    """Thread pool for blocking client work (requests, downloads, decoding).
+
+    run(fn, *args, on_done=..., on_error=...) calls fn on a worker thread
+    and hands its result or exception to the callback on the Tk thread.
+    """
+
+    def __init__(self, ui, workers=4):
+        self.ui = ui
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="client-worker")
+
+    def run(self, fn, *args, on_done=None, on_error=None):
+        def task():
+            try:
+                result = fn(*args)
+            except Exception as e:
+                if on_error:
+                    self.ui.post(on_error, e)
+                else:
+                    log.exception("Background task %r failed", fn)
+                return
+            if on_done:
+                self.ui.post(on_done, result)
+        return self.executor.submit(task)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,6 @@
+import hashlib
+
+
+def cache_key(name, etag):
+    """Hex digest naming the files kept for one version of a track"""
+    return hashlib.sha1(f"{name}\0{etag}".encode()).hexdigest()
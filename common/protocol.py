@@ -0,0 +1,175 @@
+"""Binary framing shared by MusicServer and MusicClient.
+
+Every message is a 12-byte header followed by `length` payload bytes:
+
+    version  u8   PROTOCOL_VERSION
+    type     u8   HELLO, REQUEST, RESPONSE, DATA, ERROR, PING, PONG or CANCEL
+    flags    u16  FLAG_END marks the last DATA frame of a transfer,
+                  FLAG_CANCELLED one cut short by a CANCEL
+    id       u32  request id, echoed on every frame answering that request
+    length   u32  payload size in bytes
+
+REQUEST payloads are command strings ("LIST", "PLAY:<name>", ...), HELLO,
+RESPONSE and ERROR payloads are UTF-8 JSON objects and DATA payloads are raw
+file bytes. A PLAY is answered by a RESPONSE carrying the byte range
+followed by DATA frames for it; DOWNLOAD is the same for bulk transfers.
+
+Requests are multiplexed: a client may send new REQUESTs while earlier
+transfers are still streaming, and DATA frames of concurrent transfers are
+interleaved. Frames are matched to requests by id only. A CANCEL carrying
+the id of a running transfer ends it with an empty FLAG_END|FLAG_CANCELLED
+DATA frame.
+
+A server under load answers with {"status": "BUSY", "retry_after": <seconds>}
+instead: in an ERROR frame with id 0 when it turns a connection away, in the
+RESPONSE when no transfer slot came free in time for a PLAY or DOWNLOAD.
+
+TUNE:<channel> subscribes to a radio channel: after its RESPONSE, every
+track is announced by another RESPONSE on the same id (its name, size and
+the offset the DATA that follows starts at), and the stream runs until
+CANCEL. A listener that falls too far behind is dropped with an ERROR frame.
+"""
+import json
+import socket
+import struct
+
+PROTOCOL_VERSION = 2
+
+HEADER = struct.Struct('!BBHII')
+HEADER_SIZE = HEADER.size
+MAX_PAYLOAD = 64 << 20
+
+# Message types
+HELLO = 1
+REQUEST = 2
+RESPONSE = 3
+DATA = 4
+ERROR = 5
+PING = 6
+PONG = 7
+CANCEL = 8
+
+# Flags
+FLAG_END = 0x0001
+FLAG_CANCELLED = 0x0002
+
+_MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+
+
+class ProtocolError(ConnectionError):
+    pass
+
+
+def pack_header(msg_type, request_id, length, flags=0):
+    return HEADER.pack(PROTOCOL_VERSION, msg_type, flags, request_id, length)
+
+
+def unpack_header(data):
+    """Return (msg_type, flags, request_id, length) after validating a header"""
+    version, msg_type, flags, request_id, length = HEADER.unpack(data)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version {version} (expected {PROTOCOL_VERSION})")
+    if length > MAX_PAYLOAD:
+        raise ProtocolError(f"Frame of {length} bytes exceeds limit")
+    return msg_type, flags, request_id, length
+
+
+def encode_json(obj):
+    return json.dumps(obj).encode()
+
+
+def decode_json(payload):
+    return json.loads(str(payload, 'utf-8'))
+
+
+def recv_exact_into(sock, view, allow_eof=False):
+    """Fill view completely from sock.
+
+    Returns False on a clean EOF before the first byte when allow_eof is set;
+    any other short read raises ConnectionError.
+    """
+    received = 0
+    total = len(view)
+    while received < total:
+        n = sock.recv_into(view[received:])
+        if not n:
+            if allow_eof and received == 0:
+                return False
+            raise ConnectionError("Connection closed mid-frame")
+        received += n
+    return True
+
+
+def send_frame(sock, msg_type, request_id, payload=b'', flags=0):
+    """Send one frame, gathering header and payload without concatenating"""
+    header = pack_header(msg_type, request_id, len(payload), flags)
+    if not payload:
+        sock.sendall(header)
+    elif hasattr(sock, 'sendmsg'):
+        _sendmsg_all(sock, [header, memoryview(payload)])
+    else:
+        sock.sendall(header + bytes(payload))
+
+
+def send_header(sock, msg_type, request_id, length, flags=0):
+    """Send only a header; the caller streams `length` payload bytes next"""
+    sock.sendall(pack_header(msg_type, request_id, length, flags), _MSG_MORE)
+
+
+def _sendmsg_all(sock, buffers):
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers and sent:
+            buffers[0] = buffers[0][sent:]
+
+
+class FrameReader:
+    """Reads frames from a blocking socket into preallocated buffers.
+
+    The payload buffer grows to the largest frame seen and is reused, so
+    steady-state reads allocate nothing. A returned payload view is only
+    valid until the next read.
+    """
+
+    def __init__(self, sock, initial_size=64 * 1024):
+        self.sock = sock
+        self.header = bytearray(HEADER_SIZE)
+        self.header_view = memoryview(self.header)
+        self.buffer = bytearray(initial_size)
+        self.view = memoryview(self.buffer)
+
+    def read_header(self):
+        """(msg_type, flags, request_id, length), or None on a clean EOF"""
+        if not recv_exact_into(self.sock, self.header_view, allow_eof=True):
+            return None
+        return unpack_header(self.header)
+
+    def read_payload(self, length):
+        if length > len(self.buffer):
+            self.buffer = bytearray(length)
+            self.view = memoryview(self.buffer)
+        payload = self.view[:length]
+        recv_exact_into(self.sock, payload)
+        return payload
+
+    def read_owned_payload(self, length):
+        """Receive a payload into a fresh buffer the caller may keep"""
+        payload = bytearray(length)
+        recv_exact_into(self.sock, memoryview(payload))
+        return payload
+
+    def read_frame(self, owned=False):
+        """(msg_type, flags, request_id, payload), or None on a clean EOF.
+
+        The payload is a view into the shared buffer unless owned is set.
+        """
+        header = self.read_header()
+        if header is None:
+            return None
+        msg_type, flags, request_id, length = header
+        if owned:
+            return msg_type, flags, request_id, self.read_owned_payload(length)
+        return msg_type, flags, request_id, self.read_payload(length)
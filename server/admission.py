@@ -0,0 +1,99 @@
+import threading
+from collections import OrderedDict
+
+
+class TransferSlots:
+    """Caps the transfers in progress; the rest wait their turn in order.
+
+    acquire(wake) admits a transfer at once while fewer than `limit` are
+    running, else queues it, or refuses it when `queue_size` requests are
+    waiting already. A queued request gets the slot of the next transfer
+    to finish, and wake() is called (from that transfer's thread) when it
+    does; a waiter that gives up after `wait` seconds calls settle() to
+    leave the queue. Every admitted transfer must release() its slot.
+    limit 0 admits everything.
+    """
+
+    def __init__(self, limit, queue_size=0, wait=5.0):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.wait = wait
+        self.lock = threading.Lock()
+        self.active = 0
+        self.waiting = OrderedDict()  # wake callback -> None, oldest first
+        self.refused = 0
+
+    def acquire(self, wake):
+        """'admitted', 'queued' (wake() is called once admitted) or 'refused'"""
+        with self.lock:
+            if not self.limit or (self.active < self.limit and not self.waiting):
+                self.active += 1
+                return 'admitted'
+            if len(self.waiting) < self.queue_size:
+                self.waiting[wake] = None
+                return 'queued'
+            self.refused += 1
+            return 'refused'
+
+    def settle(self, wake):
+        """Stop waiting; True if the slot was granted in the meantime"""
+        with self.lock:
+            if wake in self.waiting:
+                del self.waiting[wake]
+                self.refused += 1
+                return False
+            return True
+
+    def admit(self):
+        """Block until admitted (True) or refused (False)"""
+        event = threading.Event()
+        wake = event.set
+        state = self.acquire(wake)
+        if state != 'queued':
+            return state == 'admitted'
+        event.wait(self.wait)
+        return self.settle(wake)
+
+    def release(self):
+        with self.lock:
+            if self.waiting:
+                # Hand the slot straight to the oldest waiter
+                wake, _ = self.waiting.popitem(last=False)
+            else:
+                self.active -= 1
+                return
+        wake()
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'limit': self.limit,
+            'queued': len(self.waiting),
+            'refused': self.refused
+        }
+
+
+class AddressLimits:
+    """Open connections per client address, capped at `limit` (0: no cap)"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, address):
+        """Count a new connection from address; False if it is over the cap"""
+        with self.lock:
+            count = self.counts.get(address, 0)
+            if self.limit and count >= self.limit:
+                return False
+            self.counts[address] = count + 1
+            return True
+
+    def remove(self, address):
+        with self.lock:
+            count = self.counts.get(address, 0) - 1
+            if count > 0:
+                self.counts[address] = count
+            else:
+                self.counts.pop(address, None)
@@ -0,0 +1,357 @@
+import asyncio
+import logging
+import os
+import signal
+import socket
+import time
+
+from common import protocol
+from mux import Transfer
+from broadcast import Channel
+
+log = logging.getLogger("musicserver.aio")
+
+
+class AsyncMusicServer:
+    """Serve the MusicServer protocol from a single asyncio event loop.
+
+    Each connection is a coroutine instead of a thread, so idle and streaming
+    clients cost a few KiB each rather than a thread stack. Each transfer is a
+    task of its own, so one connection can stream several tracks and answer
+    LIST while doing it. Request handling is shared with the threaded mode
+    through MusicServer.process_request.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        # Writer -> its transfers, by request id
+        self.connections = {}
+        self.lag_task = None
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        # The socket is already bound and listening (see MusicServer.serve)
+        listener = await asyncio.start_server(self.handle_client, sock=self.server.server_socket)
+        log.info("Server is listening for connections (asyncio)...")
+        if self.server.metrics:
+            # Keep a reference; the loop only holds tasks weakly
+            self.lag_task = asyncio.create_task(self._watch_loop_lag(self.server.metrics))
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+
+        def stop_on(deadline):
+            self.server.stop(deadline)
+            stop.set()
+
+        signals = [(signal.SIGTERM, True), (signal.SIGINT, True)]
+        if self.server.worker is not None and hasattr(signal, 'SIGHUP'):
+            # The supervisor is replacing this worker
+            signals.append((signal.SIGHUP, False))
+        for signum, deadline in signals:
+            # Pre-forked workers ignore SIGINT and leave it to the supervisor
+            if signal.getsignal(signum) is signal.SIG_IGN:
+                continue
+            try:
+                loop.add_signal_handler(signum, stop_on, deadline)
+            except (NotImplementedError, RuntimeError):
+                pass  # No loop signal handlers here; Ctrl-C still interrupts
+        if self.server.stop_requested.is_set():
+            stop.set()  # Asked before the handlers were in place
+        await stop.wait()
+
+        listener.close()
+        self.server.running = False
+        self.server.radio.stop()
+        await self._drain()
+
+    async def _drain(self):
+        """Hang up idle connections now and busy ones once their transfers
+        finish, aborting whatever is left at the server's drain deadline
+        (none for a retiring worker until a SIGTERM sets one)"""
+        while self.connections:
+            deadline = self.server.drain_until
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            for writer, transfers in list(self.connections.items()):
+                if not transfers:
+                    # The handler reads end-of-file and cleans up
+                    writer.transport.close()
+            await asyncio.sleep(0.1)
+        if self.connections:
+            log.warning("Closing %d connections that did not finish", len(self.connections))
+            # Stop the transfers first: aborting a transport under a
+            # loop.sendfile() in progress leaves it in an invalid state
+            tasks = [task for transfers in self.connections.values()
+                     for transfer, task in list(transfers.values())]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for writer in list(self.connections):
+                writer.transport.abort()
+            await asyncio.sleep(0)
+
+    async def handle_client(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        busy = self.server.admit_connection(addr)
+        if busy:
+            self._send_frame(writer, protocol.ERROR, 0, busy)
+            await self._close(writer)
+            return
+
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        metrics = self.server.metrics
+        if metrics:
+            metrics.connection_opened()
+        log.debug("New connection from %s", addr)
+        # Every frame is written under lock, so replies and the DATA frames
+        # of concurrent transfers interleave whole; the lock's FIFO wakeup
+        # gives the transfers their round-robin turns
+        lock = asyncio.Lock()
+        transfers = {}
+        self.connections[writer] = transfers
+        bucket = self.server.connection_bucket()
+        try:
+            try:
+                await self._write_frame(writer, lock, protocol.HELLO, 0, self.server._welcome_message())
+            except (ConnectionResetError, BrokenPipeError):
+                # Hung up before the greeting went out
+                log.debug("Client %s disconnected", addr)
+                return
+
+            # Runs on through a shutdown, which hangs up once transfers end
+            while True:
+                try:
+                    frame = await self._receive_frame(reader, self.server.idle_timeout)
+                    if frame is None:
+                        break
+                    msg_type, flags, request_id, payload = frame
+
+                    if msg_type == protocol.PING:
+                        await self._write_frame(writer, lock, protocol.PONG, request_id, payload)
+                        continue
+                    if msg_type == protocol.CANCEL:
+                        if request_id in transfers:
+                            transfers[request_id][0].cancel()
+                        continue
+                    if msg_type != protocol.REQUEST:
+                        raise protocol.ProtocolError(f"Unexpected frame type {msg_type}")
+
+                    request = payload.decode()
+                    log.debug("Received request from %s: %s", addr, request)
+
+                    started = time.perf_counter()
+                    message, transfer = self.server.process_request(request)
+                    if transfer and not isinstance(transfer, Channel) and not await self._admit():
+                        # Like the threaded server, this connection's
+                        # requests wait behind this one
+                        message, transfer = self.server.busy_reply('Too many transfers in progress'), None
+                    message = message.encode() if isinstance(message, str) else message
+                    try:
+                        await self._write_frame(writer, lock, protocol.RESPONSE, request_id, message)
+                    except BaseException:
+                        if transfer and not isinstance(transfer, Channel):
+                            self.server.transfer_slots.release()
+                        raise
+                    if metrics:
+                        metrics.request_done(request, time.perf_counter() - started)
+                    if isinstance(transfer, Channel):
+                        self.listen(writer, lock, transfers, request_id, transfer)
+                    elif transfer:
+                        await self.start_transfer(writer, lock, transfers, bucket, request_id, transfer)
+
+                except asyncio.TimeoutError:
+                    if transfers:
+                        # A client that is only receiving is not idle
+                        continue
+                    log.debug("Timeout with client %s", addr)
+                    break
+                except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+                    log.debug("Client %s disconnected", addr)
+                    break
+                except Exception as e:
+                    log.warning("Error handling client %s: %s", addr, e)
+                    if metrics:
+                        metrics.error()
+                    break
+        finally:
+            for transfer, task in list(transfers.values()):
+                task.cancel()
+            self.connections.pop(writer, None)
+            self.server.addresses.remove(addr[0])
+            await self._close(writer)
+            log.debug("Connection closed with %s", addr)
+
+    def _send_frame(self, writer, msg_type, request_id, payload=b'', flags=0):
+        """Queue one frame on the transport"""
+        writer.write(protocol.pack_header(msg_type, request_id, len(payload), flags))
+        if payload:
+            writer.write(payload)
+
+    async def _write_frame(self, writer, lock, msg_type, request_id, payload=b'', flags=0):
+        async with lock:
+            self._send_frame(writer, msg_type, request_id, payload, flags)
+            await writer.drain()
+
+    async def _receive_frame(self, reader, timeout=None):
+        """(msg_type, flags, request_id, payload), or None on a clean EOF.
+
+        Only the wait for a header times out, so a timeout never leaves half
+        a frame consumed.
+        """
+        try:
+            header = await asyncio.wait_for(reader.readexactly(protocol.HEADER_SIZE), timeout)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+            raise
+        msg_type, flags, request_id, length = protocol.unpack_header(header)
+        payload = await reader.readexactly(length) if length else b''
+        return msg_type, flags, request_id, payload
+
+    async def _admit(self):
+        """Wait for a transfer slot; False if none came up in time"""
+        slots = self.server.transfer_slots
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            # Transfers end on the loop, so this runs there too
+            if not granted.done():
+                granted.set_result(None)
+
+        state = slots.acquire(wake)
+        if state != 'queued':
+            return state == 'admitted'
+        try:
+            await asyncio.wait_for(granted, slots.wait)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if slots.settle(wake):
+                slots.release()
+            raise
+        return slots.settle(wake)
+
+    async def start_transfer(self, writer, lock, transfers, bucket, request_id, transfer):
+        loop = asyncio.get_running_loop()
+        slots = self.server.transfer_slots
+        # A cache miss may load the file; keep that read off the event loop
+        try:
+            transfer = await loop.run_in_executor(
+                self.server.io_pool.executor, Transfer, self.server, request_id, *transfer, bucket, slots)
+        except Exception:
+            slots.release()
+            raise
+        task = asyncio.create_task(self._stream(writer, lock, transfers, transfer))
+        transfers[request_id] = (transfer, task)
+
+    async def _stream(self, writer, lock, transfers, transfer):
+        try:
+            while await self._send_next(writer, lock, transfer):
+                # drain() returns without suspending while the socket keeps
+                # up; yield so other transfers and the request reader run
+                await asyncio.sleep(0)
+            if not transfer.cancelled:
+                log.debug("File %s sent successfully", os.path.basename(transfer.filepath))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log.warning("Error sending file: %s", e)
+            if self.server.metrics:
+                self.server.metrics.error()
+            # The frame stream may be cut mid-frame; the connection is unusable
+            writer.transport.abort()
+        finally:
+            transfer.close()
+            transfers.pop(transfer.request_id, None)
+
+    def listen(self, writer, lock, transfers, request_id, channel):
+        """Send channel's broadcast as the frames of request_id"""
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        # The channel pushes from its own thread
+        listener = channel.subscribe(request_id, lambda: loop.call_soon_threadsafe(ready.set))
+        task = asyncio.create_task(self._listen(writer, lock, transfers, listener, ready))
+        transfers[request_id] = (listener, task)
+
+    async def _listen(self, writer, lock, transfers, listener, ready):
+        try:
+            while True:
+                ready.clear()
+                if not listener.ready():
+                    await ready.wait()
+                    continue
+                frame = listener.next_frame()
+                msg_type, n, flags, payload = frame
+                await self._write_frame(writer, lock, msg_type, listener.request_id, payload, flags)
+                if n and self.server.metrics:
+                    self.server.metrics.sent(n)
+                if not listener.more(frame):
+                    break
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log.warning("Error sending channel %s: %s", listener.channel.name, e)
+            writer.transport.abort()
+        finally:
+            listener.close()
+            transfers.pop(listener.request_id, None)
+
+    async def _send_next(self, writer, lock, transfer):
+        """Send one DATA frame of transfer; False after the final one"""
+        request_id = transfer.request_id
+        pos, n, flags = transfer.next_frame()
+        delay = transfer.throttle(n)
+        if delay:
+            await asyncio.sleep(delay)
+        # Copied frames are read on the I/O pool, so the loop never waits
+        # on the disk
+        if transfer.pending is not None:
+            await asyncio.wrap_future(transfer.pending)
+
+        async with lock:
+            # drain() after every frame keeps at most one chunk buffered per
+            # connection, so memory stays flat with thousands of streams
+            if pos is None:
+                self._send_frame(writer, protocol.DATA, request_id, b'', flags)
+            elif transfer.view is not None:
+                self._send_frame(writer, protocol.DATA, request_id, transfer.view[pos:pos + n], flags)
+            elif transfer.use_sendfile:
+                writer.write(protocol.pack_header(protocol.DATA, request_id, n, flags))
+                if n:
+                    await writer.drain()
+                    loop = asyncio.get_running_loop()
+                    if await loop.sendfile(writer.transport, transfer.file,
+                                           transfer.location.start + pos, n) != n:
+                        raise ConnectionError("File shrank during transfer")
+                    # sendfile() pauses reading while it runs. Give the read
+                    # callback one loop turn before another transfer takes
+                    # the lock and pauses it again, or requests starve.
+                    await asyncio.sleep(0)
+            else:
+                self._send_frame(writer, protocol.DATA, request_id, transfer.data(pos, n), flags)
+            await writer.drain()
+        if n and self.server.metrics:
+            self.server.metrics.sent(n)
+        return not flags & protocol.FLAG_END
+
+    async def _watch_loop_lag(self, metrics, interval=1.0):
+        """Record how late the loop wakes a sleeping task (blocked callbacks)"""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + interval
+            await asyncio.sleep(interval)
+            metrics.loop_lag = max(0.0, loop.time() - expected)
+
+    async def _close(self, writer):
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except Exception:
+            pass
@@ -0,0 +1,314 @@
+import fnmatch
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from common import protocol
+from storage import open_location
+
+log = logging.getLogger("musicserver.broadcast")
+
+PLAYLIST_EXTENSIONS = ('.m3u', '.m3u8', '.txt')
+
+
+class Listener:
+    """One connection tuned in to a Channel.
+
+    The channel pushes its chunks here and the connection's sender takes
+    them off as frames, with the same interface as mux.Transfer:
+    next_frame() gives (msg_type, size, flags, payload), send() writes it.
+    A RESPONSE frame with the track's details starts every track, then
+    come its DATA frames. Chunks are the channel's own bytes objects, so
+    a queued chunk costs a reference, not a copy. A listener that lets
+    `limit` chunks pile up is dropped and gets an ERROR frame instead.
+
+    wake() is called whenever frames become ready after ready() said
+    there were none, from the channel's thread.
+    """
+
+    def __init__(self, server, channel, request_id, limit, wake):
+        self.server = server
+        self.channel = channel
+        self.request_id = request_id
+        self.filepath = channel.name  # For the sender's log messages
+        self.limit = limit
+        self.wake = wake
+        self.items = deque()
+        self.cancelled = False
+        self.ended = None  # Why the channel let go: 'stopped' or 'dropped'
+        self.signalled = False
+
+    def push(self, item):
+        """Queue one (msg_type, payload); False if the queue is full"""
+        if len(self.items) >= self.limit:
+            return False
+        self.items.append(item)
+        self._signal()
+        return True
+
+    def end(self, reason):
+        self.ended = reason
+        if reason == 'dropped':
+            self.items.clear()
+        self._signal()
+
+    def cancel(self):
+        self.cancelled = True
+        self._signal()
+
+    def _signal(self):
+        if not self.signalled:
+            self.signalled = True
+            self.wake()
+
+    def ready(self):
+        """Whether next_frame() has something to send"""
+        self.signalled = False
+        return bool(self.items) or self.cancelled or self.ended is not None
+
+    def next_frame(self):
+        if self.cancelled:
+            return protocol.DATA, 0, protocol.FLAG_END | protocol.FLAG_CANCELLED, b''
+        if self.items:
+            msg_type, payload = self.items.popleft()
+            return msg_type, len(payload) if msg_type == protocol.DATA else 0, 0, payload
+        if self.ended == 'dropped':
+            return protocol.ERROR, 0, 0, protocol.encode_json({
+                'status': 'ERROR',
+                'message': f'Dropped from channel {self.channel.name}: not keeping up'
+            })
+        return protocol.DATA, 0, protocol.FLAG_END, b''
+
+    def throttle(self, n):
+        # The channel already sends in real time
+        return 0.0
+
+    def send(self, sock, frame):
+        """Send a frame from next_frame(); False if it was the final one"""
+        msg_type, n, flags, payload = frame
+        protocol.send_frame(sock, msg_type, self.request_id, payload, flags)
+        if n and self.server.metrics:
+            self.server.metrics.sent(n)
+        return self.more(frame)
+
+    def more(self, frame):
+        """Whether frames follow this one"""
+        msg_type, n, flags, payload = frame
+        return msg_type != protocol.ERROR and not flags & protocol.FLAG_END
+
+    def close(self):
+        self.channel.unsubscribe(self)
+
+
+class Channel:
+    """A radio channel: a playlist read once and sent to every listener.
+
+    One thread per channel walks the playlist in order (looping) and reads
+    each track in chunks of FRAME_SECONDS of audio, paced to its playback
+    rate (size over duration from the library index, else default_rate)
+    and kept at most LEAD seconds ahead. Each chunk is pushed to every
+    listener's queue, so disk reads cost the same for one listener or a
+    thousand. The last LEAD seconds are also kept, so a new listener
+    starts with a buffer's worth. The thread starts with the first
+    listener and pauses while there are none.
+
+    The playlist is a .m3u/.txt file of track names, or a shell pattern
+    matched against the library; it is looked up again at every loop.
+
+    A channel lives in one process: under a pre-forked server each worker
+    has its own, at its own point of the playlist.
+    """
+
+    FRAME_SECONDS = 0.25
+    LEAD = 2.0
+    IDLE_POLL = 5.0  # Seconds between looks at an empty playlist
+
+    def __init__(self, server, name, playlist, buffer_seconds=10.0, default_rate=32 << 10):
+        self.server = server
+        self.name = name
+        self.playlist = playlist
+        # A listener gets up to LEAD seconds at once, then buffer_seconds of slack
+        self.limit = int((self.LEAD + buffer_seconds) / self.FRAME_SECONDS) + 2
+        self.default_rate = default_rate
+        self.lock = threading.Condition()
+        self.listeners = set()
+        self.track = None     # RESPONSE payload fields of the track playing
+        self.position = 0     # Bytes of it read so far
+        self.recent = deque(maxlen=int(self.LEAD / self.FRAME_SECONDS) + 1)  # (offset, chunk)
+        self.index = 0
+        self.clock = None     # When the current track started, in audio time
+        self.stopped = False
+        self.dropped = 0
+        self._thread = None
+
+    def subscribe(self, request_id, wake):
+        """Tune a connection in; it hears the channel from LEAD seconds back"""
+        listener = Listener(self.server, self, request_id, self.limit, wake)
+        with self.lock:
+            if not self.stopped:
+                if self.track is not None:
+                    offset = self.recent[0][0] if self.recent else self.position
+                    listener.items.append((protocol.RESPONSE, self._track_message(offset)))
+                    listener.items.extend((protocol.DATA, chunk) for pos, chunk in self.recent)
+                self.listeners.add(listener)
+                if self._thread is None or not self._thread.is_alive():
+                    # Started on demand: threads do not survive a pre-fork
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+                self.lock.notify_all()
+                return listener
+        # Outside the lock, like every wake()
+        listener.end('stopped')
+        return listener
+
+    def unsubscribe(self, listener):
+        with self.lock:
+            self.listeners.discard(listener)
+
+    def stop(self):
+        """End every listener's stream and stop reading"""
+        with self.lock:
+            self.stopped = True
+            listeners, self.listeners = self.listeners, set()
+            self.lock.notify_all()
+        for listener in listeners:
+            listener.end('stopped')
+
+    def _track_message(self, offset):
+        return json.dumps(dict(self.track, offset=offset)).encode()
+
+    def _tracks(self):
+        """Track names of the playlist, in order"""
+        library = self.server.library
+        if self.playlist.lower().endswith(PLAYLIST_EXTENSIONS):
+            try:
+                with open(self.playlist, encoding='utf-8') as f:
+                    lines = [line.strip() for line in f]
+            except OSError as e:
+                log.warning("Channel %s: %s", self.name, e)
+                return []
+            names = [os.path.basename(line) for line in lines if line and not line.startswith('#')]
+            return [name for name in names if library.get(name) is not None]
+        return [name for name in library.names() if fnmatch.fnmatchcase(name, self.playlist)]
+
+    def _run(self):
+        log.info("Channel %s on air", self.name)
+        while True:
+            with self.lock:
+                while not self.listeners and not self.stopped:
+                    self.lock.wait()
+                if self.stopped:
+                    break
+            tracks = self._tracks()
+            if not tracks:
+                with self.lock:
+                    self.lock.wait(self.IDLE_POLL)
+                continue
+            self.index %= len(tracks)
+            name = tracks[self.index]
+            self.index += 1
+            try:
+                self._play(name)
+            except OSError as e:
+                log.warning("Channel %s skipping %s: %s", self.name, name, e)
+        log.info("Channel %s off air", self.name)
+
+    def _play(self, name):
+        track = self.server.library.get(name)
+        location = self.server.storage.locate(name)
+        if track is None or location is None:
+            return
+        size = track['size']
+        duration = track.get('duration')
+        rate = size / duration if duration else self.default_rate
+        frame_size = max(4096, int(rate * self.FRAME_SECONDS))
+        with open_location(location) as f:
+            with self.lock:
+                self.track = {
+                    'status': 'OK',
+                    'channel': self.name,
+                    'name': name,
+                    'total': size,
+                    'etag': track['etag'],
+                    'duration': duration,
+                    'format': os.path.splitext(name)[1][1:].lower()
+                }
+                self.position = 0
+                self.recent.clear()
+                listeners = list(self.listeners)
+            self._fan_out(listeners, (protocol.RESPONSE, self._track_message(0)))
+
+            now = time.monotonic()
+            if self.clock is None or self.clock < now:
+                # Starting, or back from a pause or a slow read
+                self.clock = now
+            sent = 0
+            while True:
+                with self.lock:
+                    while not self.listeners and not self.stopped:
+                        paused = time.monotonic()
+                        self.lock.wait()
+                        self.clock += time.monotonic() - paused
+                    if self.stopped:
+                        return
+                delay = self.clock + sent / rate - self.LEAD - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                data = f.read(frame_size)
+                if not data:
+                    break
+                with self.lock:
+                    self.recent.append((self.position, data))
+                    self.position += len(data)
+                    listeners = list(self.listeners)
+                self._fan_out(listeners, (protocol.DATA, data))
+                sent += len(data)
+            self.clock += sent / rate
+
+    def _fan_out(self, listeners, item):
+        # Outside the lock: a push wakes the listener's connection, which
+        # may be waiting on this lock to unsubscribe
+        for listener in listeners:
+            try:
+                if listener.push(item):
+                    continue
+            except RuntimeError:
+                pass  # Its event loop is gone
+            self.unsubscribe(listener)
+            listener.end('dropped')
+            self.dropped += 1
+            log.info("Channel %s dropped a slow listener", self.name)
+
+    def stats(self):
+        return {
+            'listeners': len(self.listeners),
+            'dropped': self.dropped,
+            'track': self.track['name'] if self.track else None
+        }
+
+
+class Radio:
+    """The server's broadcast channels, by name"""
+
+    def __init__(self, server, channels=(), buffer_seconds=10.0):
+        self.channels = {name: Channel(server, name, playlist, buffer_seconds)
+                         for name, playlist in channels}
+
+    def get(self, name):
+        return self.channels.get(name)
+
+    def list_payload(self):
+        return json.dumps({
+            'status': 'OK',
+            'channels': [dict(channel.stats(), name=name) for name, channel in self.channels.items()]
+        })
+
+    def stats(self):
+        return {name: channel.stats() for name, channel in self.channels.items()}
+
+    def stop(self):
+        for channel in self.channels.values():
+            channel.stop()
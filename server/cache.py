@@ -0,0 +1,119 @@
+import mmap
+import threading
+from collections import OrderedDict
+
+CACHE_MODES = ('memory', 'mmap')
+
+
+class ContentCache:
+    """Byte-budgeted LRU cache of hot track contents.
+
+    Entries are whole tracks held either as bytes read into RAM or as
+    read-only mmaps, handed out as memoryviews so a request slices the
+    buffer instead of opening and reading the file. A track is only admitted
+    on its admit_after-th request, so one-off plays of cold tracks don't
+    flush the hot set. Entries are keyed by storage.Location and validated
+    against the (size, mtime) stamp from the library index, so no stat()
+    is needed on the hot path.
+    """
+
+    def __init__(self, max_bytes, mode='memory', admit_after=2, max_file_size=None):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode: {mode}")
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.admit_after = admit_after
+        self.max_file_size = max_file_size or max_bytes // 4
+        self.entries = OrderedDict()  # location -> (stamp, memoryview)
+        self.size = 0
+        self.frequency = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, location, stamp):
+        """memoryview of the track's contents if cached (loading it once
+        hot), else None"""
+        if not self.max_bytes or stamp is None:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(location)
+            if entry is not None:
+                if entry[0] == stamp:
+                    self.entries.move_to_end(location)
+                    self.hits += 1
+                    return entry[1]
+                self._remove(location)
+
+            self.misses += 1
+            count = self.frequency.get(location, 0) + 1
+            self.frequency[location] = count
+            if len(self.frequency) > 65536:
+                self._age_frequencies()
+            size = stamp[0]
+            if count < self.admit_after or not 0 < size <= self.max_file_size:
+                return None
+
+        # Read outside the lock so hits on other tracks are never blocked
+        view = self._load(location, size)
+        if view is None:
+            return None
+
+        with self.lock:
+            if location not in self.entries:
+                self.entries[location] = (stamp, view)
+                self.size += len(view)
+                while self.size > self.max_bytes and self.entries:
+                    oldest = next(iter(self.entries))
+                    self._remove(oldest)
+                    self.evictions += 1
+        return view
+
+    def _load(self, location, expected_size):
+        # A plain file is read whole, so a size change shows; a packed
+        # track is its range of the pack
+        start = location.start
+        length = expected_size if location.packed else 0
+        try:
+            with open(location.path, 'rb') as f:
+                if self.mode == 'mmap':
+                    # mmap offsets must be multiples of the allocation granularity
+                    skip = start % mmap.ALLOCATIONGRANULARITY
+                    data = mmap.mmap(f.fileno(), length and length + skip,
+                                     access=mmap.ACCESS_READ, offset=start - skip)
+                    view = memoryview(data)[skip:]
+                else:
+                    f.seek(start)
+                    view = memoryview(f.read(length or -1))
+        except (OSError, ValueError):
+            return None
+        # The file changed since the library last saw it; let it rescan first
+        if len(view) != expected_size:
+            return None
+        return view
+
+    def _remove(self, location):
+        # Dropped, not closed: an mmap still being sent stays valid until
+        # the last memoryview slice of it is released
+        stamp, view = self.entries.pop(location)
+        self.size -= len(view)
+
+    def _age_frequencies(self):
+        """Halve request counts so old popularity fades and the dict stays bounded"""
+        self.frequency = {path: count // 2 for path, count in self.frequency.items() if count > 1}
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'mode': self.mode,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0
+            }
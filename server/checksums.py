@@ -0,0 +1,146 @@
+import array
+import logging
+import os
+import queue
+import sys
+import threading
+import zlib
+from filestore import TrackFileStore
+from storage import Location, open_location
+
+# Bytes per checksummed block: the same as a sendfile DATA frame, and
+# small enough that re-sending a bad one is cheap
+BLOCK_SIZE = 256 << 10
+CHECKSUM_EXT = ".crc"
+
+log = logging.getLogger("musicserver.checksums")
+
+
+def block_checksums(source, block_size=BLOCK_SIZE):
+    """CRC32 of every block_size bytes of source (a path or a
+    storage.Location), as an array('I')"""
+    sums = array.array('I')
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    f = open_location(source) if isinstance(source, Location) else open(source, 'rb', buffering=0)
+    with f:
+        while True:
+            n = 0
+            while n < block_size:
+                got = f.readinto(view[n:])
+                if not got:
+                    break
+                n += got
+            if not n:
+                break
+            sums.append(zlib.crc32(view[:n]))
+            if n < block_size:
+                break
+    return sums
+
+
+def write_checksums(path, sums, block_size=BLOCK_SIZE):
+    """Store sums in path: the block size, then one CRC32 per block, all
+    as big-endian 32-bit words"""
+    data = array.array('I', [block_size])
+    data.extend(sums)
+    if sys.byteorder == 'little':
+        data.byteswap()
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data.tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_checksums(path):
+    """(block_size, sums) stored by write_checksums, or None"""
+    data = array.array('I')
+    try:
+        with open(path, 'rb') as f:
+            data.frombytes(f.read())
+    except (OSError, ValueError):
+        return None
+    if not data:
+        return None
+    if sys.byteorder == 'little':
+        data.byteswap()
+    return data[0], data[1:]
+
+
+def covering(checksums, size, offset, length):
+    """The reply fields describing the blocks of [offset, offset + length)
+    of a size-byte file, or {} if checksums do not fit the file.
+
+    A range running from offset to the end of the file is taken to be a
+    resumed download, whose reply also carries prefix_checksums: those of
+    the blocks before offset's, so the copy already on disk can be
+    checked too.
+    """
+    if checksums is None or not length:
+        return {}
+    block_size, sums = checksums
+    if len(sums) != -(-size // block_size):
+        return {}
+    first = offset // block_size
+    last = (offset + length - 1) // block_size
+    fields = {'block_size': block_size, 'checksums': sums[first:last + 1].tolist()}
+    if first and offset + length == size:
+        fields['prefix_checksums'] = sums[:first].tolist()
+    return fields
+
+
+class ChecksumStore(TrackFileStore):
+    """Per-block CRC32s of library tracks, computed once off the request path.
+
+    When the library index changes, new and changed tracks are hashed one
+    at a time by a background thread and stored as (block_size, sums).
+    get() only reads the stored files, never the track: a track not
+    hashed yet is sent without checksums.
+    """
+
+    EXT = CHECKSUM_EXT
+
+    def __init__(self, directory, block_size=BLOCK_SIZE):
+        super().__init__(directory)
+        self.block_size = block_size
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def _read(self, path):
+        return read_checksums(path)
+
+    def update(self, tracks, storage):
+        """Hash new and changed tracks in the background and forget the
+        checksums of tracks that are gone"""
+        self.prune(tracks)
+        for name, track in tracks.items():
+            job = (name, track['etag'])
+            if job in self.pending or self.get(*job) is not None:
+                continue
+            location = storage.locate(name)
+            if location is None:
+                continue  # Gone since the scan
+            with self.lock:
+                self.pending.add(job)
+                if self._thread is None or not self._thread.is_alive():
+                    # Threads do not survive fork; a worker starts its own
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+            self._queue.put((name, track['etag'], location))
+
+    def _run(self):
+        while not self.closed:
+            try:
+                name, etag, location = self._queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            try:
+                sums = block_checksums(location, self.block_size)
+                write_checksums(self._path(name, etag), sums, self.block_size)
+                with self.lock:
+                    self.entries[name] = (etag, (self.block_size, sums))
+            except OSError as e:
+                log.debug("No checksums for %s: %s", name, e)
+            finally:
+                with self.lock:
+                    self.pending.discard((name, etag))
@@ -0,0 +1,119 @@
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from common.cachekey import cache_key
+
+log = logging.getLogger("musicserver.filestore")
+
+
+class BatchRunner:
+    """Runs batches of jobs in a process pool off the request path.
+
+    One batch runs at a time, each in a pool of its own, so no worker
+    processes are left around between library changes. run() hands every
+    result to on_result(key, result, error) in the order the jobs were
+    given, then calls on_done(); close() drops whatever is still queued
+    and neither is called again.
+    """
+
+    def __init__(self, workers=None, initializer=None):
+        self.workers = workers
+        self.initializer = initializer
+        self.closed = False
+        self._pool = None
+        self._futures = ()
+        self._jobs = threading.Semaphore(1)
+
+    def run(self, jobs, on_result, on_done=None):
+        """Start a batch on a background thread; jobs maps a key to the
+        (function, *args) to call for it in a worker process"""
+        threading.Thread(target=self._run, args=(jobs, on_result, on_done), daemon=True).start()
+
+    def _run(self, jobs, on_result, on_done):
+        with self._jobs, ProcessPoolExecutor(self.workers, initializer=self.initializer) as pool:
+            if self.closed:
+                return
+            self._pool = pool
+            futures = {pool.submit(*job): key for key, job in jobs.items()}
+            self._futures = list(futures)
+            for future, key in futures.items():
+                if self.closed:
+                    return
+                try:
+                    result, error = future.result(), None
+                except Exception as e:
+                    result, error = None, e
+                on_result(key, result, error)
+            self._pool = None
+            self._futures = ()
+        if on_done:
+            on_done()
+
+    def close(self):
+        """Drop queued work so shutdown does not wait for a whole batch"""
+        self.closed = True
+        pool = self._pool
+        if pool is not None:
+            for future in self._futures:
+                future.cancel()
+            pool.shutdown(wait=False)
+
+
+class TrackFileStore:
+    """Base of the stores keeping one small file per track name and etag
+    in directory, so a restart or a pre-forked worker reuses them.
+
+    Subclasses set EXT and _read(path), which returns the loaded file or
+    None. get() keeps what it loads in entries; prune() forgets files and
+    entries of versions that are no longer in the library.
+    """
+
+    EXT = ''
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.lock = threading.Lock()
+        self.entries = {}   # name -> (etag, loaded file)
+        self.pending = set()
+        self.closed = False
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def _path(self, name, etag):
+        return os.path.join(self.directory, cache_key(name, etag) + self.EXT)
+
+    def _read(self, path):
+        raise NotImplementedError
+
+    def get(self, name, etag):
+        """What is stored for this version of name, or None"""
+        entry = self.entries.get(name)
+        if entry is not None and entry[0] == etag:
+            return entry[1]
+        value = self._read(self._path(name, etag))
+        if value is not None:
+            with self.lock:
+                self.entries[name] = (etag, value)
+        return value
+
+    def prune(self, tracks):
+        """Forget what is stored for versions not in tracks"""
+        keep = {os.path.basename(self._path(name, track['etag'])) for name, track in tracks.items()}
+        with self.lock:
+            self.entries = {name: entry for name, entry in self.entries.items()
+                            if name in tracks and tracks[name]['etag'] == entry[0]}
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith(self.EXT) and entry.name not in keep:
+                        os.remove(entry.path)
+        except OSError as e:
+            log.warning("%s: %s", self.directory, e)
+
+    def stats(self):
+        return {'tracks': len(self.entries), 'pending': len(self.pending)}
+
+    def close(self):
+        """Stop work in progress; whatever is left is picked up on the next start"""
+        self.closed = True
@@ -0,0 +1,156 @@
+import json
+import logging
+import threading
+import time
+import wave
+from search import SearchIndex
+from storage import open_location
+
+try:
+    import mutagen
+except ImportError:  # Tags and MP3 durations are optional
+    mutagen = None
+
+log = logging.getLogger("musicserver.library")
+
+
+def make_etag(size, mtime):
+    """Cheap version tag for a file: changes whenever size or mtime does"""
+    return f"{size:x}-{int(mtime * 1e6):x}"
+
+
+class LibraryIndex:
+    """In-memory index of the tracks in a storage.Storage.
+
+    Built once at startup and kept current by polling: the roots' stamps
+    (directory mtimes, pack index mtimes) are checked every poll_interval
+    seconds (they change on add/remove/rename) and every
+    full_rescan_every polls all track stats are compared as well to catch
+    files rewritten in place. Only new or changed tracks are re-parsed.
+
+    The LIST reply is serialized once per change and reused until the next
+    one, so a LIST costs no syscalls and no JSON encoding. The SearchIndex
+    for paged/filtered listings is rebuilt on the same thread, off the
+    request path.
+    """
+
+    def __init__(self, storage, poll_interval=5.0, full_rescan_every=12):
+        self.storage = storage
+        self.poll_interval = poll_interval
+        self.full_rescan_every = full_rescan_every
+        self.tracks = {}
+        self.search = SearchIndex(self.tracks)
+        self.version = 0
+        self.lock = threading.Lock()
+        self._stamp = None
+        self._list_payload = None
+        self._watcher = None
+        self._stop = threading.Event()
+        # Called with the new tracks dict after every change
+        self.on_change = None
+        self.rescan(force=True)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def get(self, name):
+        return self.tracks.get(name)
+
+    def names(self):
+        return list(self.tracks)
+
+    def page(self, **params):
+        """One page of a filtered, sorted listing; see SearchIndex.page"""
+        return self.search.page(**params)
+
+    def list_payload(self):
+        """Pre-serialized LIST reply for the current library version"""
+        with self.lock:
+            if self._list_payload is None:
+                self._list_payload = json.dumps({
+                    'status': 'OK',
+                    'files': list(self.tracks)
+                }).encode()
+            return self._list_payload
+
+    def rescan(self, force=False):
+        """Bring the index in line with the storage; True if anything changed"""
+        stamp = self.storage.stamp()
+        if not force and stamp == self._stamp:
+            return False
+
+        old = self.tracks
+        current = {}
+        changed = False
+        for name, (size, mtime) in self.storage.scan().items():
+            track = old.get(name)
+            if track is None or track['size'] != size or track['mtime'] != mtime:
+                track = self._describe(name, size, mtime)
+                changed = True
+            current[name] = track
+        changed = changed or current.keys() != old.keys()
+        self._stamp = stamp
+
+        if changed:
+            current = dict(sorted(current.items()))
+            search = SearchIndex(current)
+            with self.lock:
+                self.tracks = current
+                self.search = search
+                self.version += 1
+                self._list_payload = None
+            if self.on_change:
+                self.on_change(current)
+        return changed
+
+    def _describe(self, name, size, mtime):
+        track = {
+            'name': name,
+            'size': size,
+            'mtime': mtime,
+            'etag': make_etag(size, mtime),
+            'duration': None,
+            'title': None,
+            'artist': None,
+            'album': None
+        }
+        try:
+            location = self.storage.locate(name)
+            if name.endswith('.wav'):
+                with open_location(location) as f, wave.open(f, 'rb') as w:
+                    track['duration'] = w.getnframes() / float(w.getframerate())
+            if mutagen is not None:
+                with open_location(location) as f:
+                    audio = mutagen.File(f, easy=True)
+                if audio is not None:
+                    if audio.info and getattr(audio.info, 'length', None):
+                        track['duration'] = audio.info.length
+                    tags = audio.tags or {}
+                    for key in ('title', 'artist', 'album'):
+                        values = tags.get(key)
+                        if values:
+                            track[key] = str(values[0])
+        except Exception:
+            pass  # Unreadable metadata is not fatal; the file still streams
+        return track
+
+    def start_watching(self):
+        if self.poll_interval and self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, daemon=True)
+            self._watcher.start()
+
+    def stop_watching(self):
+        self._stop.set()
+
+    def _watch(self):
+        polls = 0
+        while not self._stop.wait(self.poll_interval):
+            polls += 1
+            full = self.full_rescan_every and polls % self.full_rescan_every == 0
+            try:
+                started = time.perf_counter()
+                if self.rescan(force=full):
+                    log.info("Library updated: %d tracks (rescan took %.3fs)",
+                             len(self.tracks), time.perf_counter() - started)
+            except Exception as e:
+                log.warning("Library rescan failed: %s", e)
@@ -0,0 +1,210 @@
+import io
+import json
+import logging
+import os
+import threading
+from common.cachekey import cache_key
+from filestore import BatchRunner
+from storage import open_location
+
+try:
+    import mutagen
+except ImportError:  # Without it there are no tags and no album art
+    mutagen = None
+
+try:
+    from PIL import Image
+except ImportError:  # Without it album art is served at its original size
+    Image = None
+
+THUMBNAIL_SIZES = (64, 150, 300)
+ORIGINAL = 0  # Rendition size of an embedded image stored as-is
+
+log = logging.getLogger("musicserver.metadata")
+
+
+def _image_type(data):
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpg', 'image/jpeg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png', 'image/png'
+    return 'bin', 'application/octet-stream'
+
+
+def _embedded_picture(tags):
+    """Bytes of the front cover (or first picture) in ID3 tags, or None"""
+    if tags is None or not hasattr(tags, 'getall'):
+        return None
+    pictures = tags.getall('APIC')
+    if not pictures:
+        return None
+    front = [p for p in pictures if getattr(p, 'type', None) == 3]
+    return (front or pictures)[0].data
+
+
+def extract(location, prefix, sizes):
+    """Tags and album-art renditions of the track at a storage.Location
+    (runs in a worker process).
+
+    Thumbnails are written next to `prefix` as <prefix>_<size>.<ext>; the
+    returned dict maps each size to its file name and MIME type.
+    """
+    meta = {'genre': None, 'year': None, 'track': None, 'art': {}}
+    if mutagen is None:
+        return meta
+
+    with open_location(location) as f:
+        audio = mutagen.File(f)
+        if audio is None:
+            return meta
+        f.seek(0)
+        easy = mutagen.File(f, easy=True)
+    tags = (easy.tags if easy is not None else None) or {}
+    for key, tag in (('genre', 'genre'), ('year', 'date'), ('track', 'tracknumber')):
+        values = tags.get(tag)
+        if values:
+            meta[key] = str(values[0])
+
+    picture = _embedded_picture(audio.tags)
+    if picture is None:
+        return meta
+
+    if Image is None:
+        ext, mime = _image_type(picture)
+        filename = f"{prefix}_{ORIGINAL}.{ext}"
+        with open(filename, 'wb') as f:
+            f.write(picture)
+        meta['art'][ORIGINAL] = (os.path.basename(filename), mime)
+        return meta
+
+    image = Image.open(io.BytesIO(picture)).convert('RGB')
+    for size in sizes:
+        thumb = image.copy()
+        thumb.thumbnail((size, size), Image.LANCZOS)
+        filename = f"{prefix}_{size}.jpg"
+        thumb.save(filename, 'JPEG', quality=85)
+        meta['art'][size] = (os.path.basename(filename), 'image/jpeg')
+    return meta
+
+
+class MetadataStore:
+    """Extended tags and pre-resized album art for the library.
+
+    Tracks are processed in a process pool when the library index changes
+    (image decoding and resizing is CPU-bound), never on the request path.
+    Results are kept in meta_dir with an index keyed by track name and
+    etag, so a restart only processes new or changed files. Tracks not
+    processed yet simply have no extended metadata for the moment.
+    on_update, if set, is called after each batch is stored.
+    """
+
+    INDEX_FILE = "metadata.json"
+
+    def __init__(self, meta_dir, sizes=THUMBNAIL_SIZES, workers=None):
+        self.meta_dir = os.path.abspath(meta_dir)
+        self.sizes = tuple(sorted(sizes))
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.pending = set()
+        self.on_update = None
+        self._runner = BatchRunner(workers)
+
+        if not os.path.exists(self.meta_dir):
+            os.makedirs(self.meta_dir)
+        self.reload()
+
+    def reload(self):
+        """Read the index as last saved (also by another process, for a
+        pre-forked worker)"""
+        try:
+            with open(os.path.join(self.meta_dir, self.INDEX_FILE)) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            self.entries = entries
+
+    def get(self, name, etag):
+        """Stored metadata of this version of name, or None"""
+        entry = self.entries.get(name)
+        if entry is None or entry['etag'] != etag:
+            return None
+        return entry
+
+    def art_path(self, name, etag, size):
+        """(path, mime, size) of the smallest rendition of at least `size`
+        pixels (else the largest one), or None if the track has no art"""
+        entry = self.get(name, etag)
+        if not entry or not entry['art']:
+            return None
+        renditions = sorted((int(s), v) for s, v in entry['art'].items())
+        chosen = next(((s, v) for s, v in renditions if s >= size), renditions[-1])
+        art_size, (filename, mime) = chosen
+        return os.path.join(self.meta_dir, filename), mime, art_size
+
+    def update(self, tracks, storage):
+        """Process new and changed tracks of storage in the background"""
+        todo = {name: track['etag'] for name, track in tracks.items()
+                if self.get(name, track['etag']) is None and name not in self.pending}
+        stale = [name for name in self.entries if name not in tracks]
+        if stale:
+            with self.lock:
+                for name in stale:
+                    self._remove_files(self.entries.pop(name))
+                self._save()
+        if todo and mutagen is None:
+            # Nothing to extract; don't start worker processes for it
+            with self.lock:
+                for name, etag in todo.items():
+                    self.entries[name] = {'genre': None, 'year': None, 'track': None,
+                                          'art': {}, 'etag': etag}
+                self._save()
+        elif todo:
+            with self.lock:
+                self.pending.update(todo)
+            self._runner.run({name: (extract, storage.locate(name),
+                                     os.path.join(self.meta_dir, cache_key(name, etag)), self.sizes)
+                              for name, etag in todo.items()},
+                             lambda name, meta, error: self._store(name, todo[name], meta, error),
+                             lambda: self._batch_done(len(todo)))
+
+    def _store(self, name, etag, meta, error):
+        if error is not None:
+            log.debug("No metadata for %s: %s", name, error)
+            meta = {'genre': None, 'year': None, 'track': None, 'art': {}}
+        meta['etag'] = etag
+        with self.lock:
+            old = self.entries.get(name)
+            if old is not None and old['etag'] != etag:
+                self._remove_files(old)
+            self.entries[name] = meta
+            self.pending.discard(name)
+
+    def _batch_done(self, count):
+        with self.lock:
+            self._save()
+        log.info("Metadata updated for %d tracks", count)
+        if self.on_update:
+            self.on_update()
+
+    def close(self):
+        """Drop queued work so shutdown does not wait for a whole batch"""
+        self._runner.close()
+
+    def _remove_files(self, entry):
+        for filename, mime in entry['art'].values():
+            try:
+                os.remove(os.path.join(self.meta_dir, filename))
+            except OSError:
+                pass
+
+    def _save(self):
+        index_path = os.path.join(self.meta_dir, self.INDEX_FILE)
+        tmp_path = index_path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, index_path)
+        except OSError as e:
+            log.warning("Failed to save metadata index: %s", e)
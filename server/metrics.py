@@ -0,0 +1,227 @@
+import bisect
+import os
+import threading
+import time
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram (Prometheus style, not thread-safe)"""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile, or None.
+
+        '+Inf' (a string, so STATS stays strict JSON) past the last bound.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return '+Inf'
+
+    def snapshot(self):
+        cumulative = []
+        seen = 0
+        for bound, n in zip(self.bounds + ('+Inf',), self.counts):
+            seen += n
+            cumulative.append([bound, seen])
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': cumulative
+        }
+
+
+class RateWindow:
+    """Events per second over the last `seconds` whole seconds"""
+
+    def __init__(self, seconds=10):
+        self.seconds = seconds
+        self.slots = [0] * seconds
+        self.stamps = [0] * seconds
+
+    def add(self, now):
+        second = int(now)
+        i = second % self.seconds
+        if self.stamps[i] != second:
+            self.stamps[i] = second
+            self.slots[i] = 0
+        self.slots[i] += 1
+
+    def rate(self, now):
+        second = int(now)
+        return sum(n for n, stamp in zip(self.slots, self.stamps)
+                   if 0 <= second - stamp < self.seconds) / self.seconds
+
+
+class Metrics:
+    """Request, traffic and connection counters behind STATS.
+
+    Updates take one short lock. When metrics are disabled the server keeps
+    None instead of a Metrics object and skips every call, so the hot path
+    pays a single attribute test.
+    """
+
+    def __init__(self, commands):
+        self.commands = set(commands)
+        self.started = time.time()
+        self.lock = threading.Lock()
+        names = sorted(self.commands) + ['UNKNOWN']
+        self.requests = {name: 0 for name in names}
+        self.latency = {name: Histogram() for name in names}
+        self.rates = {name: RateWindow() for name in names}
+        self.bytes_sent = 0
+        self.connections_total = 0
+        self.errors = 0
+        self.loop_lag = None
+
+    def command_name(self, request):
+        # PLAY@low:<name> counts as PLAY
+        name = request.split(":", 1)[0].partition("@")[0]
+        return name if name in self.commands else 'UNKNOWN'
+
+    def request_done(self, request, seconds):
+        """Record one handled request and how long its reply took"""
+        name = self.command_name(request)
+        now = time.time()
+        with self.lock:
+            self.requests[name] += 1
+            self.latency[name].observe(seconds)
+            self.rates[name].add(now)
+
+    def sent(self, n):
+        with self.lock:
+            self.bytes_sent += n
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections_total += 1
+
+    def error(self):
+        with self.lock:
+            self.errors += 1
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            uptime = now - self.started
+            busy = sum(h.sum for h in self.latency.values())
+            return {
+                'uptime': uptime,
+                'connections_total': self.connections_total,
+                'bytes_sent': self.bytes_sent,
+                'errors': self.errors,
+                'threads': threading.active_count(),
+                # Share of wall time spent producing replies, summed over
+                # handlers; above 1.0 means several were busy at once
+                'busy_ratio': busy / uptime if uptime else 0.0,
+                'loop_lag': self.loop_lag,
+                'requests': {
+                    name: {
+                        'count': count,
+                        'rate': self.rates[name].rate(now),
+                        'latency': self.latency[name].snapshot()
+                    }
+                    for name, count in self.requests.items()
+                }
+            }
+
+
+def _format_value(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+def prometheus_text(stats, prefix='musicserver', labels=()):
+    """Render a MusicServer.stats() dict in the Prometheus text format.
+
+    labels, e.g. (('worker', '2'),), are added to every sample so the dumps
+    of several worker processes can be scraped side by side.
+    """
+    lines = []
+    base = tuple(labels)
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {prefix}_{name} {help_text}")
+        lines.append(f"# TYPE {prefix}_{name} {kind}")
+        for sample_labels, value in samples:
+            if value is None:
+                continue
+            lines.append(f"{prefix}_{name}{_labels(base + sample_labels)} {_format_value(value)}")
+
+    metric('connections_active', 'gauge', "Open client connections",
+           [((), stats['connections'])])
+    metric('tracks', 'gauge', "Tracks in the library index", [((), stats['tracks'])])
+
+    cache = stats['cache']
+    metric('cache_hits_total', 'counter', "Content cache hits", [((), cache['hits'])])
+    metric('cache_misses_total', 'counter', "Content cache misses", [((), cache['misses'])])
+    metric('cache_bytes', 'gauge', "Bytes held by the content cache", [((), cache['bytes'])])
+    metric('cache_hit_ratio', 'gauge', "Content cache hit ratio", [((), cache['hit_ratio'])])
+
+    m = stats.get('metrics')
+    if m:
+        metric('uptime_seconds', 'gauge', "Seconds since start", [((), m['uptime'])])
+        metric('connections_total', 'counter', "Connections accepted",
+               [((), m['connections_total'])])
+        metric('bytes_sent_total', 'counter', "File bytes sent in DATA frames",
+               [((), m['bytes_sent'])])
+        metric('errors_total', 'counter', "Connections ended by an error", [((), m['errors'])])
+        metric('threads', 'gauge', "Live Python threads", [((), m['threads'])])
+        metric('busy_ratio', 'gauge', "Reply time per second of uptime", [((), m['busy_ratio'])])
+        metric('loop_lag_seconds', 'gauge', "Event loop scheduling delay (async mode)",
+               [((), m['loop_lag'])])
+
+        requests = m['requests']
+        metric('requests_total', 'counter', "Requests handled",
+               [((('command', name),), r['count']) for name, r in requests.items()])
+        metric('requests_per_second', 'gauge', "Request rate over the last 10 seconds",
+               [((('command', name),), r['rate']) for name, r in requests.items()])
+
+        family = f"{prefix}_request_duration_seconds"
+        lines.append(f"# HELP {family} Time to produce and send a reply")
+        lines.append(f"# TYPE {family} histogram")
+        for name, r in requests.items():
+            latency = r['latency']
+            for bound, count in latency['buckets']:
+                bucket = base + (('command', name), ('le', _format_value(bound)))
+                lines.append(f"{family}_bucket{_labels(bucket)} {count}")
+            command = base + (('command', name),)
+            lines.append(f"{family}_sum{_labels(command)} {_format_value(latency['sum'])}")
+            lines.append(f"{family}_count{_labels(command)} {latency['count']}")
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(path, stats, labels=()):
+    """Atomically replace path with the Prometheus dump of stats"""
+    # Per process: a retiring worker may still write while its successor does
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(prometheus_text(stats, labels=labels))
+    os.replace(tmp_path, path)
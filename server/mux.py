@@ -0,0 +1,305 @@
+import logging
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+from common import protocol
+from throttle import STREAM
+
+log = logging.getLogger("musicserver.mux")
+
+
+class Transfer:
+    """One in-flight PLAY transfer, sent a DATA frame at a time.
+
+    `location` is the storage.Location of the file served; offset and
+    length are counted within it. The source is the cached memoryview
+    when the track is hot, otherwise the open file: sent with sendfile
+    for regular files, the kernel reading ahead at the server IOPool's
+    request, else copied a block at a time by the IOPool (after
+    next_frame(), `pending` is the read still to wait for, if any).
+    `kind` is the bandwidth class (STREAM or BULK) and `bucket` an
+    optional per-connection TokenBucket; throttle() turns those and the
+    server's BandwidthScheduler into a delay to wait before the next
+    frame.
+    `slots`, if given, is the TransferSlots this transfer was admitted by;
+    close() gives the slot back. wake() is called when a frame that was
+    not ready() becomes ready.
+    """
+
+    def __init__(self, server, request_id, location, offset, length, kind=STREAM, bucket=None,
+                 slots=None, wake=None):
+        self.server = server
+        self.request_id = request_id
+        self.location = location
+        self.filepath = location.name or location.path  # For log messages
+        self.kind = kind
+        self.bucket = bucket
+        self.pacer = server.scheduler.open(kind) if server.scheduler else None
+        self.file = None
+        self.reader = None
+        self.prefetch = None
+        self.pending = None
+        self.use_sendfile = False
+        self.cancelled = False
+        self.slots = None
+        self.view = server.cached_view(location)
+        if self.view is None:
+            self.file = open(location.path, 'rb')
+            self.use_sendfile = server._can_sendfile(self.file)
+            if self.use_sendfile:
+                self.frames = server._frames(offset, offset + length, server.sendfile_frame_size)
+                self.prefetch = server.io_pool.prefetch(self.file, location.start, offset, offset + length)
+            else:
+                self.reader = server.io_pool.reader(
+                    self.file, location.start, server._frames(offset, offset + length),
+                    offset, offset + length, wake)
+        else:
+            self.frames = server._frames(offset, offset + length)
+        # Only once nothing above can fail, so an error leaves the caller
+        # holding the slot
+        self.slots = slots
+
+    def ready(self):
+        """Whether a frame can be sent now: cached data always can, file
+        data once it is read"""
+        return self.cancelled or self.reader is None or self.reader.ready()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def next_frame(self):
+        """(position, size, flags) of the next DATA frame to send"""
+        self.pending = None
+        if self.cancelled:
+            return None, 0, protocol.FLAG_END | protocol.FLAG_CANCELLED
+        if self.reader is not None:
+            frame = self.reader.next()
+            self.pending = self.reader.pending
+            return frame
+        frame = next(self.frames)
+        if self.prefetch:
+            self.prefetch.advance(frame[0])
+        return frame
+
+    def data(self, pos, n):
+        """The n bytes at pos of the frame from next_frame() when it is
+        copied from the file, waiting for its read if need be"""
+        return self.reader.data(pos, n) if n else b''
+
+    def throttle(self, n):
+        """Seconds to wait before sending n more bytes"""
+        delay = self.bucket.reserve(n) if self.bucket else 0.0
+        if self.pacer:
+            delay = max(delay, self.pacer.reserve(n))
+        return delay
+
+    def send_next(self, sock):
+        """Send one DATA frame; False once the final frame has gone out"""
+        return self.send(sock, self.next_frame())
+
+    def send(self, sock, frame):
+        """Send a frame from next_frame(); False if it was the final one"""
+        pos, n, flags = frame
+        if pos is None:
+            protocol.send_frame(sock, protocol.DATA, self.request_id, b'', flags)
+        elif self.view is not None:
+            protocol.send_frame(sock, protocol.DATA, self.request_id, self.view[pos:pos + n], flags)
+        elif self.use_sendfile:
+            protocol.send_header(sock, protocol.DATA, self.request_id, n, flags)
+            if n and sock.sendfile(self.file, self.location.start + pos, n) != n:
+                raise ConnectionError("File shrank during transfer")
+        else:
+            protocol.send_frame(sock, protocol.DATA, self.request_id, self.data(pos, n), flags)
+        if n and self.server.metrics:
+            self.server.metrics.sent(n)
+        return not flags & protocol.FLAG_END
+
+    def close(self):
+        if self.reader:
+            # Reads still running keep the file open until they finish
+            self.reader.close(self.file.close)
+            self.reader = None
+            self.file = None
+        elif self.file:
+            self.file.close()
+            self.file = None
+        if self.pacer:
+            self.pacer.close()
+        slots, self.slots = self.slots, None
+        if slots:
+            slots.release()
+
+
+class Connection:
+    """Write side of a multiplexed client connection (threaded mode).
+
+    Replies are written by the reader thread as soon as a request is
+    handled; transfers are queued here and a sender thread writes one DATA
+    frame per transfer in turn. Every frame goes out under write_lock, so a
+    LIST or STAT answer waits for at most one frame of a large download,
+    and concurrent downloads share the connection round-robin, each
+    taking its turn once its next frame has been read. A frame the
+    bandwidth limits hold back is parked until it is due while the others
+    keep going, so a paced DOWNLOAD never stalls a PLAY beside it. Radio
+    listeners (broadcast.Listener) take turns the same way, when their
+    channel has queued something for them.
+    """
+
+    def __init__(self, server, sock, addr):
+        self.server = server
+        self.sock = sock
+        self.addr = addr
+        self.bucket = server.connection_bucket()
+        self.write_lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.transfers = OrderedDict()
+        self.held = {}  # request_id -> (frame, monotonic time it is due)
+        self.closed = False
+        self.sender = None
+
+    def send_frame(self, msg_type, request_id, payload=b'', flags=0):
+        with self.write_lock:
+            protocol.send_frame(self.sock, msg_type, request_id, payload, flags)
+
+    def start_transfer(self, request_id, location, offset, length, kind=STREAM, slots=None):
+        try:
+            transfer = Transfer(self.server, request_id, location, offset, length, kind,
+                                self.bucket, slots, self.wake)
+        except Exception:
+            if slots:
+                slots.release()
+            raise
+        self._add(transfer)
+
+    def listen(self, request_id, channel):
+        """Send channel's broadcast as the frames of request_id"""
+        self._add(channel.subscribe(request_id, self.wake))
+
+    def _add(self, transfer):
+        with self.cond:
+            closed = self.closed
+            if not closed:
+                self.transfers[transfer.request_id] = transfer
+                if self.sender is None:
+                    self.sender = threading.Thread(target=self._send_loop, daemon=True)
+                    self.sender.start()
+                self.cond.notify()
+        if closed:
+            transfer.close()
+
+    def wake(self):
+        with self.cond:
+            self.cond.notify()
+
+    def cancel(self, request_id):
+        """Stop a transfer early; the client gets a FLAG_CANCELLED end frame"""
+        with self.cond:
+            transfer = self.transfers.get(request_id)
+            if transfer:
+                transfer.cancel()
+                # A frame still waiting for bandwidth is dropped, not sent
+                self.held.pop(request_id, None)
+                self.cond.notify()
+
+    def busy(self):
+        return bool(self.transfers)
+
+    def close(self):
+        """Stop sending. Transfers are only cancelled here: the sender
+        thread may be in the middle of a frame of one, so it closes their
+        files itself once it has stopped (see join())."""
+        with self.cond:
+            self.closed = True
+            for transfer in self.transfers.values():
+                transfer.cancel()
+            self.held.clear()
+            self.cond.notify_all()
+
+    def join(self):
+        """Wait for the sender thread to stop after close()"""
+        if self.sender is not None:
+            self.sender.join()
+
+    def _pick(self):
+        """(request_id, held frame or None, None) of the first transfer that
+        can send now, else (None, None, seconds until a held frame is due)"""
+        now = time.monotonic()
+        wait = None
+        for request_id, transfer in self.transfers.items():
+            held = self.held.get(request_id)
+            if held is None:
+                if transfer.ready():
+                    return request_id, None, None
+                continue
+            frame, due = held
+            if due > now:
+                wait = due - now if wait is None else min(wait, due - now)
+            elif transfer.pending is None or transfer.pending.done():
+                del self.held[request_id]
+                return request_id, frame, None
+        return None, None, wait
+
+    def _send_loop(self):
+        try:
+            self._send_frames()
+        finally:
+            with self.cond:
+                self.closed = True
+                transfers = list(self.transfers.values())
+                self.transfers.clear()
+                self.held.clear()
+            for transfer in transfers:
+                transfer.close()
+
+    def _send_frames(self):
+        while True:
+            with self.cond:
+                while not self.closed:
+                    # Round-robin: take the first that is ready, put it back at the tail
+                    request_id, frame, wait = self._pick()
+                    if request_id is not None:
+                        break
+                    self.cond.wait(wait)
+                if self.closed:
+                    return
+                transfer = self.transfers[request_id]
+                self.transfers.move_to_end(request_id)
+
+            try:
+                if frame is None:
+                    frame = transfer.next_frame()
+                    delay = transfer.throttle(frame[1])
+                    if delay:
+                        # Park it and serve the others meanwhile
+                        with self.cond:
+                            if self.closed:
+                                return
+                            if not transfer.cancelled:
+                                self.held[request_id] = (frame, time.monotonic() + delay)
+                                continue
+                with self.write_lock:
+                    more = transfer.send(self.sock, frame)
+            except Exception as e:
+                if self.closed:
+                    # Hung up under it by the reader thread
+                    log.debug("Stopped sending to %s: %s", self.addr, e)
+                    return
+                log.warning("Error sending file to %s: %s", self.addr, e)
+                if self.server.metrics:
+                    self.server.metrics.error()
+                self.close()
+                try:
+                    # Wake the reader thread so the connection is torn down
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return
+
+            if not more:
+                transfer.close()
+                with self.cond:
+                    self.transfers.pop(request_id, None)
+                if not transfer.cancelled:
+                    log.debug("File %s sent successfully", transfer.filepath)
@@ -0,0 +1,290 @@
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+from contextlib import nullcontext
+
+log = logging.getLogger("musicserver.prefork")
+
+
+class Supervisor:
+    """Run a MusicServer as a group of pre-forked worker processes.
+
+    Each worker is a full server (either mode) with its own GIL, cache and
+    connections. The library index and metadata are built once, here,
+    before forking, so every worker starts from the same read-only copy
+    shared copy-on-write instead of scanning the directory itself. Only
+    the supervisor watches the directory and processes new tracks; when
+    the library or its metadata changes it tells the workers through a
+    pipe each, and they re-read the index and metadata in place, so no
+    connection or radio channel is interrupted.
+
+    SIGHUP replaces every worker with a freshly forked one. The old
+    generation stops accepting and exits once its transfers have
+    finished, however long they take, unless a SIGTERM comes first.
+
+    With SO_REUSEPORT each worker binds the port and the kernel spreads
+    new connections over them; without it they all accept from one socket
+    inherited from the supervisor. Workers that die are restarted, after a
+    growing delay if they keep dying right after starting.
+
+    Radio channels are not shared: every worker runs its own copy of each
+    one, started by its own first listener. Listeners on different
+    workers hear different points of the playlist, each such worker reads
+    it from disk, and a new generation of workers (SIGHUP) starts every
+    channel over from the top.
+    """
+
+    MIN_UPTIME = 10.0  # Exiting sooner than this counts as a crash loop
+    MAX_DELAY = 60.0
+
+    def __init__(self, server, workers, reuseport=True):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError("Pre-fork mode needs os.fork, which this platform lacks")
+        self.server = server
+        self.count = workers
+        self.reuseport = reuseport and hasattr(socket, 'SO_REUSEPORT')
+        self.listener = None
+        self.workers = {}    # pid -> (slot, start time)
+        self.pipes = {}      # pid -> write end of its refresh pipe
+        self.retiring = set()
+        self.restarts = {}   # slot -> time to restart it
+        self.delays = {}     # slot -> last restart delay
+        self.stopping = False
+        self.reload = False
+        self.refresh = False
+
+    def run(self):
+        server = self.server
+        try:
+            if self.reuseport:
+                # Fail here, not in every worker, if the port is taken
+                server.make_listener(reuseport=True).close()
+            else:
+                self.listener = server.make_listener()
+        except OSError as e:
+            log.error("Failed to start server: %s", e)
+            return
+
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self._request_reload)
+
+        def library_changed(tracks):
+            server.on_library_change(tracks)
+            self.refresh = True
+
+        server.library.on_change = library_changed
+        if server.metadata:
+            server.metadata.on_update = self._request_refresh
+        server.on_library_change(server.library.tracks)
+        server.library.start_watching()
+
+        log.info("Starting %d workers (%s)", self.count,
+                 "SO_REUSEPORT" if self.reuseport else "shared listening socket")
+        if server.radio.channels:
+            log.warning("Radio channels run separately in each worker: listeners on "
+                        "different workers are not in sync and each worker reads the "
+                        "playlists itself; use one worker for a single shared stream")
+        for slot in range(self.count):
+            self._spawn(slot)
+        try:
+            while not self.stopping:
+                if self.reload:
+                    self.reload = False
+                    self.refresh = False
+                    self._roll()
+                if self.refresh:
+                    self.refresh = False
+                    self._notify()
+                self._reap()
+                now = time.monotonic()
+                for slot, when in list(self.restarts.items()):
+                    if now >= when:
+                        del self.restarts[slot]
+                        self._spawn(slot)
+                time.sleep(0.2)
+        finally:
+            self._shutdown()
+
+    def _request_stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def _request_reload(self, signum=None, frame=None):
+        self.reload = True
+
+    def _request_refresh(self):
+        self.refresh = True
+
+    def _spawn(self, slot):
+        # Fork while holding the locks our background threads take, so no
+        # worker inherits one locked by a thread that does not exist there
+        transcoder, checksums = self.server.transcoder, self.server.checksums
+        waveforms = self.server.waveforms
+        read, write = os.pipe()
+        with self.server.library.lock, (transcoder.lock if transcoder else nullcontext()), \
+                (checksums.lock if checksums else nullcontext()), \
+                (waveforms.lock if waveforms else nullcontext()):
+            pid = os.fork()
+        if pid == 0:
+            # Only the supervisor may hold write ends, or a worker would
+            # never see the end of file when the supervisor dies
+            for fd in [write, *self.pipes.values()]:
+                os.close(fd)
+            self._run_worker(slot, read)
+        os.close(read)
+        os.set_blocking(write, False)
+        self.workers[pid] = (slot, time.monotonic())
+        self.pipes[pid] = write
+        log.info("Started worker %d (pid %d)", slot, pid)
+
+    def _run_worker(self, slot, pipe):
+        code = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self.server.worker = slot
+            if hasattr(signal, 'SIGHUP'):
+                # Retire; serve() installs the same, this covers the start
+                signal.signal(signal.SIGHUP, lambda signum, frame: self.server.stop(deadline=False))
+            # The supervisor processes changes; this worker only follows them
+            self.server.library.on_change = None
+            if self.server.metadata:
+                self.server.metadata.on_update = None
+            threading.Thread(target=self._follow, args=(pipe,), daemon=True).start()
+            if self.server.serve(self.listener, reuseport=self.reuseport):
+                code = 0
+        except BaseException:
+            log.exception("Worker %d failed", slot)
+        finally:
+            # os._exit skips the exit hooks that would stop this worker's
+            # transcoding processes, so stop them here
+            for child in multiprocessing.active_children():
+                child.terminate()
+            # Never return into the supervisor's loop
+            os._exit(code)
+
+    def _follow(self, pipe):
+        """In a worker: bring the library and metadata up to date whenever
+        the supervisor writes to the pipe, until it closes it"""
+        server = self.server
+        while True:
+            try:
+                # Notifications that piled up are handled as one
+                if not os.read(pipe, 4096):
+                    break
+            except OSError:
+                break
+            try:
+                server.library.rescan(force=True)
+                if server.metadata:
+                    server.metadata.reload()
+            except Exception as e:
+                log.warning("Worker %d failed to refresh: %s", server.worker, e)
+        os.close(pipe)
+
+    def _notify(self):
+        """Tell every live worker to refresh"""
+        for pid, fd in self.pipes.items():
+            try:
+                os.write(fd, b'.')
+            except BlockingIOError:
+                pass  # It has not read the last ones yet; one will do
+            except OSError:
+                pass  # Exited; _reap deals with it
+
+    def _close_pipe(self, pid):
+        fd = self.pipes.pop(pid, None)
+        if fd is not None:
+            os.close(fd)
+
+    def _roll(self):
+        """Replace every worker with one forked from the current index"""
+        log.info("Reloading: replacing workers")
+        old = list(self.workers)
+        for pid in old:
+            self._close_pipe(pid)
+        self.workers = {}
+        self.restarts.clear()
+        for slot in range(self.count):
+            self._spawn(slot)
+        for pid in old:
+            # Stop accepting and exit once every transfer has finished
+            self._signal(pid, signal.SIGHUP)
+            self.retiring.add(pid)
+
+    def _reap(self):
+        # Only our own pids: waitpid(-1) would also reap the metadata
+        # extraction processes behind their pool's back
+        for pid in list(self.retiring):
+            if self._exited(pid) is not None:
+                self.retiring.discard(pid)
+        for pid in list(self.workers):
+            status = self._exited(pid)
+            if status is None:
+                continue
+            slot, started = self.workers.pop(pid)
+            self._close_pipe(pid)
+            if time.monotonic() - started < self.MIN_UPTIME:
+                delay = min(max(1.0, self.delays.get(slot, 0) * 2), self.MAX_DELAY)
+            else:
+                delay = 0
+            self.delays[slot] = delay
+            self.restarts[slot] = time.monotonic() + delay
+            log.warning("Worker %d (pid %d) exited with status %d, restarting in %.0fs",
+                        slot, pid, status, delay)
+
+    def _exited(self, pid):
+        """Exit code of pid once it has ended (negative: killed by that
+        signal), else None"""
+        try:
+            done, status = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            return 0
+        if done == 0:
+            return None
+        if os.WIFSIGNALED(status):
+            return -os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+
+    def _signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _shutdown(self):
+        log.info("Shutting down server...")
+        pids = list(self.workers) + list(self.retiring)
+        for pid in pids:
+            self._signal(pid, signal.SIGTERM)
+        # Workers drain for shutdown_timeout; allow a little more for exiting
+        deadline = time.monotonic() + self.server.shutdown_timeout + 5
+        while pids and time.monotonic() < deadline:
+            pids = [pid for pid in pids if self._exited(pid) is None]
+            time.sleep(0.1)
+        for pid in pids:
+            log.warning("Killing worker pid %d", pid)
+            self._signal(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        for pid in list(self.pipes):
+            self._close_pipe(pid)
+        self.workers = {}
+        self.retiring = set()
+
+        self.server.library.stop_watching()
+        if self.server.metadata:
+            self.server.metadata.close()
+        if self.server.checksums:
+            self.server.checksums.close()
+        if self.server.waveforms:
+            self.server.waveforms.close()
+        if self.server.transcoder:
+            self.server.transcoder.close()
+        if self.listener:
+            self.listener.close()
+        log.info("Server stopped successfully")
@@ -0,0 +1,237 @@
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Copied frames are read in blocks of at least this much, so small frames
+# don't each pay for a read
+READ_BLOCK = 256 << 10
+# Lets a read that would wait on the disk return at once instead
+_NOWAIT = getattr(os, 'RWF_NOWAIT', None)
+
+
+def _read_into(fd, buf, pos, got=0):
+    """Fill buf from pos, its first `got` bytes already read"""
+    view = memoryview(buf)
+    while got < len(buf):
+        if hasattr(os, 'preadv'):
+            n = os.preadv(fd, [view[got:]], pos + got)
+        else:
+            data = os.pread(fd, len(buf) - got, pos + got)
+            n = len(data)
+            view[got:got + n] = data
+        if not n:
+            raise ConnectionError("File shrank during transfer")
+        got += n
+    return buf
+
+
+class IOPool:
+    """Disk reads for transfers, kept off the senders.
+
+    Every transfer has the kernel read `depth` blocks ahead of the frame
+    being sent into the page cache (prefetch()), which copies nothing.
+    Transfers sent with sendfile() need nothing more. Copied ones read
+    each block when it is due: at once by the caller if it is in the
+    page cache (preadv with RWF_NOWAIT), else on these threads, so a
+    slow disk holds up that transfer only, never the event loop or a
+    connection's other transfers and replies. With no threads every read
+    happens inline.
+    """
+
+    def __init__(self, threads=8, depth=2, block_size=READ_BLOCK):
+        self.threads = threads
+        self.depth = max(1, depth)
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='io') if threads else None
+        self.reads = 0
+        self.bytes = 0
+        self.cached = 0  # Reads served from the page cache without the threads
+        self.waits = 0   # Blocks not read yet when their turn came
+        self.advised = 0
+        self.nowait = _NOWAIT is not None and self.executor is not None
+
+    def read(self, fd, pos, n):
+        """The n bytes at pos of fd, read now, or a Future of them"""
+        self.reads += 1
+        self.bytes += n
+        buf = bytearray(n)
+        got = 0
+        if self.nowait:
+            try:
+                got = os.preadv(fd, [buf], pos, _NOWAIT)
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.nowait = False  # Not supported by this kernel or file system
+            if got == n:
+                self.cached += 1
+                return buf
+        if self.executor is None:
+            return _read_into(fd, buf, pos, got)
+        return self.executor.submit(_read_into, fd, buf, pos, got)
+
+    def reader(self, file, base, frames, offset, end, wake=None):
+        """A ReadAhead of the frames of [offset, end), positions in file
+        counted from base"""
+        return ReadAhead(self, file, base, frames, offset, end, wake)
+
+    def prefetch(self, file, base, offset, end):
+        """A Prefetch of [offset, end), positions counted from base"""
+        return Prefetch(self, file, base, offset, end, self.depth * self.block_size)
+
+    def stats(self):
+        return {
+            'threads': self.threads,
+            'depth': self.depth,
+            'reads': self.reads,
+            'bytes': self.bytes,
+            'cached': self.cached,
+            'waits': self.waits,
+            'advised': self.advised
+        }
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+
+class Prefetch:
+    """Page-cache hints for a range sent with sendfile().
+
+    advance(pos) keeps `window` bytes past pos requested from the disk
+    with posix_fadvise(WILLNEED), which returns at once and copies
+    nothing. Hints go out half a window at a time.
+    """
+
+    def __init__(self, pool, file, base, offset, end, window):
+        self.pool = pool
+        # The file, not its descriptor: once it is closed the number may
+        # belong to another file
+        self.file = file
+        self.base = base
+        self.end = end
+        self.window = window
+        self.advised = offset  # Requested up to here
+        self.enabled = hasattr(os, 'posix_fadvise')
+
+    def advance(self, pos):
+        target = min(self.end, pos + self.window)
+        n = target - self.advised
+        if not self.enabled or n <= 0 or (n < self.window // 2 and target < self.end):
+            return
+        try:
+            os.posix_fadvise(self.file.fileno(), self.base + self.advised, n, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            self.enabled = False  # Not supported by this file system
+            return
+        self.pool.advised += n
+        self.advised = target
+
+
+class _Block:
+    """Consecutive frames read together; view is their data once read,
+    future the read until then"""
+
+    __slots__ = ('start', 'frames', 'future', 'view')
+
+    def __init__(self, start, frames, data):
+        self.start = start
+        self.frames = frames
+        if isinstance(data, Future):
+            self.future, self.view = data, None
+        else:
+            self.future, self.view = None, memoryview(data)
+
+    def done(self):
+        if self.view is None:
+            if not self.future.done():
+                return False
+            self.view = memoryview(self.future.result())
+        return True
+
+
+class ReadAhead:
+    """The frames of one copied transfer, read a block at a time.
+
+    Consecutive frames are grouped into blocks of at least the pool's
+    block_size. The kernel is asked to read `depth` blocks ahead into the
+    page cache (a Prefetch); a block itself is copied out only when its
+    first frame is due, inline if it is cached by then, else on the
+    pool. ready() says whether the next frame's block is read; wake(), if
+    given, is called from the pool thread when a block read there is.
+    After next(), `pending` is the future of the frame's block while it
+    is still being read and data() gives the frame's bytes.
+    """
+
+    def __init__(self, pool, file, base, frames, offset, end, wake=None):
+        self.pool = pool
+        self.file = file  # Not its descriptor, which a closed file gives up
+        self.base = base
+        self.frames = frames
+        self.wake = wake
+        self.prefetch = pool.prefetch(file, base, offset, end)
+        self.block = None  # That of the frame from next()
+        self.pending = None
+        self.closed = False
+
+    def _head(self):
+        """The block holding the next frame, its read started; None at the end"""
+        if self.closed:
+            raise ValueError("Read ahead of a closed transfer")
+        block = self.block
+        if block is None or not block.frames:
+            frames = deque()
+            size = 0
+            for frame in self.frames:
+                frames.append(frame)
+                size += frame[1]
+                if size >= self.pool.block_size:
+                    break
+            if not frames:
+                return None
+            start = frames[0][0]
+            self.prefetch.advance(start)
+            data = self.pool.read(self.file.fileno(), self.base + start, size) if size else b''
+            if self.wake and isinstance(data, Future):
+                data.add_done_callback(self._done)
+            block = self.block = _Block(start, frames, data)
+        return block
+
+    def _done(self, future):
+        if not self.closed:
+            self.wake()
+
+    def ready(self):
+        block = self._head()
+        return block is None or block.done()
+
+    def next(self):
+        """(position, size, flags) of the next frame"""
+        block = self._head()
+        frame = block.frames.popleft()
+        self.pending = None
+        if not block.done():
+            self.pool.waits += 1
+            self.pending = block.future
+        return frame
+
+    def data(self, pos, n):
+        """The n bytes at pos of the frame from next(), waiting for its
+        block to be read if need be"""
+        block = self.block
+        if block.view is None:
+            block.future.result()
+            block.done()
+        skip = pos - block.start
+        return block.view[skip:skip + n]
+
+    def close(self, on_idle):
+        """Drop the read if it has not started and call on_idle() (to
+        close the file) once it is not running any more"""
+        self.closed = True
+        future = self.block.future if self.block else None
+        self.block = self.pending = None
+        if future is None or future.cancel() or future.done():
+            on_idle()
+        else:
+            future.add_done_callback(lambda future: on_idle())
@@ -1,60 +1,261 @@
 import socket
 import threading
 import os
+import sys
 import json
+import base64
 import time
-import struct
+import argparse
+import stat
+import signal
+import logging
+from urllib.parse import parse_qs
+from library import LibraryIndex, make_etag
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common import protocol
+from cache import ContentCache, CACHE_MODES
+from mux import Connection, Transfer
+from throttle import TokenBucket, BandwidthScheduler, STREAM, BULK
+from metrics import Metrics, write_prometheus
+from metadata import MetadataStore
+from transcode import Transcoder, QUALITIES, ORIGINAL
+from checksums import ChecksumStore, CHECKSUM_EXT, covering, read_checksums
+from waveform import WaveformStore, reduce_peaks
+from storage import Storage, file_location
+from readahead import IOPool
+from broadcast import Radio, Channel
+from admission import TransferSlots, AddressLimits
+
+SERVER_MODES = ('thread', 'async')
+COMMANDS = ('LIST', 'STAT', 'PLAY', 'DOWNLOAD', 'STATS', 'META', 'ART', 'WAVE', 'RADIO', 'TUNE')
+
+log = logging.getLogger("musicserver")
 
 class MusicServer:
-    def __init__(self):
-        self.host = '0.0.0.0'
-        self.port = 12345
+    def __init__(self, host='0.0.0.0', port=12345, music_dir="music_files", mode='thread',
+                 backlog=128, max_connections=1000, idle_timeout=30.0,
+                 chunk_size=65536, use_sendfile=True, rescan_interval=5.0,
+                 cache_bytes=256 << 20, cache_mode='memory', conn_rate=0, total_rate=0,
+                 stream_share=0.8, metrics=True, metrics_file=None, metrics_interval=10.0,
+                 meta_dir=None, meta_workers=None, workers=1, reuseport=True,
+                 shutdown_timeout=10.0, rendition_dir=None, rendition_bytes=2 << 30,
+                 transcode_workers=None, encoder='auto', pregenerate=(), checksum_dir=None,
+                 channels=(), listener_buffer=10.0, max_per_ip=64, max_transfers=512,
+                 transfer_queue=512, queue_wait=5.0, retry_after=5.0, waveform_dir=None,
+                 library_roots=(), io_threads=8, readahead=2):
+        if mode not in SERVER_MODES:
+            raise ValueError(f"Unknown server mode: {mode}")
+        self.host = host
+        self.port = port
         self.server_socket = None
         self.running = False
-        self.clients = []
-        self.music_dir = "music_files"
+        # Client socket -> its Connection (None until the handler starts)
+        self.clients = {}
+        self.aio = None
+        self.accept_thread = None
+        self.stop_requested = threading.Event()
+        self.music_dir = music_dir
+        self.mode = mode
+        self.backlog = backlog
+        self.max_connections = max_connections
+        # Overload is answered with BUSY and a retry_after hint in seconds
+        self.addresses = AddressLimits(max_per_ip)
+        self.transfer_slots = TransferSlots(max_transfers, transfer_queue, queue_wait)
+        self.retry_after = retry_after
+        self.rejected = 0
+        self.idle_timeout = idle_timeout or None
+        self.chunk_size = chunk_size
+        self.use_sendfile = use_sendfile
+        # Big enough to amortize the header, small enough that a reply
+        # multiplexed behind a sendfile frame is not held up for long
+        self.sendfile_frame_size = max(chunk_size, 256 << 10)
+        self.max_page_size = 1000
+        # Bandwidth limits in bytes/s; 0 means unlimited
+        self.conn_rate = conn_rate
+        self.scheduler = BandwidthScheduler(total_rate, stream_share) if total_rate else None
+        # None when disabled; every call site checks before recording
+        self.metrics = Metrics(COMMANDS) if metrics else None
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        # Pre-fork mode: number of worker processes, and this process's
+        # slot among them (None in the supervisor or a single process)
+        self.workers = workers
+        self.worker = None
+        self.reuseport = reuseport
+        # How long stop_server lets transfers in flight finish; a retiring
+        # pre-forked worker lets them run to the end (see stop())
+        self.shutdown_timeout = shutdown_timeout
+        self.retiring = False
+        self.drain_until = None
         
         if not os.path.exists(self.music_dir):
             os.makedirs(self.music_dir)
         
-        print(f"Music Server starting on {self.host}:{self.port}")
-        print(f"Music files directory: {os.path.abspath(self.music_dir)}")
-        print(f"Available files: {os.listdir(self.music_dir)}")
-        self.start_server()
+        log.info("Music Server starting on %s:%s (%s mode)", self.host, self.port, self.mode)
+        log.info("Music files directory: %s", os.path.abspath(self.music_dir))
+        # music_dir first, then further directories or pack files; the
+        # first root holding a name serves it
+        self.storage = Storage([self.music_dir, *library_roots])
+        for root in library_roots:
+            log.info("Library root: %s", os.path.abspath(root))
+        # Disk reads of transfers, off the sending threads and event loop
+        self.io_pool = IOPool(io_threads, readahead)
+        self.library = LibraryIndex(self.storage, poll_interval=rescan_interval)
+        log.info("Indexed %d tracks", len(self.library))
+        try:
+            self.metadata = MetadataStore(meta_dir or os.path.join(self.music_dir, '.meta'),
+                                          workers=meta_workers)
+        except OSError as e:
+            log.warning("Album art disabled: %s", e)
+            self.metadata = None
+        # Qualities made for every track up front; others on first request
+        self.pregenerate = tuple(pregenerate)
+        try:
+            self.transcoder = Transcoder(rendition_dir or os.path.join(self.music_dir, '.renditions'),
+                                         rendition_bytes, transcode_workers, encoder)
+            encoder = self.transcoder.encoder
+            log.info("Renditions made with %s", encoder[0] if encoder else "WAV downsampling only")
+        except OSError as e:
+            log.warning("Renditions disabled: %s", e)
+            self.transcoder = None
+        try:
+            self.checksums = ChecksumStore(checksum_dir or os.path.join(self.music_dir, '.checksums'))
+        except OSError as e:
+            log.warning("Block checksums disabled: %s", e)
+            self.checksums = None
+        try:
+            self.waveforms = WaveformStore(waveform_dir or os.path.join(self.music_dir, '.waveforms'),
+                                           workers=meta_workers)
+        except OSError as e:
+            log.warning("Waveforms disabled: %s", e)
+            self.waveforms = None
+        self.library.on_change = self.on_library_change
+        # (name, playlist) pairs; see broadcast.Channel
+        self.radio = Radio(self, channels, listener_buffer)
+        self.cache = ContentCache(cache_bytes, mode=cache_mode)
     
     def start_server(self):
+        if self.workers > 1:
+            from prefork import Supervisor
+            Supervisor(self, self.workers, self.reuseport).run()
+            return
+        self.on_library_change(self.library.tracks)
+        self.library.start_watching()
+        self.serve()
+    
+    def on_library_change(self, tracks):
+        """Bring album art, block checksums, waveforms and pre-generated
+        renditions up to date"""
+        if self.metadata:
+            self.metadata.update(tracks, self.storage)
+        if self.checksums:
+            self.checksums.update(tracks, self.storage)
+        if self.waveforms:
+            self.waveforms.update(tracks, self.storage)
+        if self.transcoder and self.pregenerate:
+            self.transcoder.pregenerate(tracks, self.storage, self.pregenerate)
+    
+    def make_listener(self, reuseport=False):
+        """A listening socket on host:port; with reuseport, other processes
+        can bind the same port and the kernel spreads connections over them"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
-            self.running = True
-            
-            print(f"Server is listening for connections...")
-            
-            accept_thread = threading.Thread(target=self.accept_clients, daemon=True)
-            accept_thread.start()
-            
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuseport:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((self.host, self.port))
+            sock.listen(self.backlog)
+        except:
+            sock.close()
+            raise
+        return sock
+    
+    def serve(self, listener=None, reuseport=False):
+        """Accept and handle connections in this process until stopped.
+        
+        listener is a socket already listening (shared by pre-forked
+        workers); without one a new one is bound. Returns False if the
+        server could not start.
+        """
+        if self.metrics_file:
+            threading.Thread(target=self._dump_metrics, daemon=True).start()
+        try:
+            self.server_socket = listener or self.make_listener(reuseport)
+        except Exception as e:
+            log.error("Failed to start server: %s", e)
+            self.stop_server()
+            return False
+        self.running = True
+        
+        if self.mode == 'async':
+            from aio import AsyncMusicServer
+            started = True
             try:
-                while self.running:
-                    time.sleep(1)
+                self.aio = AsyncMusicServer(self)
+                self.aio.run()
             except KeyboardInterrupt:
-                self.stop_server()
-                
-        except Exception as e:
-            print(f"Failed to start server: {str(e)}")
+                pass
+            except Exception as e:
+                log.error("Failed to start server: %s", e)
+                started = False
             self.stop_server()
+            return started
+        
+        log.info("Server is listening for connections...")
+        self.accept_thread = threading.Thread(target=self.accept_clients, daemon=True)
+        self.accept_thread.start()
+        
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+            if self.worker is not None and hasattr(signal, 'SIGHUP'):
+                signal.signal(signal.SIGHUP, lambda signum, frame: self.stop(deadline=False))
+        try:
+            while not self.stop_requested.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        self.stop_server()
+        return True
+    
+    def stop(self, deadline=True):
+        """Ask serve() to stop. Transfers in flight get shutdown_timeout
+        seconds to finish, or without a deadline (a pre-forked worker
+        being replaced) all the time they need, until a later stop()
+        sets one."""
+        if deadline:
+            until = time.monotonic() + self.shutdown_timeout
+            self.drain_until = min(self.drain_until or until, until)
+        elif not self.stop_requested.is_set():
+            self.retiring = True
+        self.stop_requested.set()
     
     def stop_server(self):
-        print("\nShutting down server...")
+        """Stop accepting, let transfers in flight finish (see stop()),
+        then close the remaining connections"""
+        if self.retiring:
+            log.info("Worker %d retiring once its transfers finish", self.worker)
+        else:
+            log.info("Shutting down server...")
+        if not self.retiring and self.drain_until is None:
+            self.drain_until = time.monotonic() + self.shutdown_timeout
         self.running = False
-        for client in self.clients:
-            try:
-                client.close()
-            except:
-                pass
-        self.clients = []
-        
+        # Listeners never finish on their own; end their streams first
+        self.radio.stop()
+        if self.worker is None:
+            # Pre-forked workers share these with the supervisor, which owns them
+            self.library.stop_watching()
+            if self.metadata:
+                self.metadata.close()
+            if self.checksums:
+                self.checksums.close()
+            if self.waveforms:
+                self.waveforms.close()
+        if self.transcoder:
+            self.transcoder.close()
+        if self.accept_thread:
+            self.accept_thread.join(2)
+            self.accept_thread = None
         if self.server_socket:
             try:
                 self.server_socket.close()
@@ -62,122 +263,744 @@ class MusicServer:
                 pass
             self.server_socket = None
         
-        print("Server stopped successfully")
-        os._exit(0)
+        warned = False
+        while self.clients:
+            now = time.monotonic()
+            # Re-read every turn: a SIGTERM may end a retiring worker's wait
+            deadline = self.drain_until if self.drain_until is not None else float('inf')
+            if now >= deadline and not warned:
+                log.warning("Closing %d connections that did not finish", len(self.clients))
+                warned = True
+            if now >= deadline + 1:
+                # Handlers stuck elsewhere; close the sockets under them
+                for client in list(self.clients):
+                    try:
+                        client.close()
+                    except:
+                        pass
+                self.clients.clear()
+                break
+            for client, conn in list(self.clients.items()):
+                if conn is None or not conn.busy() or now >= deadline:
+                    # The handler sees end-of-file and cleans up
+                    try:
+                        client.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+            time.sleep(0.1)
+        self.io_pool.close()
+        log.info("Cache: %s", self.cache.stats())
+        log.info("Server stopped successfully")
     
     def accept_clients(self):
+        # Wake up regularly to notice stop_server: closing the socket does
+        # not interrupt accept(), and shutting it down would also stop the
+        # other workers sharing it
+        self.server_socket.settimeout(1.0)
         while self.running:
             try:
                 client_socket, addr = self.server_socket.accept()
-                client_socket.settimeout(30.0)  # Increased timeout
-                self.clients.append(client_socket)
-                print(f"\nNew connection from {addr}")
+                busy = self.admit_connection(addr)
+                if busy:
+                    self._reject_client(client_socket, busy)
+                    continue
+                client_socket.settimeout(self.idle_timeout)
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.clients[client_socket] = None
+                log.debug("New connection from %s", addr)
                 threading.Thread(target=self.handle_client, args=(client_socket, addr), daemon=True).start()
+            except socket.timeout:
+                continue
             except Exception as e:
                 if self.running:
-                    print(f"Error accepting connection: {str(e)}")
+                    log.error("Error accepting connection: %s", e)
                 break
     
+    def _reject_client(self, client_socket, message):
+        """Turn away a connection with an ERROR frame carrying message"""
+        try:
+            # Never let a client that does not read stall the accept loop
+            client_socket.settimeout(0)
+            protocol.send_frame(client_socket, protocol.ERROR, 0, message)
+        except Exception:
+            pass
+        try:
+            client_socket.close()
+        except:
+            pass
+    
+    def stats(self):
+        """Snapshot of server counters"""
+        return {
+            'mode': self.mode,
+            'worker': self.worker,
+            'connections': len(self.aio.connections) if self.aio else len(self.clients),
+            'transfers': self.transfer_slots.stats(),
+            'rejected': self.rejected,
+            'tracks': len(self.library),
+            'cache': self.cache.stats(),
+            'storage': self.storage.stats(),
+            'io': self.io_pool.stats(),
+            'bandwidth': self.scheduler.stats() if self.scheduler else None,
+            'renditions': self.transcoder.stats() if self.transcoder else None,
+            'checksums': self.checksums.stats() if self.checksums else None,
+            'waveforms': self.waveforms.stats() if self.waveforms else None,
+            'channels': self.radio.stats(),
+            'metrics': self.metrics.snapshot() if self.metrics else None
+        }
+    
+    def _dump_metrics(self):
+        """Rewrite metrics_file in the Prometheus text format periodically"""
+        path, labels = self.metrics_file, ()
+        if self.worker is not None:
+            root, ext = os.path.splitext(path)
+            path, labels = f"{root}-{self.worker}{ext}", (('worker', str(self.worker)),)
+        while True:
+            try:
+                write_prometheus(path, self.stats(), labels)
+            except Exception as e:
+                log.warning("Failed to write %s: %s", path, e)
+            time.sleep(self.metrics_interval)
+    
+    def connection_bucket(self):
+        """A fresh per-connection TokenBucket, or None when unlimited"""
+        return TokenBucket(self.conn_rate) if self.conn_rate else None
+    
+    def _welcome_message(self):
+        return protocol.encode_json({
+            'status': 'OK',
+            'message': 'Welcome to Music Server',
+            'version': protocol.PROTOCOL_VERSION
+        })
+    
+    def busy_reply(self, message):
+        """A BUSY reply: the request was turned away for load, not refused,
+        and may be retried after retry_after seconds"""
+        return json.dumps({
+            'status': 'BUSY',
+            'message': message,
+            'retry_after': self.retry_after
+        })
+    
+    def admit_connection(self, addr):
+        """None if a new connection from addr may be served, else the
+        BUSY message to turn it away with; count it if it is admitted"""
+        connections = len(self.aio.connections) if self.aio else len(self.clients)
+        if connections >= self.max_connections:
+            reason = 'Server is at maximum capacity'
+        elif not self.addresses.add(addr[0]):
+            reason = 'Too many connections from your address'
+        else:
+            return None
+        self.rejected += 1
+        log.warning("Rejecting connection from %s: %s", addr, reason)
+        return self.busy_reply(reason).encode()
+    
+    def process_request(self, request):
+        """Handle one protocol request.
+        
+        Returns a (message, transfer) pair: the JSON reply (str or bytes) to
+        send in a RESPONSE frame and, for PLAY and DOWNLOAD, a (location,
+        offset, length, kind) range of a storage.Location to stream after
+        it as DATA frames
+        (otherwise None). DOWNLOAD takes the same arguments as PLAY but is
+        scheduled as bulk traffic behind playback streams. Either may ask
+        for a rendition, as in PLAY@low:<name>; see _rendition.
+        
+        RADIO lists the broadcast channels and TUNE:<channel> returns the
+        Channel itself as the transfer: the connection is subscribed to it
+        until it sends a CANCEL.
+        """
+        if request == "LIST":
+            return self.library.list_payload(), None
+        
+        elif request.startswith("LIST:"):
+            return self._list_page(request[len("LIST:"):]), None
+        
+        elif request == "STATS":
+            return json.dumps(dict(self.stats(), status='OK')), None
+        
+        elif request.startswith("META:"):
+            return self._meta(request[5:]), None
+        
+        elif request.startswith("ART:"):
+            return self._art(request[4:])
+        
+        elif request.startswith("WAVE:"):
+            return self._wave(request[5:]), None
+        
+        elif request.startswith("STAT:"):
+            return self._stat(request[len("STAT:"):]), None
+        
+        elif request == "RADIO":
+            return self.radio.list_payload(), None
+        
+        elif request.startswith("TUNE:"):
+            name = request[len("TUNE:"):]
+            channel = self.radio.get(name)
+            if channel is None:
+                return json.dumps({
+                    'status': 'ERROR',
+                    'message': f'Unknown channel: {name}'
+                }), None
+            return json.dumps(dict(channel.stats(), status='OK', channel=name)), channel
+        
+        elif request.startswith(("PLAY:", "PLAY@", "DOWNLOAD:", "DOWNLOAD@")):
+            command, args = request.split(":", 1)
+            command, _, quality = command.partition("@")
+            kind = STREAM if command == "PLAY" else BULK
+            if quality and quality != ORIGINAL and quality not in QUALITIES:
+                return json.dumps({
+                    'status': 'ERROR',
+                    'message': f'Unknown quality: {quality}'
+                }), None
+            filename, offset, length = self._parse_play(args)
+            location = self.storage.locate(filename)
+            
+            track = self.library.get(filename)
+            stat = self.storage.stat(filename) if track is None else None
+            if stat is not None:
+                # Not indexed yet
+                track = {'size': stat[0], 'etag': make_etag(*stat)}
+            if track is None or location is None:
+                return json.dumps({
+                    'status': 'ERROR',
+                    'message': f'File not found: {filename}'
+                }), None
+            location, track, quality = self._rendition(filename, location, track, quality)
+            filesize = track['size']
+            
+            offset = offset or 0
+            if offset and offset >= filesize:
+                return json.dumps({
+                    'status': 'ERROR',
+                    'message': f'Range not satisfiable: {filename} has {filesize} bytes'
+                }), None
+            if not length or offset + length > filesize:
+                length = filesize - offset
+            reply = {
+                'status': 'OK',
+                'name': filename,
+                'offset': offset,
+                'length': length,
+                'total': filesize,
+                # Lets a client resuming a broken transfer check the file
+                'etag': track['etag'],
+                'quality': quality,
+                # A rendition may not be in the original's format
+                'format': os.path.splitext(location.name or location.path)[1][1:].lower()
+            }
+            # CRC32s of the blocks the range touches, so the client can
+            # check each one as it arrives and re-request only bad ones
+            reply.update(covering(self._checksums(filename, location, track, quality),
+                                  filesize, offset, length))
+            return json.dumps(reply), (location, offset, length, kind)
+        
+        return json.dumps({
+            'status': 'ERROR',
+            'message': f'Unknown command: {request.split(":", 1)[0]}'
+        }), None
+    
+    def _list_page(self, query_string):
+        """LIST:<query string> with offset, limit, sort, q, match and field"""
+        try:
+            params = {k: v[-1] for k, v in parse_qs(query_string).items()}
+            offset = max(int(params.get('offset', 0)), 0)
+            limit = min(max(int(params.get('limit', 100)), 0), self.max_page_size)
+            total, tracks, exact = self.library.page(
+                query=params.get('q', ''),
+                match=params.get('match', 'prefix'),
+                field=params.get('field'),
+                sort=params.get('sort', 'name'),
+                offset=offset,
+                limit=limit
+            )
+        except ValueError as e:
+            return json.dumps({
+                'status': 'ERROR',
+                'message': f'Bad LIST parameters: {str(e)}'
+            })
+        reply = {
+            'status': 'OK',
+            'total': total,
+            'offset': offset,
+            'files': [track['name'] for track in tracks],
+            'tracks': tracks
+        }
+        if not exact:
+            # Counting every match of a broad query costs more than the
+            # page; total is an upper bound then
+            reply['exact'] = False
+        return json.dumps(reply)
+    
+    def _stat(self, filename):
+        """Size, mtime and etag of a track, for client-side cache validation"""
+        track = self.library.get(filename)
+        if track is None:
+            # Not indexed yet (or not a library track); fall back to stat()
+            stat = self.storage.stat(filename)
+            if stat is None:
+                return json.dumps({
+                    'status': 'ERROR',
+                    'message': f'File not found: {filename}'
+                })
+            size, mtime = stat
+            track = {'size': size, 'mtime': mtime, 'etag': make_etag(size, mtime)}
+        return json.dumps({
+            'status': 'OK',
+            'name': filename,
+            'size': track['size'],
+            'mtime': track['mtime'],
+            'etag': track['etag']
+        })
+    
+    def _meta(self, filename):
+        """Tags, duration and available album-art sizes of a library track"""
+        track = self.library.get(filename)
+        if track is None:
+            return json.dumps({
+                'status': 'ERROR',
+                'message': f'File not found: {filename}'
+            })
+        reply = {
+            'status': 'OK',
+            'name': filename,
+            'etag': track['etag'],
+            'title': track['title'],
+            'artist': track['artist'],
+            'album': track['album'],
+            'duration': track['duration'],
+            'genre': None,
+            'year': None,
+            'track': None,
+            'art_sizes': [],
+            'pending': False
+        }
+        extra = self.metadata.get(filename, track['etag']) if self.metadata else None
+        if extra:
+            for key in ('genre', 'year', 'track'):
+                reply[key] = extra[key]
+            reply['art_sizes'] = sorted(int(size) for size in extra['art'])
+        elif self.metadata:
+            reply['pending'] = True
+        return json.dumps(reply)
+    
+    def _art(self, args):
+        """ART:<name>[:<size>]: the smallest stored rendition of at least
+        size pixels, sent as DATA frames like a PLAY"""
+        filename, size = args, 0
+        parts = args.rsplit(":", 1)
+        if len(parts) == 2 and parts[1].isdigit():
+            filename, size = parts[0], int(parts[1])
+        track = self.library.get(filename)
+        art = self.metadata.art_path(filename, track['etag'], size) if track and self.metadata else None
+        if art is None:
+            return json.dumps({
+                'status': 'ERROR',
+                'message': f'No album art for {filename}'
+            }), None
+        path, mime, art_size = art
+        try:
+            length = os.path.getsize(path)
+        except OSError:
+            return json.dumps({
+                'status': 'ERROR',
+                'message': f'No album art for {filename}'
+            }), None
+        return json.dumps({
+            'status': 'OK',
+            'name': filename,
+            'size': art_size,
+            'mime': mime,
+            'offset': 0,
+            'length': length,
+            'total': length
+        }), (file_location(path, length), 0, length, STREAM)
+    
+    def _wave(self, args):
+        """WAVE:<name>[:<points>]: duration, bitrate and peak waveform.
+        
+        peaks holds at most `points` (default: all stored) peak levels,
+        0-255, evenly spread over the track, base64-encoded one byte each.
+        Until the track is summarized the library's duration is sent with
+        no peaks and pending set.
+        """
+        filename, points = args, 0
+        parts = args.rsplit(":", 1)
+        if len(parts) == 2 and parts[1].isdigit():
+            filename, points = parts[0], int(parts[1])
+        track = self.library.get(filename)
+        if track is None:
+            return json.dumps({
+                'status': 'ERROR',
+                'message': f'File not found: {filename}'
+            })
+        summary = self.waveforms.get(filename, track['etag']) if self.waveforms else None
+        if summary is None:
+            duration = track['duration']
+            return json.dumps({
+                'status': 'OK',
+                'name': filename,
+                'etag': track['etag'],
+                'duration': duration,
+                'bitrate': int(track['size'] * 8 / duration) if duration else None,
+                'peaks': '',
+                'pending': self.waveforms is not None
+            })
+        peaks = reduce_peaks(summary['peaks'], points)
+        return json.dumps({
+            'status': 'OK',
+            'name': filename,
+            'etag': track['etag'],
+            # 0 where neither the file nor the library told
+            'duration': summary['duration'] or None,
+            'bitrate': summary['bitrate'] or None,
+            'sample_rate': summary['sample_rate'] or None,
+            'channels': summary['channels'] or None,
+            'peaks': base64.b64encode(peaks.tobytes()).decode('ascii'),
+            'pending': False
+        })
+    
+    def _rendition(self, filename, location, track, quality):
+        """(location, track, quality) actually served for a requested quality.
+        
+        A ready rendition is served under its own etag (the track's plus
+        ".<quality>"), so a resumed transfer never mixes it with the
+        original. Until it is made, the original is served and the
+        rendition queued; tracks it would not shrink always get the original.
+        """
+        if not quality or quality == ORIGINAL or self.transcoder is None:
+            return location, track, ORIGINAL
+        rendition = self.transcoder.lookup(filename, track['etag'], quality)
+        if rendition is None:
+            self.transcoder.request(filename, track['etag'], location, quality)
+        if not rendition:
+            return location, track, ORIGINAL
+        path, size = rendition
+        return file_location(path, size), {'size': size, 'etag': f"{track['etag']}.{quality}"}, quality
+    
+    def _checksums(self, filename, location, track, quality):
+        """Stored (block_size, sums) of the file served, or None.
+        
+        Only precomputed checksums are sent: the library's from the
+        checksum store, a rendition's from the file made along with it.
+        """
+        if quality != ORIGINAL:
+            return read_checksums(location.path + CHECKSUM_EXT)
+        if self.checksums is None:
+            return None
+        return self.checksums.get(filename, track['etag'])
+    
+    def _parse_play(self, args):
+        """Split <name>[:<offset>[:<length>]] into (name, offset, length).
+        
+        offset is None for a plain whole-file request; a missing or zero
+        length means "to end of file". Numeric suffixes are peeled off from
+        the right so names containing ':' still work.
+        """
+        parts = args.rsplit(":", 2)
+        if len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit():
+            return parts[0], int(parts[1]), int(parts[2])
+        parts = args.rsplit(":", 1)
+        if len(parts) == 2 and parts[1].isdigit():
+            return parts[0], int(parts[1]), None
+        return args, None, None
+    
     def handle_client(self, client_socket, addr):
+        reader = protocol.FrameReader(client_socket)
+        conn = Connection(self, client_socket, addr)
+        self.clients[client_socket] = conn
+        metrics = self.metrics
+        if metrics:
+            metrics.connection_opened()
         try:
             # Send welcome message
-            self._send_message(client_socket, json.dumps({
-                'status': 'OK',
-                'message': 'Welcome to Music Server'
-            }))
+            conn.send_frame(protocol.HELLO, 0, self._welcome_message())
             
-            while self.running:
+            # Runs on through stop_server, which hangs up once transfers end
+            while not conn.closed:
                 try:
-                    # Receive request
-                    request = self._receive_message(client_socket)
-                    if not request:
+                    # Receive request; transfers keep streaming meanwhile
+                    frame = reader.read_frame()
+                    if frame is None:
                         break
+                    msg_type, flags, request_id, payload = frame
                     
-                    print(f"Received request from {addr}: {request}")
+                    if msg_type == protocol.PING:
+                        conn.send_frame(protocol.PONG, request_id, payload)
+                        continue
+                    if msg_type == protocol.CANCEL:
+                        conn.cancel(request_id)
+                        continue
+                    if msg_type != protocol.REQUEST:
+                        raise protocol.ProtocolError(f"Unexpected frame type {msg_type}")
                     
-                    if request == "LIST":
-                        files = [f for f in os.listdir(self.music_dir) if f.endswith(('.mp3', '.wav'))]
-                        self._send_message(client_socket, json.dumps({
-                            'status': 'OK',
-                            'files': files
-                        }))
+                    request = str(payload, 'utf-8')
+                    log.debug("Received request from %s: %s", addr, request)
                     
-                    elif request.startswith("PLAY:"):
-                        filename = request.split(":")[1]
-                        filepath = os.path.join(self.music_dir, filename)
-                        
-                        if os.path.exists(filepath):
-                            self._send_message(client_socket, "READY")
-                            self.send_file(client_socket, filepath)
+                    started = time.perf_counter()
+                    message, transfer = self.process_request(request)
+                    slots = None
+                    if transfer and not isinstance(transfer, Channel):
+                        # May wait for a slot; this connection's reader
+                        # thread stays blocked meanwhile
+                        if self.transfer_slots.admit():
+                            slots = self.transfer_slots
                         else:
-                            self._send_message(client_socket, json.dumps({
-                                'status': 'ERROR',
-                                'message': f'File not found: {filename}'
-                            }))
+                            message, transfer = self.busy_reply('Too many transfers in progress'), None
+                    try:
+                        self._send_message(conn, request_id, message)
+                    except Exception:
+                        if slots:
+                            slots.release()
+                        raise
+                    if metrics:
+                        metrics.request_done(request, time.perf_counter() - started)
+                    if isinstance(transfer, Channel):
+                        conn.listen(request_id, transfer)
+                    elif transfer:
+                        conn.start_transfer(request_id, *transfer, slots=slots)
                     
                 except socket.timeout:
-                    print(f"Timeout with client {addr}")
+                    if conn.busy():
+                        # A client that is only receiving is not idle
+                        continue
+                    log.debug("Timeout with client %s", addr)
                     break
                 except ConnectionResetError:
-                    print(f"Client {addr} disconnected")
+                    log.debug("Client %s disconnected", addr)
                     break
                 except Exception as e:
-                    print(f"Error handling client {addr}: {str(e)}")
+                    if not conn.closed:
+                        log.warning("Error handling client %s: %s", addr, e)
+                        if metrics:
+                            metrics.error()
                     break
                     
         except Exception as e:
-            print(f"Error with client {addr}: {str(e)}")
+            log.warning("Error with client %s: %s", addr, e)
         finally:
+            conn.close()
+            try:
+                # Fails a send still in progress, so the sender stops
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            # The socket and the transfers' files are only closed once
+            # the sender thread is done with them
+            conn.join()
             try:
                 client_socket.close()
             except:
                 pass
-            if client_socket in self.clients:
-                self.clients.remove(client_socket)
-            print(f"Connection closed with {addr}")
+            self.clients.pop(client_socket, None)
+            self.addresses.remove(addr[0])
+            log.debug("Connection closed with %s", addr)
 
-    def _send_message(self, sock, message):
-        """Send a length-prefixed message"""
+    def _send_message(self, conn, request_id, message):
+        """Send a reply as a RESPONSE frame"""
         try:
             message = message.encode() if isinstance(message, str) else message
-            sock.sendall(struct.pack('!I', len(message)) + message)
+            conn.send_frame(protocol.RESPONSE, request_id, message)
         except Exception as e:
             raise ConnectionError(f"Failed to send message: {str(e)}")
 
-    def _receive_message(self, sock):
-        """Receive a length-prefixed message"""
-        try:
-            # First 4 bytes contain message length
-            raw_len = sock.recv(4)
-            if not raw_len:
-                return None
-            msg_len = struct.unpack('!I', raw_len)[0]
-            
-            # Receive the actual message
-            return b''.join([sock.recv(msg_len)]).decode()
-        except Exception as e:
-            raise ConnectionError(f"Failed to receive message: {str(e)}")
+    def send_file(self, client_socket, request_id, filepath, offset, length):
+        """Stream length bytes of filepath from offset as DATA frames.
 
-    def send_file(self, client_socket, filepath):
+        Blocking, single-transfer version of what Connection does for
+        multiplexed clients.
+        """
+        transfer = Transfer(self, request_id, file_location(filepath), offset, length)
         try:
-            filename = os.path.basename(filepath)
-            filesize = os.path.getsize(filepath)
-            
-            # Send file size first
-            client_socket.sendall(filesize.to_bytes(8, 'big'))
-            
-            # Send file data in chunks
-            with open(filepath, 'rb') as f:
-                while True:
-                    data = f.read(4096)
-                    if not data:
-                        break
-                    client_socket.sendall(data)
-            
-            print(f"File {filename} sent successfully")
+            while transfer.send_next(client_socket):
+                pass
+            log.debug("File %s sent successfully", os.path.basename(filepath))
         except Exception as e:
-            print(f"Error sending file: {str(e)}")
+            log.warning("Error sending file: %s", e)
             raise
+        finally:
+            transfer.close()
+    
+    def _frames(self, offset, end, frame_size=None):
+        """(position, size, flags) of each DATA frame for [offset, end)"""
+        frame_size = frame_size or self.chunk_size
+        if offset >= end:
+            yield offset, 0, protocol.FLAG_END
+            return
+        pos = offset
+        while pos < end:
+            n = min(frame_size, end - pos)
+            yield pos, n, protocol.FLAG_END if pos + n >= end else 0
+            pos += n
+    
+    def cached_view(self, location):
+        """Cached contents of a library track as a memoryview, or None"""
+        track = self.library.get(location.name) if location.name else None
+        if track is None:
+            return None
+        return self.cache.get(location, (track['size'], track['mtime']))
+    
+    def _can_sendfile(self, f):
+        """sendfile() only works for regular files"""
+        return self.use_sendfile and stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+
+def _qualities(value):
+    """--pregenerate: a comma-separated list of QUALITIES"""
+    qualities = [q for q in value.split(',') if q]
+    for quality in qualities:
+        if quality not in QUALITIES:
+            raise argparse.ArgumentTypeError(
+                f"unknown quality {quality!r} (choose from {', '.join(QUALITIES)})")
+    return qualities
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Music streaming server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--music-dir', default="music_files")
+    parser.add_argument('--library-root', action='append', default=[], metavar='PATH',
+                        help="another directory or pack file of tracks, searched after "
+                             "--music-dir in the order given (repeatable); see storage.py "
+                             "for building packs")
+    parser.add_argument('--io-threads', type=int, default=8,
+                        help="threads reading track data for copied transfers when it is "
+                             "not in the page cache (0: read inline)")
+    parser.add_argument('--readahead', type=int, default=2,
+                        help="256 KiB blocks of each transfer the kernel is asked to read "
+                             "ahead of the one being sent")
+    parser.add_argument('--mode', choices=SERVER_MODES, default='thread',
+                        help="thread: one thread per connection, async: single asyncio event loop")
+    parser.add_argument('--backlog', type=int, default=128,
+                        help="listen() backlog for pending connections")
+    parser.add_argument('--max-connections', type=int, default=1000,
+                        help="connections beyond this are turned away")
+    parser.add_argument('--max-per-ip', type=int, default=64,
+                        help="connections allowed from one address (0 disables)")
+    parser.add_argument('--max-transfers', type=int, default=512,
+                        help="PLAY/DOWNLOAD transfers in progress at once (0 disables)")
+    parser.add_argument('--transfer-queue', type=int, default=512,
+                        help="transfers that may wait for a free slot; more are told BUSY")
+    parser.add_argument('--queue-wait', type=float, default=5.0,
+                        help="seconds a transfer waits for a slot before it is told BUSY")
+    parser.add_argument('--retry-after', type=float, default=5.0,
+                        help="seconds BUSY replies ask clients to wait before retrying")
+    parser.add_argument('--idle-timeout', type=float, default=30.0,
+                        help="seconds before an idle client is dropped (0 disables)")
+    parser.add_argument('--chunk-size', type=int, default=65536,
+                        help="read size for the non-sendfile copy loop")
+    parser.add_argument('--no-sendfile', action='store_true',
+                        help="always copy file data through userspace")
+    parser.add_argument('--rescan-interval', type=float, default=5.0,
+                        help="seconds between library change checks (0 disables)")
+    parser.add_argument('--cache-mb', type=int, default=256,
+                        help="memory budget for hot track contents (0 disables)")
+    parser.add_argument('--cache-mode', choices=CACHE_MODES, default='memory',
+                        help="memory: copy into RAM, mmap: map files read-only "
+                             "(do not truncate cached files in place)")
+    parser.add_argument('--conn-rate', type=int, default=0,
+                        help="per-connection send limit in KiB/s (0 disables)")
+    parser.add_argument('--total-rate', type=int, default=0,
+                        help="server-wide send limit in KiB/s shared fairly "
+                             "between transfers (0 disables)")
+    parser.add_argument('--stream-share', type=float, default=0.8,
+                        help="share of --total-rate guaranteed to PLAY streams "
+                             "over DOWNLOADs")
+    parser.add_argument('--meta-dir',
+                        help="where album-art thumbnails and extended tags are kept "
+                             "(default: <music-dir>/.meta)")
+    parser.add_argument('--meta-workers', type=int,
+                        help="processes extracting album art and waveforms (default: one per CPU)")
+    parser.add_argument('--rendition-dir',
+                        help="where lower-bitrate renditions are cached "
+                             "(default: <music-dir>/.renditions)")
+    parser.add_argument('--rendition-cache-mb', type=int, default=2048,
+                        help="disk budget of the rendition cache")
+    parser.add_argument('--transcode-workers', type=int,
+                        help="processes making renditions (default: one per CPU)")
+    parser.add_argument('--encoder', choices=('auto', 'none'), default='auto',
+                        help="auto: use ffmpeg or lame when installed, none: only "
+                             "downsample WAV files")
+    parser.add_argument('--pregenerate', type=_qualities, default='',
+                        help="comma-separated qualities (%s) to make for every track "
+                             "up front instead of on first request" % ', '.join(QUALITIES))
+    parser.add_argument('--checksum-dir',
+                        help="where per-block checksums of library tracks are kept "
+                             "(default: <music-dir>/.checksums)")
+    parser.add_argument('--waveform-dir',
+                        help="where track durations and peak waveforms are kept "
+                             "(default: <music-dir>/.waveforms)")
+    parser.add_argument('--channel', action='append', default=[], metavar='NAME=PLAYLIST',
+                        help="broadcast a radio channel: PLAYLIST is an .m3u/.txt file "
+                             "of track names or a pattern such as 'jazz_*' (repeatable); "
+                             "with --workers each worker broadcasts its own copy")
+    parser.add_argument('--listener-buffer', type=float, default=10.0,
+                        help="seconds of audio a radio listener may fall behind "
+                             "before it is dropped")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="serve from this many pre-forked processes (POSIX only)")
+    parser.add_argument('--no-reuseport', action='store_true',
+                        help="make workers share one listening socket instead of "
+                             "each binding the port with SO_REUSEPORT")
+    parser.add_argument('--shutdown-timeout', type=float, default=10.0,
+                        help="seconds a stopping server lets transfers in flight finish")
+    parser.add_argument('--log-level', default='INFO',
+                        choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+                        help="DEBUG also logs every connection and request")
+    parser.add_argument('--no-metrics', action='store_true',
+                        help="disable request/traffic counters (STATS keeps the basics)")
+    parser.add_argument('--metrics-file',
+                        help="periodically write metrics here in the Prometheus text format")
+    parser.add_argument('--metrics-interval', type=float, default=10.0,
+                        help="seconds between --metrics-file updates")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    server = MusicServer()
\ No newline at end of file
+    args = parse_args()
+    logging.basicConfig(
+        level=getattr(logging, args.log_level),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    server = MusicServer(
+        host=args.host,
+        port=args.port,
+        music_dir=args.music_dir,
+        mode=args.mode,
+        backlog=args.backlog,
+        max_connections=args.max_connections,
+        max_per_ip=args.max_per_ip,
+        max_transfers=args.max_transfers,
+        transfer_queue=args.transfer_queue,
+        queue_wait=args.queue_wait,
+        retry_after=args.retry_after,
+        idle_timeout=args.idle_timeout,
+        chunk_size=args.chunk_size,
+        use_sendfile=not args.no_sendfile,
+        rescan_interval=args.rescan_interval,
+        cache_bytes=args.cache_mb << 20,
+        cache_mode=args.cache_mode,
+        conn_rate=args.conn_rate << 10,
+        total_rate=args.total_rate << 10,
+        stream_share=args.stream_share,
+        metrics=not args.no_metrics,
+        metrics_file=args.metrics_file,
+        metrics_interval=args.metrics_interval,
+        meta_dir=args.meta_dir,
+        meta_workers=args.meta_workers,
+        workers=args.workers,
+        reuseport=not args.no_reuseport,
+        shutdown_timeout=args.shutdown_timeout,
+        rendition_dir=args.rendition_dir,
+        rendition_bytes=args.rendition_cache_mb << 20,
+        transcode_workers=args.transcode_workers,
+        encoder=None if args.encoder == 'none' else 'auto',
+        pregenerate=args.pregenerate,
+        checksum_dir=args.checksum_dir,
+        waveform_dir=args.waveform_dir,
+        library_roots=args.library_root,
+        io_threads=args.io_threads,
+        readahead=args.readahead,
+        channels=[spec.split('=', 1) for spec in args.channel],
+        listener_buffer=args.listener_buffer
+    )
+    server.start_server()
\ No newline at end of file
@@ -0,0 +1,337 @@
+"""Where library tracks live: plain directories and pack files.
+
+A pack holds many tracks concatenated into one large file, each stored
+once per distinct content (keyed by its SHA-1), with a JSON index of
+name -> content and content -> (offset, size) next to it. Fewer inodes,
+and a whole album reads sequentially. Build or extend one with
+
+    python storage.py music.pack music_files/ more_music/
+"""
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+from contextlib import contextmanager
+
+AUDIO_EXTENSIONS = ('.mp3', '.wav')
+PACK_INDEX_EXT = ".idx"
+PACK_VERSION = 1
+# Packed tracks start on a page boundary, so sendfile and mmap of one
+# never share a page with its neighbour
+PACK_ALIGN = 4096
+
+log = logging.getLogger("musicserver.storage")
+
+# A byte range of a file on disk holding a track (or another servable
+# file): all of `path` for a plain file, `size` bytes at `start` for a
+# packed one. `name` is the library name, None for renditions and art.
+Location = namedtuple('Location', 'name path start size packed')
+
+
+def is_track_name(name):
+    """Whether name can be a library track: an audio file name with no
+    directory part, so it never reaches outside a library root"""
+    return (name.endswith(AUDIO_EXTENSIONS) and '\0' not in name and os.sep not in name
+            and not (os.altsep and os.altsep in name))
+
+
+def file_location(path, size=None):
+    """Location of a whole plain file that is not a library track"""
+    if size is None:
+        size = os.path.getsize(path)
+    return Location(None, path, 0, size, False)
+
+
+class SectionReader(io.RawIOBase):
+    """Read-only file object for `size` bytes at `start` of a file"""
+
+    def __init__(self, path, start, size, name=None):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.start = start
+        self.size = size
+        self.pos = 0
+        # Lets mutagen guess the format from the extension, as for a file
+        self.name = name or path
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self.pos)
+        if n <= 0:
+            return 0
+        data = os.pread(self.fd, n, self.start + self.pos)
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if not self.closed:
+            os.close(self.fd)
+        super().close()
+
+
+def open_location(location):
+    """A buffered binary file object for the track at location"""
+    if not location.packed:
+        return open(location.path, 'rb')
+    return io.BufferedReader(SectionReader(location.path, location.start, location.size, location.name))
+
+
+@contextmanager
+def local_copy(location):
+    """Path of a plain file with the track's bytes, for tools that want a
+    file name: the file itself, or a temporary copy of a packed track"""
+    if not location.packed:
+        yield location.path
+        return
+    fd, path = tempfile.mkstemp(suffix=os.path.splitext(location.name or '')[1])
+    try:
+        with os.fdopen(fd, 'wb') as dst, open_location(location) as src:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        yield path
+    finally:
+        os.remove(path)
+
+
+class DirectoryStorage:
+    """The audio files directly inside one directory"""
+
+    def __init__(self, root):
+        self.root = root
+        self.sizes = {}
+
+    def stamp(self):
+        """Changes whenever a file is added, removed or renamed"""
+        return os.stat(self.root).st_mtime_ns
+
+    def scan(self):
+        """{name: (size, mtime)} of every track"""
+        tracks = {}
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not entry.name.endswith(AUDIO_EXTENSIONS) or not entry.is_file():
+                    continue
+                st = entry.stat()
+                tracks[entry.name] = (st.st_size, st.st_mtime)
+        self.sizes = {name: size for name, (size, mtime) in tracks.items()}
+        return tracks
+
+    def stat(self, name):
+        """(size, mtime) of name, indexed or not, or None"""
+        if not is_track_name(name):
+            return None
+        try:
+            st = os.stat(os.path.join(self.root, name))
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def locate(self, name):
+        size = self.sizes.get(name)
+        if size is None:
+            # Not scanned yet; served if it is there, like before a rescan
+            stat = self.stat(name)
+            if stat is None:
+                return None
+            size = stat[0]
+        return Location(name, os.path.join(self.root, name), 0, size, False)
+
+    def describe(self):
+        return self.root
+
+
+class PackStorage:
+    """The tracks of one pack file, looked up in its index"""
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + PACK_INDEX_EXT
+        self.tracks = {}  # name -> (start, size, mtime)
+
+    def stamp(self):
+        """Changes whenever the index is rewritten"""
+        return os.stat(self.index_path).st_mtime_ns
+
+    def scan(self):
+        """Reload the index: {name: (size, mtime)} of every track"""
+        index = read_pack_index(self.index_path)
+        blobs = index['blobs']
+        tracks = {}
+        for name, (digest, mtime) in index['tracks'].items():
+            start, size = blobs[digest]
+            tracks[name] = (start, size, mtime)
+        self.tracks = tracks
+        return {name: (size, mtime) for name, (start, size, mtime) in tracks.items()}
+
+    def stat(self, name):
+        entry = self.tracks.get(name)
+        return entry[1:] if entry else None
+
+    def locate(self, name):
+        entry = self.tracks.get(name)
+        if entry is None:
+            return None
+        return Location(name, self.path, entry[0], entry[1], True)
+
+    def describe(self):
+        return self.path
+
+
+class Storage:
+    """The library roots, in order: a name found in several is served
+    from the first. Each root is a directory or a pack file."""
+
+    def __init__(self, roots):
+        self.backends = [PackStorage(root) if os.path.isfile(root) or root.endswith('.pack')
+                         else DirectoryStorage(root) for root in roots]
+        self.owners = {}  # name -> the backend it is served from
+        self.counts = {}
+
+    def stamp(self):
+        """Changes whenever any root's list of tracks does"""
+        stamps = []
+        for backend in self.backends:
+            try:
+                stamps.append(backend.stamp())
+            except OSError:
+                stamps.append(None)  # Missing for now
+        return tuple(stamps)
+
+    def scan(self):
+        """{name: (size, mtime)} of every track in every root"""
+        tracks = {}
+        owners = {}
+        counts = {}
+        for backend in self.backends:
+            try:
+                found = backend.scan()
+            except (OSError, ValueError, KeyError) as e:
+                log.warning("Cannot read %s: %s", backend.describe(), e)
+                found = {}
+            counts[backend.describe()] = len(found)
+            for name, entry in found.items():
+                if name in tracks:
+                    log.debug("%s in %s is shadowed by an earlier root", name, backend.describe())
+                    continue
+                tracks[name] = entry
+                owners[name] = backend
+        self.owners = owners
+        self.counts = counts
+        return tracks
+
+    def stat(self, name):
+        """(size, mtime) of name, or None"""
+        for backend in self.backends:
+            stat = backend.stat(name)
+            if stat is not None:
+                return stat
+        return None
+
+    def locate(self, name):
+        """Location of name, or None"""
+        owner = self.owners.get(name)
+        if owner is not None:
+            location = owner.locate(name)
+            if location is not None:
+                return location
+        for backend in self.backends:
+            location = backend.locate(name)
+            if location is not None:
+                return location
+        return None
+
+    def stats(self):
+        return dict(self.counts)
+
+
+def read_pack_index(index_path):
+    with open(index_path) as f:
+        index = json.load(f)
+    if index.get('version') != PACK_VERSION:
+        raise ValueError(f"Unsupported pack index version {index.get('version')}")
+    return index
+
+
+def pack_files(pack_path, paths):
+    """Add the audio files in paths (files or directories) to a pack,
+    creating it if needed. Contents already in the pack are not stored
+    again; a name added again points at its new contents. The old bytes
+    stay in the pack until it is rebuilt. Returns (added, stored) counts.
+    """
+    index_path = pack_path + PACK_INDEX_EXT
+    try:
+        index = read_pack_index(index_path)
+    except FileNotFoundError:
+        index = {'version': PACK_VERSION, 'blobs': {}, 'tracks': {}}
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            with os.scandir(path) as entries:
+                files.extend(sorted(entry.path for entry in entries
+                                    if entry.name.endswith(AUDIO_EXTENSIONS) and entry.is_file()))
+        else:
+            files.append(path)
+
+    added = stored = 0
+    # Appending leaves every indexed offset valid, so a running server
+    # keeps reading the pack while it grows; it sees the new tracks once
+    # the index is replaced
+    with open(pack_path, 'ab') as pack:
+        for path in files:
+            digest = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            digest = digest.hexdigest()
+            if digest not in index['blobs']:
+                start = -(-pack.tell() // PACK_ALIGN) * PACK_ALIGN
+                pack.write(bytes(start - pack.tell()))
+                with open(path, 'rb') as f:
+                    shutil.copyfileobj(f, pack, 1 << 20)
+                index['blobs'][digest] = [start, pack.tell() - start]
+                stored += 1
+            index['tracks'][os.path.basename(path)] = [digest, os.path.getmtime(path)]
+            added += 1
+        pack.flush()
+        os.fsync(pack.fileno())
+
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+    return added, stored
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Add audio files to a pack file")
+    parser.add_argument('pack', help="pack file to create or extend")
+    parser.add_argument('paths', nargs='+', help="audio files, or directories of them")
+    args = parser.parse_args(argv)
+    added, stored = pack_files(args.pack, args.paths)
+    print(f"{args.pack}: {added} tracks added, {stored} new contents stored")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import threading
+import time
+
+# Transfer classes: PLAY feeds a listener in real time, DOWNLOAD is bulk
+STREAM = 'stream'
+BULK = 'bulk'
+
+
+class TokenBucket:
+    """Token bucket rate limiter that hands out delays instead of blocking.
+
+    reserve(n) always takes n tokens, letting the bucket go into debt, and
+    returns how long the caller must wait before sending so the long-term
+    rate stays at `rate` bytes/s. Callers sleep however suits them
+    (time.sleep or asyncio.sleep). Used as the per-connection limit.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate / 10, 64 << 10))
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def available(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            return self.tokens
+
+    def reserve(self, n):
+        """Take n tokens; seconds to wait before sending them"""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class BandwidthScheduler:
+    """Server-wide bandwidth shared fairly between active transfers.
+
+    Each transfer gets a Pacer that spaces its frames to run at the
+    transfer's fair share: its class rate divided by the number of active
+    transfers in that class. PLAY streams are guaranteed stream_share of
+    max_rate and DOWNLOADs the rest, so a burst of downloads can never take
+    the bandwidth listeners need; a class with no transfers leaves the whole
+    rate to the other.
+    """
+
+    def __init__(self, max_rate, stream_share=0.8):
+        if not 0 < stream_share < 1:
+            raise ValueError("stream_share must be between 0 and 1")
+        self.max_rate = max_rate
+        self.shares = {STREAM: stream_share, BULK: 1 - stream_share}
+        self.active = {STREAM: 0, BULK: 0}
+        self.sent = {STREAM: 0, BULK: 0}
+        self.lock = threading.Lock()
+
+    def open(self, kind):
+        """Pacer for a new transfer of class kind; close() it when done"""
+        with self.lock:
+            self.active[kind] += 1
+        return Pacer(self, kind)
+
+    def _close(self, kind):
+        with self.lock:
+            self.active[kind] -= 1
+
+    def fair_rate(self, kind, n=0):
+        """Current bytes/s for one `kind` transfer; accounts n bytes sent"""
+        other = BULK if kind == STREAM else STREAM
+        with self.lock:
+            self.sent[kind] += n
+            share = self.shares[kind] if self.active[other] else 1.0
+            return self.max_rate * share / max(1, self.active[kind])
+
+    def stats(self):
+        with self.lock:
+            return {
+                'max_rate': self.max_rate,
+                'active_streams': self.active[STREAM],
+                'active_downloads': self.active[BULK],
+                'stream_bytes': self.sent[STREAM],
+                'bulk_bytes': self.sent[BULK]
+            }
+
+
+class Pacer:
+    """Spaces one transfer's frames at its fair share of a scheduler.
+
+    A transfer that fell behind (slow client, stalled disk) may catch up
+    at full speed for at most `slack` seconds' worth of data.
+    """
+
+    def __init__(self, scheduler, kind, slack=0.1):
+        self.scheduler = scheduler
+        self.kind = kind
+        self.slack = slack
+        self.next_at = time.monotonic()
+        self.closed = False
+
+    def reserve(self, n):
+        """Seconds to wait before sending the next n bytes"""
+        rate = self.scheduler.fair_rate(self.kind, n)
+        now = time.monotonic()
+        start = max(self.next_at, now - self.slack)
+        self.next_at = start + n / rate
+        return max(0.0, start - now)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.scheduler._close(self.kind)
@@ -0,0 +1,367 @@
+import array
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from operator import floordiv, rshift
+from common.cachekey import cache_key
+from checksums import CHECKSUM_EXT, block_checksums, write_checksums
+from storage import local_copy
+
+# Rendition ladder. An encoder (ffmpeg or lame) makes an MP3 at `bitrate`
+# kbps at `rate` Hz; without one, WAV tracks are downsampled to PCM WAV
+# with at most `pcm_rate` Hz, `channels` channels and `width` bytes per
+# sample instead.
+# Against 44.1 kHz 16-bit stereo WAV that is 7-22x smaller with an encoder
+# and 2-16x smaller without.
+QUALITIES = {
+    'high': {'bitrate': 192, 'rate': 44100, 'channels': 2, 'pcm_rate': 22050, 'width': 2},
+    'medium': {'bitrate': 128, 'rate': 44100, 'channels': 2, 'pcm_rate': 22050, 'width': 1},
+    'low': {'bitrate': 64, 'rate': 22050, 'channels': 1, 'pcm_rate': 11025, 'width': 1},
+}
+ORIGINAL = 'original'
+
+# Sample widths the pure-Python fallback can read, as array typecodes
+_TYPECODES = {1: 'b', 2: 'h', 4: 'i'}
+_FLIP_SIGN = bytes(b ^ 0x80 for b in range(256))
+
+log = logging.getLogger("musicserver.transcode")
+
+
+def find_encoder():
+    """(name, path) of the first encoder on PATH, or None"""
+    for name in ('ffmpeg', 'lame'):
+        path = shutil.which(name)
+        if path:
+            return name, path
+    return None
+
+
+def _encoder_command(encoder, source, target, quality):
+    name, path = encoder
+    q = QUALITIES[quality]
+    if name == 'ffmpeg':
+        return [path, '-nostdin', '-v', 'error', '-y', '-i', source, '-vn',
+                '-ac', str(q['channels']), '-ar', str(q['rate']),
+                '-b:a', f"{q['bitrate']}k", '-f', 'mp3', target]
+    command = [path, '--quiet', '-b', str(q['bitrate']),
+               '--resample', f"{q['rate'] / 1000:g}", '-m', 'm' if q['channels'] == 1 else 'j']
+    if source.lower().endswith('.mp3'):
+        command.append('--mp3input')
+    return command + [source, target]
+
+
+def _convert(frames, channels, width, factor, out_channels, out_width):
+    """Average every `factor` frames (and the channels, when going to mono)
+    and requantize to out_width bytes, all on interleaved PCM bytes"""
+    if width == 1:
+        # 8-bit WAV is unsigned; flipping the top bit makes it signed
+        frames = frames.translate(_FLIP_SIGN)
+    samples = array.array(_TYPECODES[width])
+    samples.frombytes(frames)
+    if sys.byteorder == 'big' and width > 1:
+        samples.byteswap()
+    step = channels * factor
+    del samples[len(samples) // step * step:]
+
+    out = array.array(_TYPECODES[out_width])
+    out.frombytes(bytes(len(samples) // step * out_channels * out_width))
+    shift = 8 * (width - out_width)
+    for c in range(out_channels):
+        # Mono mixes every input channel; otherwise channel c maps to c.
+        # Strided slices, zip and map keep the per-sample work in C.
+        mixed = range(channels) if out_channels == 1 else (c,)
+        parts = [samples[ch + k * channels::step] for ch in mixed for k in range(factor)]
+        values = parts[0]
+        if len(parts) > 1:
+            values = map(floordiv, map(sum, zip(*parts)), repeat(len(parts)))
+        if shift:
+            values = map(rshift, values, repeat(shift))
+        out[c::out_channels] = array.array(out.typecode, values)
+
+    if sys.byteorder == 'big' and out_width > 1:
+        out.byteswap()
+    data = out.tobytes()
+    return data.translate(_FLIP_SIGN) if out_width == 1 else data
+
+
+def downsample_wav(source, target, quality):
+    """Write a smaller PCM WAV of source; False if it would not be smaller"""
+    q = QUALITIES[quality]
+    with wave.open(source, 'rb') as src:
+        channels, width, rate = src.getnchannels(), src.getsampwidth(), src.getframerate()
+        if width not in _TYPECODES:
+            raise ValueError(f"{width * 8}-bit samples are not supported")
+        factor = max(1, -(-rate // q['pcm_rate']))
+        out_channels = min(channels, q['channels'])
+        out_width = min(width, q['width'])
+        if factor == 1 and out_channels == channels and out_width == width:
+            return False
+        with wave.open(target, 'wb') as dst:
+            dst.setnchannels(out_channels)
+            dst.setsampwidth(out_width)
+            dst.setframerate(rate // factor)
+            while True:
+                frames = src.readframes(factor * 16384)
+                if not frames:
+                    break
+                dst.writeframes(_convert(frames, channels, width, factor, out_channels, out_width))
+    return True
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # Exists, but not ours to signal
+    return True
+
+
+def _init_job_process():
+    # Forked from a server that may handle SIGTERM gracefully; a job
+    # process should just die when its pool terminates it
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def make_rendition(location, target, quality, encoder):
+    """Write the `quality` rendition of the track at a storage.Location to
+    target (runs in a worker process), with its block checksums next to
+    it. Returns False, leaving no file, if it would not be smaller."""
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    try:
+        with local_copy(location) as source:
+            if encoder:
+                subprocess.run(_encoder_command(encoder, source, tmp_path, quality),
+                               check=True, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+                made = True
+            else:
+                made = downsample_wav(source, tmp_path, quality)
+        if not made or os.path.getsize(tmp_path) >= location.size:
+            return False
+        # Before the rendition itself, so it is never served without them
+        write_checksums(target + CHECKSUM_EXT, block_checksums(tmp_path))
+        os.replace(tmp_path, target)
+        return True
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class Transcoder:
+    """Lower-bitrate renditions of library tracks, made in the background.
+
+    Renditions live in cache_dir as <key>.<quality>.<ext>, with their block
+    checksums in a .crc file next to them, keyed by track name and etag, so
+    a changed track never serves a stale copy and every process of a
+    pre-forked server sees the same cache. lookup() only stats a file on
+    the request path, touching it at most every TOUCH_INTERVAL seconds; a
+    missing rendition is queued on a process pool with request() and the
+    original is served meanwhile. Tracks a rendition would not shrink (or
+    that cannot be converted) get an empty .none marker so they are not
+    tried again. The least recently served renditions (by mtime, to
+    within TOUCH_INTERVAL) are deleted once the cache exceeds max_bytes.
+    """
+
+    STALE_LOCK = 600.0  # A job lock older than this is ignored, owner alive or not
+    TOUCH_INTERVAL = 60.0  # Seconds a served rendition's mtime may lag behind
+
+    def __init__(self, cache_dir, max_bytes=2 << 30, workers=None, encoder='auto'):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.workers = workers
+        # (name, path) of the encoder; None uses the WAV fallback only
+        self.encoder = find_encoder() if encoder == 'auto' else encoder
+        self.ext = 'mp3' if self.encoder else 'wav'
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.futures = set()
+        self._pool = None
+        self._pool_pid = None
+        self.closed = False
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self._remove_leftovers()
+
+    def _remove_leftovers(self):
+        """Drop job locks and partial files of processes that are gone"""
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.lock'):
+                    stale = self._stale(entry.path)
+                elif entry.name.endswith('.tmp'):
+                    stale = not _alive(int(entry.name.rsplit('.', 2)[1]))
+                else:
+                    continue
+                if stale:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+
+    def can_transcode(self, name):
+        """Whether renditions of name can be made at all"""
+        return self.encoder is not None or name.lower().endswith('.wav')
+
+    def _base(self, name, etag, quality):
+        return os.path.join(self.cache_dir, f"{cache_key(name, etag)}.{quality}")
+
+    def lookup(self, name, etag, quality):
+        """(path, size) of a ready rendition, False if there will never be
+        one (serve the original), or None if it has not been made yet"""
+        base = self._base(name, etag, quality)
+        path = f"{base}.{self.ext}"
+        try:
+            st = os.stat(path)
+        except OSError:
+            if not self.can_transcode(name) or os.path.exists(base + ".none"):
+                return False
+            return None
+        if time.time() - st.st_mtime > self.TOUCH_INTERVAL:
+            try:
+                # Recency for eviction
+                os.utime(path)
+            except OSError:
+                pass
+        return path, st.st_size
+
+    def request(self, name, etag, location, quality):
+        """Queue the rendition of the track at location unless it exists
+        or is being made"""
+        job = (name, etag, quality)
+        with self.lock:
+            if self.closed or job in self.pending:
+                return
+            self.pending.add(job)
+            if self._pool is None or self._pool_pid != os.getpid():
+                # A pool inherited through fork belongs to the parent
+                self._pool = ProcessPoolExecutor(self.workers, initializer=_init_job_process)
+                self._pool_pid = os.getpid()
+            pool = self._pool
+        base = self._base(name, etag, quality)
+        lock_path = base + ".lock"
+        if not self._claim(lock_path):
+            # Another process is on it
+            with self.lock:
+                self.pending.discard(job)
+            return
+        try:
+            future = pool.submit(make_rendition, location, f"{base}.{self.ext}", quality, self.encoder)
+        except RuntimeError as e:
+            # Shut down, or broken by a killed worker process
+            log.warning("Cannot queue %s rendition of %s: %s", quality, name, e)
+            with self.lock:
+                self.pending.discard(job)
+                if self._pool is pool and not self.closed:
+                    self._pool = None
+            os.remove(lock_path)
+            return
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(lambda f: self._done(f, job, base, lock_path))
+
+    def pregenerate(self, tracks, storage, qualities):
+        """Queue every missing rendition of qualities for tracks"""
+        for name, track in tracks.items():
+            for quality in qualities:
+                location = storage.locate(name)
+                if location is not None and self.lookup(name, track['etag'], quality) is None:
+                    self.request(name, track['etag'], location, quality)
+
+    def _claim(self, lock_path):
+        """Create the job's lock file; False if a live job holds it"""
+        if self._stale(lock_path):
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(os.getpid()))
+        return True
+
+    def _stale(self, lock_path):
+        """Whether the lock was left by a process that is gone"""
+        try:
+            with open(lock_path) as f:
+                pid = int(f.read() or 0)
+            age = time.time() - os.path.getmtime(lock_path)
+        except (OSError, ValueError):
+            return False  # Gone already, or still being written
+        return age >= self.STALE_LOCK or not _alive(pid)
+
+    def _done(self, future, job, base, lock_path):
+        name, etag, quality = job
+        try:
+            if future.cancelled():
+                return
+            try:
+                made = future.result()
+            except Exception as e:
+                log.warning("No %s rendition of %s: %s", quality, name, e)
+                made = False
+            if made:
+                log.info("Made %s rendition of %s", quality, name)
+                self._evict()
+            else:
+                open(base + ".none", 'w').close()
+        except OSError as e:
+            log.warning("Rendition cache: %s", e)
+        finally:
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+            with self.lock:
+                self.pending.discard(job)
+                self.futures.discard(future)
+
+    def _evict(self):
+        """Delete the least recently served renditions over max_bytes"""
+        files = []
+        total = 0
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.' + self.ext):
+                    st = entry.stat()
+                    files.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+        for mtime, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                os.remove(path + CHECKSUM_EXT)
+            except OSError:
+                pass
+
+    def stats(self):
+        return {
+            'encoder': self.encoder[0] if self.encoder else None,
+            'pending': len(self.pending)
+        }
+
+    def close(self):
+        """Drop queued jobs so shutdown does not wait for them"""
+        with self.lock:
+            self.closed = True
+            pool, self._pool = self._pool, None
+            futures = list(self.futures)
+        if pool is not None and self._pool_pid == os.getpid():
+            for future in futures:
+                future.cancel()
+            pool.shutdown(wait=False)
@@ -0,0 +1,301 @@
+import array
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import wave
+
+try:
+    import mutagen
+except ImportError:  # MP3 bitrates are then estimated from size and duration
+    mutagen = None
+
+try:
+    import numpy
+except ImportError:  # Peaks are then found with array slices instead
+    numpy = None
+
+from filestore import BatchRunner, TrackFileStore
+from storage import local_copy, open_location
+from transcode import _FLIP_SIGN, _TYPECODES, _init_job_process
+
+# Peaks stored per track; clients ask for as many as they have pixels
+# and get the stored ones max-reduced to that
+POINTS = 1024
+WAVEFORM_EXT = ".wave"
+# Magic, format version, channels, peak count, duration (s), bitrate
+# (bit/s), sample rate (Hz), then `points` unsigned bytes of peaks
+HEADER = struct.Struct('!4sBBHdII')
+MAGIC = b'MSWV'
+VERSION = 1
+
+# Rate MP3s are decoded at for their peaks: plenty for a seek bar
+DECODE_RATE = 8000
+_NUMPY_TYPES = {1: 'u1', 2: '<i2', 4: '<i4'}
+# Bytes of PCM decoded at a time: the whole track is never in memory
+READ_BYTES = 1 << 20
+
+log = logging.getLogger("musicserver.waveform")
+
+
+def _numpy_peaks(frames, width):
+    samples = numpy.frombuffer(frames, _NUMPY_TYPES[width])
+    # Widened first: abs() of the most negative sample overflows its type
+    samples = samples.astype(numpy.int64 if width == 4 else numpy.int32)
+    if width == 1:
+        samples -= 128  # 8-bit WAV is unsigned
+    return numpy.abs(samples)
+
+
+def _array_peaks(frames, width):
+    if width == 1:
+        # 8-bit WAV is unsigned; flipping the top bit makes it signed
+        frames = frames.translate(_FLIP_SIGN)
+    samples = array.array(_TYPECODES[width])
+    samples.frombytes(frames)
+    if sys.byteorder == 'big' and width > 1:
+        samples.byteswap()
+    return samples
+
+
+class PeakReducer:
+    """Max |sample| of every `bucket` frames of interleaved PCM, scaled to
+    0-255, taking the PCM in pieces of any whole number of frames"""
+
+    def __init__(self, channels, width, bucket):
+        if width not in _TYPECODES:
+            raise ValueError(f"{width * 8}-bit samples are not supported")
+        self.channels = channels
+        self.width = width
+        self.step = bucket * channels  # Samples per peak
+        self.scale = 255.0 / (1 << (8 * width - 1))
+        self.peaks = array.array('B')
+        self.pending = b''
+
+    def feed(self, frames):
+        if self.pending:
+            frames = self.pending + frames
+        whole = len(frames) // (self.step * self.width) * self.step * self.width
+        self.pending = frames[whole:]
+        if whole:
+            self._reduce(frames[:whole])
+
+    def finish(self):
+        """The peaks, including one for a last partial bucket"""
+        if self.pending:
+            self._reduce(self.pending)
+            self.pending = b''
+        return self.peaks
+
+    def _reduce(self, frames):
+        if numpy is not None:
+            samples = _numpy_peaks(frames, self.width)
+            n = -(-len(samples) // self.step)
+            if len(samples) < n * self.step:
+                # Pad a last partial bucket with silence
+                samples = numpy.concatenate((samples, numpy.zeros(n * self.step - len(samples), samples.dtype)))
+            peaks = samples.reshape(n, self.step).max(axis=1) * self.scale
+            self.peaks.frombytes(numpy.minimum(peaks, 255).astype(numpy.uint8).tobytes())
+            return
+        samples = _array_peaks(frames, self.width)
+        step, scale = self.step, self.scale
+        for i in range(0, len(samples), step):
+            part = samples[i:i + step]
+            self.peaks.append(min(255, int(max(max(part), -min(part)) * scale)))
+
+
+def reduce_peaks(peaks, points):
+    """peaks max-reduced to at most `points` values"""
+    if points <= 0 or len(peaks) <= points:
+        return peaks
+    out = array.array('B')
+    for i in range(points):
+        out.append(max(peaks[i * len(peaks) // points:(i + 1) * len(peaks) // points]))
+    return out
+
+
+def _wav_summary(location, points):
+    with open_location(location) as f, wave.open(f, 'rb') as src:
+        channels, width, rate = src.getnchannels(), src.getsampwidth(), src.getframerate()
+        nframes = src.getnframes()
+        bucket = max(1, -(-nframes // points))
+        reducer = PeakReducer(channels, width, bucket)
+        # Whole buckets at a time, so no PCM is carried over between reads
+        chunk = bucket * max(1, READ_BYTES // (bucket * channels * width))
+        while True:
+            frames = src.readframes(chunk)
+            if not frames:
+                break
+            reducer.feed(frames)
+    return {
+        'duration': nframes / float(rate) if rate else 0.0,
+        'bitrate': rate * channels * width * 8,
+        'sample_rate': rate,
+        'channels': channels,
+        'peaks': reducer.finish()
+    }
+
+
+def _decoded_peaks(decoder, path, duration, points):
+    """(peaks, duration) of any format decoder (ffmpeg) reads, from mono
+    16-bit PCM piped out of it at DECODE_RATE"""
+    # Without a duration, hundredths of a second, reduced to points at the end
+    nframes = int(duration * DECODE_RATE) if duration else 0
+    bucket = max(1, -(-nframes // points)) if nframes else DECODE_RATE // 100
+    reducer = PeakReducer(1, 2, bucket)
+    chunk = bucket * 2 * max(1, READ_BYTES // (bucket * 2))
+    decoded = 0
+    command = [decoder, '-nostdin', '-v', 'error', '-i', path, '-vn',
+               '-ac', '1', '-ar', str(DECODE_RATE), '-f', 's16le', '-']
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as proc:
+        while True:
+            frames = proc.stdout.read(chunk)
+            if not frames:
+                break
+            decoded += len(frames)
+            reducer.feed(frames)
+    if proc.returncode:
+        raise OSError(f"{os.path.basename(decoder)} exited with status {proc.returncode}")
+    # A slightly wrong duration leaves more buckets than asked for
+    return reduce_peaks(reducer.finish(), points), decoded / 2.0 / DECODE_RATE
+
+
+def summarize(location, target, points, size, duration, decoder):
+    """Compute and store the summary of the track at a storage.Location
+    (runs in a worker process).
+
+    WAV is read natively; anything else needs mutagen for its duration
+    and bitrate and the decoder for its peaks, and gets no peaks without
+    one. duration is the library's, used when nothing better is known.
+    """
+    if location.name.lower().endswith('.wav'):
+        summary = _wav_summary(location, points)
+    else:
+        summary = {'duration': duration or 0.0, 'bitrate': 0, 'sample_rate': 0,
+                   'channels': 0, 'peaks': array.array('B')}
+        audio = None
+        if mutagen is not None:
+            with open_location(location) as f:
+                audio = mutagen.File(f)
+        if audio is not None and getattr(audio, 'info', None) is not None:
+            info = audio.info
+            summary['duration'] = getattr(info, 'length', None) or summary['duration']
+            summary['bitrate'] = getattr(info, 'bitrate', 0) or 0
+            summary['sample_rate'] = getattr(info, 'sample_rate', 0) or 0
+            summary['channels'] = getattr(info, 'channels', 0) or 0
+        if decoder:
+            with local_copy(location) as path:
+                summary['peaks'], decoded = _decoded_peaks(decoder, path, summary['duration'], points)
+            summary['duration'] = summary['duration'] or decoded
+        if not summary['bitrate'] and summary['duration']:
+            summary['bitrate'] = int(size * 8 / summary['duration'])
+    write_summary(target, summary)
+
+
+def write_summary(path, summary):
+    peaks = summary['peaks']
+    header = HEADER.pack(MAGIC, VERSION, min(summary['channels'], 255), len(peaks),
+                         summary['duration'], int(summary['bitrate']), summary['sample_rate'])
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(header + peaks.tobytes())
+    os.replace(tmp_path, path)
+
+
+def read_summary(path):
+    """The summary stored by write_summary, or None"""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    if len(data) < HEADER.size:
+        return None
+    magic, version, channels, points, duration, bitrate, rate = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or len(data) != HEADER.size + points:
+        return None
+    peaks = array.array('B')
+    peaks.frombytes(data[HEADER.size:])
+    return {'duration': duration, 'bitrate': bitrate, 'sample_rate': rate,
+            'channels': channels, 'peaks': peaks}
+
+
+class WaveformStore(TrackFileStore):
+    """Durations, bitrates and peak waveforms of library tracks.
+
+    When the library index changes, new and changed tracks are summarized
+    in a process pool, one batch at a time, and each summary is stored as
+    a small binary file (a header and a byte per peak). Summaries are
+    kept in memory as arrays, about 1 KB a track; get() otherwise only
+    reads those files. Tracks not done yet have none.
+    """
+
+    EXT = WAVEFORM_EXT
+
+    def __init__(self, directory, points=POINTS, workers=None, decoder='auto'):
+        super().__init__(directory)
+        self.points = points
+        self.workers = workers
+        if decoder == 'auto':
+            decoder = shutil.which('ffmpeg')
+        self.decoder = decoder or None
+        self._runner = BatchRunner(workers, initializer=_init_job_process)
+
+    def _read(self, path):
+        return read_summary(path)
+
+    def update(self, tracks, storage):
+        """Summarize new and changed tracks in the background and forget
+        the summaries of tracks that are gone"""
+        self.prune(tracks)
+        todo = {name: track for name, track in tracks.items()
+                if (name, track['etag']) not in self.pending and self.get(name, track['etag']) is None}
+        if not todo:
+            return
+        with self.lock:
+            self.pending.update((name, track['etag']) for name, track in todo.items())
+        failed = []
+
+        def stored(name, result, error):
+            track = todo[name]
+            if error is not None:
+                failed.append(name)
+                self._store_fallback(name, track, error)
+            self._load(name, track['etag'])
+
+        def done():
+            log.info("Waveforms computed for %d of %d tracks", len(todo) - len(failed), len(todo))
+
+        self._runner.run({name: (summarize, storage.locate(name), self._path(name, track['etag']),
+                                 self.points, track['size'], track.get('duration'), self.decoder)
+                          for name, track in todo.items()}, stored, done)
+
+    def _store_fallback(self, name, track, error):
+        """Store what the library knows, so the track is not tried again
+        until it changes"""
+        log.debug("No waveform for %s: %s", name, error)
+        duration = track.get('duration') or 0.0
+        try:
+            write_summary(self._path(name, track['etag']), {
+                'duration': duration,
+                'bitrate': int(track['size'] * 8 / duration) if duration else 0,
+                'sample_rate': 0,
+                'channels': 0,
+                'peaks': array.array('B')
+            })
+        except OSError:
+            pass
+
+    def _load(self, name, etag):
+        summary = read_summary(self._path(name, etag))
+        with self.lock:
+            if summary is not None:
+                self.entries[name] = (etag, summary)
+            self.pending.discard((name, etag))
+
+    def close(self):
+        """Drop queued work; whatever is left is picked up on the next start"""
+        super().close()
+        self._runner.close()
@@ -0,0 +1,68 @@
+import io
+import zlib
+
+from integrity import BlockVerifier
+
+BLOCK = 16
+
+
+def sums_of(data):
+    return [zlib.crc32(data[i:i + BLOCK]) for i in range(0, len(data), BLOCK)]
+
+
+DATA = bytes(range(100))  # Six whole blocks and a short last one
+SUMS = sums_of(DATA)
+
+
+def feed_in_pieces(verifier, data, size=7):
+    for i in range(0, len(data), size):
+        verifier.feed(data[i:i + size])
+
+
+def test_clean_transfer_has_no_bad_blocks():
+    verifier = BlockVerifier(BLOCK, SUMS, 0, len(DATA))
+    feed_in_pieces(verifier, DATA)
+    assert verifier.bad == []
+
+
+def test_corrupt_block_is_reported_with_its_range():
+    corrupt = bytearray(DATA)
+    corrupt[40] ^= 0xff
+    corrupt[99] ^= 0xff
+    verifier = BlockVerifier(BLOCK, SUMS, 0, len(DATA))
+    feed_in_pieces(verifier, bytes(corrupt))
+    assert verifier.bad == [(32, BLOCK, SUMS[2]), (96, 4, SUMS[6])]
+
+
+def test_resume_mid_block_checks_that_block_with_its_prefix():
+    offset = 40
+    corrupt = bytearray(DATA)
+    corrupt[45] ^= 0xff
+    verifier = BlockVerifier(BLOCK, SUMS[2:], offset, len(DATA), prefix=DATA[32:offset])
+    verifier.feed(bytes(corrupt[offset:]))
+    assert verifier.bad == [(32, BLOCK, SUMS[2])]
+
+
+def test_resume_without_the_prefix_skips_the_first_block():
+    offset = 40
+    corrupt = bytearray(DATA)
+    corrupt[45] ^= 0xff
+    verifier = BlockVerifier(BLOCK, SUMS[2:], offset, len(DATA))
+    verifier.feed(bytes(corrupt[offset:]))
+    assert verifier.bad == []
+
+
+def test_check_prefix_finds_corrupt_blocks_already_on_disk():
+    offset = 40
+    on_disk = bytearray(DATA[:offset])
+    on_disk[3] ^= 0xff
+    verifier = BlockVerifier(BLOCK, SUMS[2:], offset, len(DATA), prefix=DATA[32:offset])
+    verifier.check_prefix(io.BytesIO(bytes(on_disk)), SUMS[:2])
+    verifier.feed(DATA[offset:])
+    assert verifier.bad == [(0, BLOCK, SUMS[0])]
+
+
+def test_check_prefix_reports_a_truncated_copy():
+    verifier = BlockVerifier(BLOCK, SUMS[2:], 32, len(DATA))
+    verifier.check_prefix(io.BytesIO(DATA[:20]), SUMS[:2])
+    assert verifier.bad == [(16, BLOCK, SUMS[1])]
@@ -0,0 +1,123 @@
+import struct
+import threading
+import time
+
+from streaming import StreamBuffer, StreamReader, audio_layout, id3_tag_size
+
+DATA = bytes(range(256)) * 64  # 16 KiB
+
+
+def spooled(tmp_path, capacity, data=DATA, start_offset=0):
+    """A StreamBuffer fed data the way the receiving thread does it:
+    written to the spool file first"""
+    spool = tmp_path / 'track.part'
+    spool.write_bytes(data)
+    buffer = StreamBuffer(str(spool), start_offset, capacity)
+    buffer.set_size(len(data))
+    for i in range(start_offset, len(data), 1000):
+        buffer.feed(data[i:i + 1000])
+    return buffer
+
+
+def test_recent_bytes_come_from_the_ring_older_ones_from_the_spool(tmp_path):
+    buffer = spooled(tmp_path, capacity=4096)
+    assert buffer.ring_start == len(DATA) - 4096
+    assert buffer.read_at(len(DATA) - 100, 100) == DATA[-100:]
+    assert buffer.read_at(10, 50) == DATA[10:60]
+    # Across the ring's wrap-around point
+    pos = len(DATA) - 4096 + 3000
+    assert buffer.read_at(pos, 2000) == DATA[pos:pos + 2000]
+
+
+def test_a_chunk_larger_than_the_ring_keeps_its_tail(tmp_path):
+    spool = tmp_path / 'track.part'
+    spool.write_bytes(DATA)
+    buffer = StreamBuffer(str(spool), capacity=1024)
+    buffer.feed(DATA)
+    assert buffer.written == len(DATA)
+    assert buffer.read_at(len(DATA) - 1024, 1024) == DATA[-1024:]
+
+
+def test_resumed_prefix_is_read_from_the_spool(tmp_path):
+    buffer = spooled(tmp_path, capacity=8192, start_offset=5000)
+    assert buffer.read_at(0, 5000) == DATA[:5000]
+    reader = StreamReader(buffer)
+    assert reader.read() == DATA
+    assert reader.read(10) == b''
+
+
+def test_reader_seeks_like_a_file(tmp_path):
+    buffer = spooled(tmp_path, capacity=4096)
+    reader = StreamReader(buffer)
+    assert reader.seek(-10, 2) == len(DATA) - 10
+    assert reader.read(100) == DATA[-10:]
+    reader.seek(100)
+    reader.seek(20, 1)
+    assert reader.tell() == 120 and reader.read(5) == DATA[120:125]
+
+
+def test_prebuffer_waits_for_seconds_of_audio(tmp_path):
+    header = b'RIFF' + b'\0' * 4 + b'WAVE' + b'\0' * 16 + struct.pack('<I', 1000) + b'\0' * 12
+    data = header + bytes(5000)
+    spool = tmp_path / 'track.part'
+    spool.write_bytes(data)
+    buffer = StreamBuffer(str(spool), capacity=1 << 16)
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(buffer.wait_for_prebuffer(seconds=2)))
+    waiter.start()
+    buffer.feed(data[:1000])
+    time.sleep(0.1)
+    assert not result
+    buffer.feed(data[1000:2100])  # 44 header bytes + 2 s at 1000 bytes/s
+    waiter.join(5)
+    assert result == [True]
+
+
+def test_prebuffer_reports_a_failed_transfer(tmp_path):
+    buffer = StreamBuffer(str(tmp_path / 'track.part'))
+    buffer.fail(ConnectionError("gone"))
+    assert buffer.wait_for_prebuffer(nbytes=100) is False
+
+
+def test_underrun_rebuffers_and_is_reported(tmp_path):
+    spool = tmp_path / 'track.part'
+    spool.write_bytes(DATA)
+    events = []
+    buffer = StreamBuffer(str(spool), capacity=1 << 16,
+                          on_event=lambda event, info: events.append((event, info)))
+    buffer.rebuffer_bytes = 4096
+    buffer.set_size(len(DATA))
+    buffer.feed(DATA[:1000])
+    buffer.mark_playing()
+
+    def feed_later():
+        time.sleep(0.2)
+        buffer.feed(DATA[1000:3000])
+        time.sleep(0.1)
+        buffer.feed(DATA[3000:6000])
+
+    feeder = threading.Thread(target=feed_later)
+    feeder.start()
+    # Caught up with the network: waits until rebuffer_bytes past pos arrived
+    assert buffer.read_at(1000, 500) == DATA[1000:1500]
+    feeder.join()
+    assert buffer.underruns == 1
+    assert buffer.stall_time >= 0.25
+    assert [event for event, info in events] == ['underrun', 'rebuffered']
+    assert events[0][1] == {'position': 1000, 'count': 1}
+
+
+def test_finish_moves_the_spool(tmp_path):
+    buffer = spooled(tmp_path, capacity=4096)
+    final = tmp_path / 'track.wav'
+    assert buffer.finish(str(final)) == str(final)
+    assert final.read_bytes() == DATA
+    assert buffer.read_at(0, 10) == DATA[:10]
+
+
+def test_audio_layout_of_mp3_and_wav():
+    assert audio_layout(b'RIFF') is None
+    tag = b'ID3\x04\x00\x00\x00\x00\x01\x00'  # 128 bytes of tag after the header
+    assert id3_tag_size(tag) == 138
+    frame = b'\xff\xfb\x90\x00'  # MPEG-1 Layer III, 128 kbps
+    assert audio_layout(tag + bytes(128) + frame) == (138, 16000)
@@ -0,0 +1,134 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import wave
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+SERVER_DIR = os.path.join(ROOT, 'server')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, SERVER_DIR)
+
+from common import protocol  # noqa: E402
+
+
+def write_wav(path, seconds, rate=8000, channels=1, width=2):
+    frames = bytes(range(256)) * (int(seconds * rate) * channels * width // 256 + 1)
+    with wave.open(str(path), 'wb') as w:
+        w.setnchannels(channels)
+        w.setsampwidth(width)
+        w.setframerate(rate)
+        w.writeframes(frames[:int(seconds * rate) * channels * width])
+
+
+class Client:
+    """Just enough of the protocol to drive a server from a test"""
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout=30)
+        self.next_id = 0
+        msg_type, _, _, payload = self.frame()
+        assert msg_type == protocol.HELLO
+        self.hello = protocol.decode_json(payload)
+
+    def frame(self):
+        header = bytearray(protocol.HEADER_SIZE)
+        protocol.recv_exact_into(self.sock, memoryview(header))
+        msg_type, flags, request_id, length = protocol.unpack_header(header)
+        payload = bytearray(length)
+        protocol.recv_exact_into(self.sock, memoryview(payload))
+        return msg_type, flags, request_id, bytes(payload)
+
+    def request(self, command):
+        """The reply to command, and for a transfer the bytes it sent"""
+        self.next_id += 1
+        protocol.send_frame(self.sock, protocol.REQUEST, self.next_id, command.encode())
+        msg_type, _, _, payload = self.frame()
+        reply = protocol.decode_json(payload)
+        if msg_type != protocol.RESPONSE or 'length' not in reply or reply.get('status') != 'OK':
+            return reply, None
+        data = bytearray()
+        while True:
+            msg_type, flags, _, payload = self.frame()
+            data += payload
+            if flags & protocol.FLAG_END:
+                return reply, bytes(data)
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def music_dir(tmp_path):
+    directory = tmp_path / 'music'
+    directory.mkdir()
+    write_wav(directory / 'long.wav', 16)
+    write_wav(directory / 'short.wav', 0.5)
+    return directory
+
+
+@pytest.fixture
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def run_server(tmp_path, free_port):
+    """Start server.py with extra arguments; yields a function doing so"""
+    servers = []
+
+    def start(music_dir, *args):
+        log = open(tmp_path / f'server{len(servers)}.log', 'w+')
+        proc = subprocess.Popen(
+            [sys.executable, 'server.py', '--host', '127.0.0.1', '--port', str(free_port),
+             '--music-dir', str(music_dir), *args],
+            cwd=SERVER_DIR, stdout=log, stderr=subprocess.STDOUT)
+        proc.port = free_port
+        proc.log = log
+        proc.output = lambda: read_log(proc)
+        servers.append(proc)
+        deadline = time.monotonic() + 15
+        while time.monotonic() < deadline:
+            try:
+                Client(free_port).close()
+                return proc
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("Server did not start:\n" + read_log(proc))
+
+    yield start
+    for proc in servers:
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGTERM)
+            try:
+                proc.wait(20)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        proc.log.close()
+
+
+def read_log(proc):
+    proc.log.flush()
+    proc.log.seek(0)
+    return proc.log.read()
+
+
+@pytest.fixture
+def client_for():
+    clients = []
+
+    def connect(proc):
+        client = Client(proc.port)
+        clients.append(client)
+        return client
+
+    yield connect
+    for client in clients:
+        client.close()
+
@@ -0,0 +1,51 @@
+import signal
+import socket
+import struct
+import time
+
+from common import protocol
+from conftest import Client, write_wav
+
+
+def _hang_up(port):
+    """Connect and reset the connection before the greeting is read"""
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    sock.close()
+
+
+def test_clients_hanging_up_before_hello_are_not_errors(music_dir, run_server):
+    server = run_server(music_dir, '--mode', 'async')
+    for _ in range(50):
+        _hang_up(server.port)
+    time.sleep(0.5)
+
+    client = Client(server.port)
+    reply, _ = client.request('LIST')
+    client.close()
+    assert reply['status'] == 'OK'
+    output = server.output()
+    assert 'client_connected_cb' not in output
+    assert 'Traceback' not in output
+
+
+def test_shutdown_deadline_stops_transfers_before_hanging_up(tmp_path, run_server):
+    music = tmp_path / 'big'
+    music.mkdir()
+    write_wav(music / 'big.wav', 300)  # More than the socket buffers hold
+    server = run_server(music, '--mode', 'async', '--cache-mb', '0', '--shutdown-timeout', '1')
+    # Clients that stop reading leave sendfile() waiting on a full socket
+    clients = [Client(server.port) for _ in range(3)]
+    for client in clients:
+        protocol.send_frame(client.sock, protocol.REQUEST, 1, b'PLAY:big.wav')
+        client.frame()
+    time.sleep(0.5)
+
+    server.send_signal(signal.SIGTERM)
+    assert server.wait(15) == 0
+    for client in clients:
+        client.close()
+    output = server.output()
+    assert 'Closing 3 connections that did not finish' in output
+    assert 'InvalidStateError' not in output
+    assert 'Traceback' not in output
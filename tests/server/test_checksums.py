@@ -0,0 +1,20 @@
+import array
+
+from checksums import covering
+
+SUMS = array.array('I', [10, 11, 12, 13])
+
+
+def test_covering_lists_the_blocks_a_range_touches():
+    assert covering((100, SUMS), 350, 150, 100) == {'block_size': 100, 'checksums': [11, 12]}
+
+
+def test_covering_a_resume_lists_the_blocks_before_it():
+    assert covering((100, SUMS), 350, 150, 200) == {
+        'block_size': 100, 'checksums': [11, 12, 13], 'prefix_checksums': [10]}
+    assert 'prefix_checksums' not in covering((100, SUMS), 350, 50, 300)
+
+
+def test_covering_ignores_checksums_of_another_size():
+    assert covering((100, SUMS), 500, 0, 500) == {}
+    assert covering(None, 350, 0, 350) == {}
@@ -0,0 +1,50 @@
+from metrics import Histogram, Metrics
+
+COMMANDS = ('LIST', 'PLAY', 'DOWNLOAD', 'STATS')
+
+
+def test_command_name_strips_arguments_and_quality():
+    metrics = Metrics(COMMANDS)
+    assert metrics.command_name('LIST') == 'LIST'
+    assert metrics.command_name('LIST:q=a&sort=-size') == 'LIST'
+    assert metrics.command_name('PLAY:song.mp3') == 'PLAY'
+    assert metrics.command_name('PLAY@low:song.mp3') == 'PLAY'
+    assert metrics.command_name('DOWNLOAD@medium:a:b.wav') == 'DOWNLOAD'
+
+
+def test_unknown_commands_share_a_bucket():
+    metrics = Metrics(COMMANDS)
+    assert metrics.command_name('FETCH:x') == 'UNKNOWN'
+    assert metrics.command_name('PLAYX:x') == 'UNKNOWN'
+    assert metrics.command_name('') == 'UNKNOWN'
+
+
+def test_quality_requests_are_counted_under_their_command():
+    metrics = Metrics(COMMANDS)
+    metrics.request_done('PLAY@low:a.wav', 0.01)
+    metrics.request_done('DOWNLOAD@medium:a.wav', 0.02)
+    metrics.request_done('PLAY:a.wav', 0.01)
+    assert metrics.requests['PLAY'] == 2
+    assert metrics.requests['DOWNLOAD'] == 1
+    assert metrics.requests['UNKNOWN'] == 0
+
+
+def test_histogram_quantiles():
+    histogram = Histogram(bounds=(0.1, 1.0))
+    assert histogram.quantile(0.5) is None
+    for value in (0.05, 0.05, 0.5, 5.0):
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.75) == 1.0
+    assert histogram.quantile(1.0) == '+Inf'
+    assert histogram.snapshot()['buckets'] == [[0.1, 2], [1.0, 3], ['+Inf', 4]]
+
+
+def test_stats_count_quality_requests(music_dir, run_server, client_for):
+    client = client_for(run_server(music_dir))
+    client.request('PLAY@low:short.wav')
+    client.request('DOWNLOAD@medium:short.wav')
+    requests = client.request('STATS')[0]['metrics']['requests']
+    assert requests['PLAY']['count'] == 1
+    assert requests['DOWNLOAD']['count'] == 1
+    assert requests['UNKNOWN']['count'] == 0
@@ -0,0 +1,41 @@
+import socket
+import struct
+import time
+
+import pytest
+
+from common import protocol
+from conftest import Client, write_wav
+
+
+def _hang_up_mid_transfer(port, requests):
+    """Stop reading mid-transfer, hang up the sending side (the server
+    sees end-of-file while its sender is blocked) and then reset"""
+    client = Client(port)
+    for i, request in enumerate(requests, 1):
+        protocol.send_frame(client.sock, protocol.REQUEST, i, request.encode())
+    for _ in range(len(requests) + 1):
+        client.frame()
+    client.sock.shutdown(socket.SHUT_WR)
+    time.sleep(0.2)
+    client.sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    client.close()
+
+
+@pytest.mark.parametrize('args', [('--cache-mb', '0'), ('--cache-mb', '0', '--no-sendfile'), ()])
+def test_hanging_up_mid_transfer_closes_files_after_the_sender(tmp_path, run_server, args):
+    music = tmp_path / 'big'
+    music.mkdir()
+    write_wav(music / 'big.wav', 300)  # More than the socket buffers hold
+    server = run_server(music, '--mode', 'thread', *args)
+    for _ in range(5):
+        _hang_up_mid_transfer(server.port, ['PLAY:big.wav', 'DOWNLOAD:big.wav'])
+    time.sleep(0.5)
+
+    client = Client(server.port)
+    reply, _ = client.request('STAT:big.wav')
+    client.close()
+    assert reply['status'] == 'OK'
+    output = server.output()
+    assert 'closed file' not in output
+    assert 'Traceback' not in output
@@ -0,0 +1,55 @@
+import signal
+import threading
+import time
+
+import pytest
+
+from conftest import write_wav
+
+pytestmark = pytest.mark.skipif(not hasattr(signal, 'SIGHUP'), reason="pre-fork mode is POSIX only")
+
+
+def start_play(client_for, proc, name='long.wav'):
+    client = client_for(proc)
+    result = {}
+
+    def play():
+        result['reply'], result['data'] = client.request(f'PLAY:{name}')
+
+    thread = threading.Thread(target=play)
+    thread.start()
+    return thread, result
+
+
+def seen_by_workers(client_for, proc, name, tries=8):
+    """Whether fresh connections (spread over the workers) all list name"""
+    return all(name in client_for(proc).request('LIST')[0]['files'] for _ in range(tries))
+
+
+@pytest.mark.parametrize('mode', ['thread', 'async'])
+def test_library_change_reaches_workers_without_cutting_transfers(mode, music_dir, run_server, client_for):
+    proc = run_server(music_dir, '--mode', mode, '--workers', '2', '--rescan-interval', '0.3',
+                      '--shutdown-timeout', '1', '--conn-rate', '64')
+    thread, result = start_play(client_for, proc)
+    time.sleep(0.5)
+    write_wav(music_dir / 'new.wav', 0.2)
+
+    deadline = time.monotonic() + 10
+    while not seen_by_workers(client_for, proc, 'new.wav'):
+        assert time.monotonic() < deadline, proc.output()
+        time.sleep(0.2)
+    thread.join(30)
+    assert len(result['data']) == result['reply']['length']
+    assert "Closing" not in proc.output()
+
+
+@pytest.mark.parametrize('mode', ['thread', 'async'])
+def test_sighup_lets_retiring_workers_finish(mode, music_dir, run_server, client_for):
+    proc = run_server(music_dir, '--mode', mode, '--workers', '2',
+                      '--shutdown-timeout', '0.5', '--conn-rate', '64')
+    thread, result = start_play(client_for, proc)
+    time.sleep(0.5)
+    proc.send_signal(signal.SIGHUP)
+    thread.join(30)
+    assert len(result['data']) == result['reply']['length']
+    assert "Closing" not in proc.output()
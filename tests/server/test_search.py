@@ -0,0 +1,111 @@
+import random
+
+import pytest
+
+import search
+from search import SearchIndex, tokenize
+
+ARTISTS = ['The Beatles', 'Beach House', 'Bebel Gilberto', 'Radiohead', 'Röyksopp', None]
+WORDS = ['love', 'lovely', 'glove', 'blue', 'moon', 'midnight', 'rain', 'train', 'a', 'go']
+
+
+def make_tracks(n, seed=1):
+    rng = random.Random(seed)
+    tracks = {}
+    for i in range(n):
+        name = f"track_{i:04d}.mp3"
+        tracks[name] = {
+            'name': name,
+            'title': ' '.join(rng.sample(WORDS, rng.randint(1, 3))).title() if i % 7 else None,
+            'artist': rng.choice(ARTISTS),
+            'album': f"{rng.choice(WORDS)} {rng.choice(WORDS)}",
+            'duration': rng.choice([None, rng.uniform(60, 400)]),
+            'size': rng.randint(1, 10 << 20),
+            'mtime': rng.uniform(0, 1e9)
+        }
+    return tracks
+
+
+def brute_force(tracks, query, match, field, sort):
+    """What page() should return, worked out the slow way"""
+    words = tokenize(query)
+    fields = [field] if field else list(search.SEARCH_FIELDS)
+
+    def matches(track):
+        tokens = tokenize(' '.join(track[f] for f in search.SEARCH_FIELDS if track.get(f)))
+        own = [t for f in fields for t in tokenize(track.get(f))]
+        if match == 'prefix':
+            hit = lambda w, ts: any(t.startswith(w) for t in ts)
+        else:
+            hit = lambda w, ts: any(w in t for t in ts)
+        return all(hit(w, tokens) and hit(w, own) for w in words)
+
+    key = sort.lstrip('-')
+    found = [t for t in tracks.values() if matches(t)]
+    present = [t for t in found if t.get(key) is not None]
+    missing = [t for t in found if t.get(key) is None]
+    fold = (lambda v: v.casefold()) if key in search.SEARCH_FIELDS else (lambda v: v)
+    present.sort(key=lambda t: (fold(t[key]), list(tracks).index(t['name'])))
+    ordered = present + missing
+    return ordered[::-1] if sort.startswith('-') else ordered
+
+
+@pytest.fixture(scope='module')
+def tracks():
+    return make_tracks(600)
+
+
+@pytest.fixture(scope='module')
+def index(tracks):
+    return SearchIndex(tracks)
+
+
+@pytest.mark.parametrize('query', ['', 'lo', 'love', 'blue moon', 'be', 'röyk', 'zzz', 'track_01'])
+@pytest.mark.parametrize('match', ['prefix', 'substring'])
+@pytest.mark.parametrize('sort', ['name', '-size', 'artist', '-title', 'duration'])
+def test_pages_match_a_brute_force_search(tracks, index, query, match, sort):
+    expected = brute_force(tracks, query, match, None, sort)
+    for offset, limit in ((0, 10), (5, 50), (len(expected) - 3, 10), (0, 0), (len(expected) + 5, 10)):
+        offset = max(offset, 0)
+        total, page, exact = index.page(query, match, None, sort, offset, limit)
+        assert exact
+        assert total == len(expected)
+        # Ties may come in any order; compare the sort keys
+        key = sort.lstrip('-')
+        assert [t.get(key) for t in page] == [t.get(key) for t in expected[offset:offset + limit]]
+
+
+@pytest.mark.parametrize('field', ['title', 'artist', 'album'])
+def test_field_filter(tracks, index, field):
+    expected = brute_force(tracks, 'lo', 'prefix', field, 'name')
+    total, page, exact = index.page('lo', 'prefix', field, 'name', 0, 1000)
+    assert (total, exact) == (len(expected), True)
+    assert [t['name'] for t in page] == [t['name'] for t in expected]
+
+
+def test_bad_parameters(index):
+    for kwargs in ({'sort': 'colour'}, {'match': 'regex'}, {'field': 'genre'}):
+        with pytest.raises(ValueError):
+            index.page('love', **kwargs)
+
+
+def test_broad_queries_give_an_upper_bound_when_counting_is_costly(monkeypatch, tracks):
+    monkeypatch.setattr(search, 'COUNT_LIMIT', 20)
+    monkeypatch.setattr(search, 'WALK_COST', 1)  # Walk the sort order rather than gather
+    index = SearchIndex(tracks)
+    for query in ('lo bl', 'love moon'):
+        expected = brute_force(tracks, query, 'prefix', None, 'name')
+        total, page, exact = index.page(query, 'prefix', None, 'name', 0, 5)
+        assert [t['name'] for t in page] == [t['name'] for t in expected[:5]]
+        assert not exact and total >= len(expected)
+    # A single prefix has its count worked out when the index is built
+    total, page, exact = index.page('lo', 'prefix', None, 'name', 0, 5)
+    assert (total, exact) == (len(brute_force(tracks, 'lo', 'prefix', None, 'name')), True)
+
+
+def test_search_returns_ids_of_matching_tracks(tracks, index):
+    assert index.search('') is None
+    assert index.search('zzz') == set()
+    ids = index.search('blue', 'substring')
+    assert {index.tracks[tid]['name'] for tid in ids} == {
+        t['name'] for t in brute_force(tracks, 'blue', 'substring', None, 'name')}
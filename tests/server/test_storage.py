@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+from storage import Storage, is_track_name
+
+from conftest import write_wav
+
+
+@pytest.mark.parametrize('name', ['song.mp3', 'song.wav', 'a b..c.mp3', '..mp3'])
+def test_plain_audio_names_are_track_names(name):
+    assert is_track_name(name)
+
+
+@pytest.mark.parametrize('name', [
+    '../secret.wav',
+    '../../etc/passwd.mp3',
+    'sub/song.mp3',
+    '/abs/song.wav',
+    'song.mp3\0.txt',
+    'bad\0.mp3',
+    'notes.txt',
+    'song.wav/',
+    '',
+])
+def test_paths_and_other_files_are_not(name):
+    assert not is_track_name(name)
+
+
+def test_storage_never_serves_names_outside_its_roots(tmp_path):
+    root = tmp_path / 'music'
+    root.mkdir()
+    write_wav(root / 'inside.wav', 0.1)
+    write_wav(tmp_path / 'outside.wav', 0.1)
+    storage = Storage([str(root)])
+    storage.scan()
+
+    assert storage.locate('inside.wav').path == os.path.join(str(root), 'inside.wav')
+    assert storage.stat('../outside.wav') is None
+    assert storage.locate('../outside.wav') is None
+    assert storage.locate(str(tmp_path / 'outside.wav')) is None
+
+
+def test_unscanned_tracks_are_found_by_name(tmp_path):
+    root = tmp_path / 'music'
+    root.mkdir()
+    storage = Storage([str(root)])
+    storage.scan()
+    write_wav(root / 'new.wav', 0.1)
+    assert storage.locate('new.wav') is not None
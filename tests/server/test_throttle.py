@@ -0,0 +1,69 @@
+import pytest
+
+import throttle
+from throttle import BULK, STREAM, BandwidthScheduler, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(throttle.time, 'monotonic', clock)
+    return clock
+
+
+def test_bucket_lets_a_burst_through_then_paces(clock):
+    bucket = TokenBucket(100 << 10, burst=64 << 10)
+    assert bucket.reserve(64 << 10) == 0.0
+    assert bucket.reserve(50 << 10) == pytest.approx(0.5)
+    # Debt is paid off at the rate
+    clock.now += 0.5
+    assert bucket.available() == pytest.approx(0)
+    clock.now += 10
+    assert bucket.available() == 64 << 10  # Never more than the burst
+
+
+def test_bucket_burst_defaults_to_a_tenth_of_a_second_or_64k():
+    assert TokenBucket(10 << 20).burst == 1 << 20
+    assert TokenBucket(1 << 10).burst == 64 << 10
+
+
+def test_fair_rate_splits_each_class_between_its_transfers(clock):
+    scheduler = BandwidthScheduler(1000, stream_share=0.8)
+    streams = [scheduler.open(STREAM), scheduler.open(STREAM)]
+    # Alone, the streams share the whole rate
+    assert scheduler.fair_rate(STREAM) == 500
+    download = scheduler.open(BULK)
+    assert scheduler.fair_rate(STREAM) == 400
+    assert scheduler.fair_rate(BULK) == pytest.approx(200)
+    for pacer in streams:
+        pacer.close()
+    assert scheduler.fair_rate(BULK) == 1000
+    download.close()
+    download.close()  # Closing twice counts once
+    assert scheduler.stats()['active_downloads'] == 0
+
+
+def test_stream_share_must_be_a_fraction():
+    with pytest.raises(ValueError):
+        BandwidthScheduler(1000, stream_share=1)
+
+
+def test_pacer_spaces_frames_and_limits_catching_up(clock):
+    scheduler = BandwidthScheduler(1000)
+    pacer = scheduler.open(STREAM)
+    assert pacer.reserve(500) == 0.0
+    assert pacer.reserve(500) == pytest.approx(0.5)
+    # Long stalled: only `slack` seconds of data may go out at once
+    clock.now += 60
+    assert pacer.reserve(50) == 0.0
+    assert pacer.reserve(100) == 0.0
+    assert pacer.reserve(100) == pytest.approx(0.05)
+    assert scheduler.stats()['stream_bytes'] == 1250
@@ -0,0 +1,40 @@
+import os
+import time
+
+import pytest
+
+from server import parse_args
+from transcode import Transcoder
+
+
+def test_pregenerate_takes_a_list_of_qualities():
+    assert parse_args([]).pregenerate == []
+    assert parse_args(['--pregenerate', 'low,high']).pregenerate == ['low', 'high']
+
+
+def test_pregenerate_rejects_unknown_qualities(capsys):
+    with pytest.raises(SystemExit):
+        parse_args(['--pregenerate', 'low,lossless'])
+    assert "unknown quality 'lossless'" in capsys.readouterr().err
+
+
+def test_lookup_touches_a_rendition_at_most_every_interval(tmp_path):
+    transcoder = Transcoder(tmp_path, encoder=None)
+    path = f"{transcoder._base('a.wav', 'e1', 'low')}.{transcoder.ext}"
+    with open(path, 'wb') as f:
+        f.write(b'x' * 10)
+    recent = time.time() - 5
+    os.utime(path, (recent, recent))
+    assert transcoder.lookup('a.wav', 'e1', 'low') == (path, 10)
+    assert os.path.getmtime(path) == pytest.approx(recent)
+
+    old = time.time() - 2 * Transcoder.TOUCH_INTERVAL
+    os.utime(path, (old, old))
+    transcoder.lookup('a.wav', 'e1', 'low')
+    assert os.path.getmtime(path) > time.time() - 5
+
+
+def test_lookup_of_missing_renditions(tmp_path):
+    transcoder = Transcoder(tmp_path, encoder=None)
+    assert transcoder.lookup('a.wav', 'e1', 'low') is None
+    assert transcoder.lookup('a.mp3', 'e1', 'low') is False
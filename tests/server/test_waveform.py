@@ -0,0 +1,112 @@
+import array
+import struct
+import threading
+import time
+
+import pytest
+
+import waveform
+from filestore import BatchRunner
+from storage import Location
+from waveform import PeakReducer, WaveformStore, read_summary, reduce_peaks
+
+from conftest import write_wav
+
+
+def pcm16(samples):
+    return struct.pack(f'<{len(samples)}h', *samples)
+
+
+@pytest.fixture(params=['numpy', 'array'])
+def peaks_with(request, monkeypatch):
+    """Runs a test with numpy (when installed) and with array slices"""
+    if request.param == 'numpy' and waveform.numpy is None:
+        pytest.skip("numpy is not installed")
+    if request.param == 'array':
+        monkeypatch.setattr(waveform, 'numpy', None)
+
+
+def test_peaks_are_scaled_max_of_each_bucket(peaks_with):
+    reducer = PeakReducer(1, 2, 2)
+    reducer.feed(pcm16([0, 16384, -32768, 100, 0, 0]))
+    assert reducer.finish().tolist() == [127, 255, 0]
+
+
+def test_pieces_of_any_size_give_the_same_peaks(peaks_with):
+    frames = pcm16([(i * 997) % 65536 - 32768 for i in range(1000)])
+    whole = PeakReducer(2, 2, 7)
+    whole.feed(frames)
+    pieces = PeakReducer(2, 2, 7)
+    for i in range(0, len(frames), 12):
+        pieces.feed(frames[i:i + 12])
+    assert pieces.finish() == whole.finish()
+    assert len(whole.peaks) == -(-500 // 7)
+
+
+def test_eight_bit_samples_are_unsigned(peaks_with):
+    reducer = PeakReducer(1, 1, 2)
+    reducer.feed(bytes([128, 128, 0, 255]))
+    assert reducer.finish().tolist() == [0, 255]
+
+
+def test_unsupported_sample_width():
+    with pytest.raises(ValueError):
+        PeakReducer(1, 3, 10)
+
+
+def test_reduce_peaks_keeps_the_maximum():
+    peaks = array.array('B', [1, 9, 2, 3, 8, 4])
+    assert reduce_peaks(peaks, 3).tolist() == [9, 3, 8]
+    assert reduce_peaks(peaks, 10) is peaks
+
+
+def test_batch_runner_reports_results_in_order():
+    results = []
+    finished = threading.Event()
+    runner = BatchRunner(1)
+    runner.run({'a': (pow, 2, 3), 'b': (pow, 2, 'x'), 'c': (abs, -4)},
+               lambda key, result, error: results.append((key, result, type(error))),
+               finished.set)
+    assert finished.wait(30)
+    assert results == [('a', 8, type(None)), ('b', None, TypeError), ('c', 4, type(None))]
+
+
+def _wait_for(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+class _Storage:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def locate(self, name):
+        path = self.directory / name
+        return Location(name, str(path), 0, path.stat().st_size, False)
+
+
+def test_store_summarizes_tracks_and_prunes_old_versions(tmp_path):
+    music = tmp_path / 'music'
+    music.mkdir()
+    write_wav(music / 'a.wav', 1)
+    (music / 'broken.wav').write_bytes(b'not a wav')
+    tracks = {'a.wav': {'etag': 'v1', 'size': 16044, 'duration': 1.0},
+              'broken.wav': {'etag': 'v1', 'size': 9, 'duration': 2.0}}
+    store = WaveformStore(tmp_path / 'waves', points=100, workers=1, decoder=None)
+    try:
+        store.update(tracks, _Storage(music))
+        _wait_for(lambda: not store.pending)
+        summary = store.get('a.wav', 'v1')
+        assert summary['duration'] == 1.0 and len(summary['peaks']) == 100
+        # A track that cannot be read keeps what the library knows
+        fallback = store.get('broken.wav', 'v1')
+        assert fallback['duration'] == 2.0 and not fallback['peaks']
+
+        old_path = store._path('a.wav', 'v1')
+        store.prune({'a.wav': {'etag': 'v2'}})
+        assert read_summary(old_path) is None
+        assert store.get('a.wav', 'v1') is None
+    finally:
+        store.close()